@@ -1,34 +1,65 @@
-import logging
-from logging.handlers import RotatingFileHandler
 import os
+import time
 
 from flask import Flask
-from config import Settings
-from app.middlewares import exception_handler_middleware
+from pydantic import ValidationError
+from config import Settings, settings
+from app.exceptions import GitBusyError
+from app.acl import AccessDeniedError
+from app.middlewares import (access_denied_response, admission_control_middleware,
+                             capture_middleware, exception_handler_middleware, git_busy_response,
+                             profiling_middleware, validation_error_response)
+from app.logs import configure_logging, request_log_middleware
 
 
 def create_app(config_class=Settings):
+    started = time.perf_counter()
+
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    app.wsgi_app = profiling_middleware(app.wsgi_app)
     app.wsgi_app = exception_handler_middleware(app.wsgi_app)
+    # Inside admission, so rejected requests cost nothing to record.
+    if settings.CAPTURE_PATH:
+        app.wsgi_app = capture_middleware(app.wsgi_app)
+    if settings.ADMISSION_CONTROL:
+        app.wsgi_app = admission_control_middleware(app.wsgi_app)
+    # Outermost, so access records cover the time spent waiting for admission.
+    app.wsgi_app = request_log_middleware(app.wsgi_app)
+    app.register_error_handler(GitBusyError, git_busy_response)
+    app.register_error_handler(AccessDeniedError, access_denied_response)
+    app.register_error_handler(ValidationError, validation_error_response)
 
     from app.routes import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.search import rebuild_search_index_command
+    app.cli.add_command(rebuild_search_index_command)
+
     if not app.debug and not app.testing:
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/wenoteapi.log',
-                                           maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
+        configure_logging()
         app.logger.info('WenoteAPI startup')
 
-    return app
+    if settings.WARMUP_ON_BOOT and not app.testing:
+        # Runs inside the gunicorn worker before it starts accepting requests.
+        from app.warmup import warm_up
+        warm_up(settings.WARMUP_REPOS or [settings.REPO_PATH])
 
+    if settings.JOURNAL_WRITES and not app.testing:
+        # Finishes writes acknowledged before a crash or restart.
+        from app.journal import journaled_repos
+        from app.services import get_note_journal
+        # Requests may name any repository, so also those only the registry knows of.
+        repos = [*journaled_repos(), *(settings.WARMUP_REPOS or [settings.REPO_PATH])]
+        for repo_path in dict.fromkeys(os.path.abspath(repo_path) for repo_path in repos):
+            journal = get_note_journal(repo_path)
+            journal.apply_pending()
+            journal.kick()
+
+    from app import metrics
+    startup_seconds = time.perf_counter() - started
+    metrics.set_gauge("startup_seconds", startup_seconds)
+    app.logger.info('WenoteAPI ready in %.3fs', startup_seconds)
+
+    return app
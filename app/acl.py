@@ -0,0 +1,161 @@
+"""Per-note access control.
+
+Rules are versioned with the notes, in ACL_FILE at the root of the tree:
+
+    {"rules": [
+        {"path": "private", "user": "*", "access": "none"},
+        {"path": "private/alice", "user": "alice", "access": "write"},
+        {"path": "handbook", "user": "*", "access": "read"}
+    ]}
+
+A rule covers its path and everything below it; the most specific path
+wins, and on one path a rule for the user wins over a "*" rule. Notes
+without any rule are writable by everyone. ACL_FILE itself is read-only
+unless a rule on its own path grants more, so the rules cannot be
+rewritten through the notes API by default.
+
+Rules are compiled into a trie of path components, so evaluating a note
+costs O(path depth) regardless of the number of rules. Compiled indexes
+are cached per repository and commit, and shared between commits with the
+same ACL_FILE blob, so permission checks add no git lookups on hot paths.
+
+Typical usage example:
+    acl = get_acl(repo_path, commit_id)
+    readonly = acl.access(user, note_path) != WRITE
+"""
+
+import collections
+import json
+import os
+import threading
+
+from app.backends import get_backend
+from app.exceptions import LogicalError
+from config import settings
+
+NONE, READ, WRITE = "none", "read", "write"
+ACCESS_LEVELS = (NONE, READ, WRITE)
+
+
+class AclIndex:
+    def __init__(self, rules: list[dict]):
+        # node: [children by path component, access by user name or "*"]
+        self._root: list = [{}, {}]
+        for rule in rules:
+            path, user, access = rule["path"], rule.get("user", "*"), rule["access"]
+            if access not in ACCESS_LEVELS:
+                raise LogicalError(f"invalid access in {settings.ACL_FILE} - {access}")
+            node = self._root
+            for part in _parts(path):
+                node = node[0].setdefault(part, [{}, {}])
+            node[1][user] = access
+
+    @property
+    def empty(self) -> bool:
+        return not self._root[0] and not self._root[1]
+
+    def access(self, user: str | None, note_path: str) -> str:
+        """Access of a user, None for anonymous requests, to a note."""
+        parts = _parts(note_path)
+        node = self._root
+        access = _match(node[1], user) or WRITE
+        rule = None
+        for part in parts:
+            node = node[0].get(part)
+            if node is None:
+                rule = None
+                break
+            rule = _match(node[1], user)
+            access = rule or access
+        if access == WRITE and rule is None and "/".join(parts) == settings.ACL_FILE.strip("/"):
+            return READ
+        return access
+
+    def filter(self, user: str | None, note_paths: list[str]) -> list[str]:
+        """Note paths the user may read."""
+        if self.empty:
+            return note_paths
+        return [note_path for note_path in note_paths if self.access(user, note_path) != NONE]
+
+    def visible(self, user: str | None, dir_path: str) -> bool:
+        """Whether the user may read the directory or anything below it."""
+        if self.access(user, dir_path) != NONE:
+            return True
+        node = self._node(dir_path)
+        return node is not None and _grants_below(node, user)
+
+    def uniform(self, dir_path: str) -> bool:
+        """Whether no rule below dir_path changes the access of the notes in it."""
+        node = self._node(dir_path)
+        return node is None or not node[0]
+
+    def _node(self, path: str) -> list | None:
+        node = self._root
+        for part in _parts(path):
+            node = node[0].get(part)
+            if node is None:
+                return None
+        return node
+
+
+def _parts(path: str) -> list[str]:
+    return [part for part in path.split("/") if part not in ("", ".")]
+
+
+def _grants_below(node: list, user: str | None) -> bool:
+    return any(_match(child[1], user) not in (None, NONE) or _grants_below(child, user)
+               for child in node[0].values())
+
+
+def _match(rules: dict[str, str], user: str | None) -> str | None:
+    if not rules:
+        return None
+    return rules.get(user) or rules.get("*")
+
+
+class AccessDeniedError(LogicalError):
+    """The user may not read or change the note."""
+
+
+ALLOW_ALL = AclIndex([])
+
+_acl_by_commit: collections.OrderedDict[tuple[str, str], AclIndex] = collections.OrderedDict()
+_acl_by_blob: dict[str, AclIndex] = {}
+_acl_lock = threading.Lock()
+
+
+def get_acl(repo_path: str, commit_id: str) -> AclIndex:
+    """Compiled ACL of a commit, cached by commit and by ACL_FILE blob."""
+    key = (os.path.abspath(repo_path or os.curdir), commit_id)
+    with _acl_lock:
+        acl = _acl_by_commit.get(key)
+        if acl is not None:
+            _acl_by_commit.move_to_end(key)
+            return acl
+
+    backend = get_backend(repo_path)
+    blob_id = backend.blob_id(settings.ACL_FILE, commit_id)
+    if blob_id is None:
+        acl = ALLOW_ALL
+    else:
+        with _acl_lock:
+            acl = _acl_by_blob.get(blob_id)
+        if acl is None:
+            try:
+                rules = json.loads(backend.read_blob(settings.ACL_FILE, commit_id))["rules"]
+            except (ValueError, KeyError, TypeError) as e:
+                raise LogicalError(f"malformed {settings.ACL_FILE} at {commit_id} - {e}")
+            acl = AclIndex(rules)
+
+    with _acl_lock:
+        if blob_id is not None:
+            _acl_by_blob[blob_id] = acl
+        _acl_by_commit[key] = acl
+        while len(_acl_by_commit) > settings.ACL_CACHE_SIZE:
+            _acl_by_commit.popitem(last=False)
+        # Drops compiled rules no cached commit refers to any more.
+        if len(_acl_by_blob) > settings.ACL_CACHE_SIZE:
+            live = {id(index) for index in _acl_by_commit.values()}
+            for stale in [oid for oid, index in _acl_by_blob.items() if id(index) not in live]:
+                del _acl_by_blob[stale]
+    return acl
@@ -0,0 +1,206 @@
+"""Snapshot export and import of all notes as one archive.
+
+Export streams `git archive` output chunk by chunk. Import streams archive
+members straight into `git fast-import`, producing a single commit on top
+of MAIN_BRANCH without touching the worktree per note. Both run in
+constant memory. Uploads are spooled to a temporary file before any lock
+or git process slot is taken, so a slow client holds neither; members
+above LFS_THRESHOLD_BYTES go into the large object store like other
+uploads.
+
+Typical usage example:
+    commit_id, chunks = export_archive(git, "master", "tar")
+    with spool_upload(request.stream) as upload:
+        old, new, imported, skipped = import_archive(git, upload, "tar", "master")
+"""
+
+import logging
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from contextlib import ExitStack, contextmanager
+from typing import IO, Callable, Iterator
+
+from .utils import GitCommander
+from .executor import executor
+from .exceptions import LogicalError
+from .lfs import LargeObjectStore, make_pointer
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMATS = {
+    "tar": "application/x-tar",
+    "tar.gz": "application/gzip",
+    "zip": "application/zip",
+}
+CHUNK_SIZE = 64 * 1024
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+
+
+def export_archive(git: GitCommander, rev: str, fmt: str,
+                   exclude: Callable[[str], bool] | None = None) -> tuple[str, "ArchiveStream"]:
+    """Resolves rev and returns its commit id with an iterable of archive chunks.
+
+    Notes for which exclude returns True are left out; the archive is then
+    made from an unreferenced commit without them.
+    """
+    commit_id = git.get_commit_id(rev)
+    tree_ish = commit_id
+    if exclude is not None:
+        excluded = [note_path for note_path in git.list_files(commit_id) if exclude(note_path)]
+        if excluded:
+            tree_ish = git.write_tree_commit(commit_id, dict.fromkeys(excluded),
+                                             msg=f"export of {commit_id}")
+    return commit_id, ArchiveStream(git, commit_id, fmt, tree_ish)
+
+
+class ArchiveStream:
+    """Iterable over `git archive` output holding a git process slot until closed.
+
+    The WSGI server calls close() even when the client goes away before the
+    first chunk, which a plain generator would not notice.
+    """
+
+    def __init__(self, git: GitCommander, commit_id: str, fmt: str, tree_ish: str | None = None):
+        self.commit_id = commit_id
+        self._slot = ExitStack()
+        self._slot.enter_context(executor.slot(git.repo_path))
+        try:
+            self._proc = git.archive(tree_ish or commit_id, fmt)
+        except BaseException:
+            self._slot.close()
+            raise
+
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self._proc.stdout.read(CHUNK_SIZE):
+            yield chunk
+
+    def close(self) -> None:
+        proc = self._proc
+        proc.stdout.close()
+        if proc.poll() is None:  # client went away mid-stream
+            proc.kill()
+        if proc.wait() not in (0, -9):
+            logger.error("git archive of %s exited with %s", self.commit_id, proc.returncode)
+        self._slot.close()
+
+
+@contextmanager
+def spool_upload(stream: IO[bytes]) -> Iterator[IO[bytes]]:
+    """Copies an upload into a temporary file, removed on exit, and yields it rewound."""
+    with tempfile.SpooledTemporaryFile(SPOOL_MEMORY_BYTES) as spool:
+        shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+        spool.seek(0)
+        yield spool
+
+
+def import_archive(git: GitCommander, upload: IO[bytes], fmt: str, branch_name: str,
+                   replace: bool = False, message: str = "import notes",
+                   may_write: Callable[[str], bool] | None = None) -> tuple[str, str, int, int]:
+    """Commits every regular file of the archive onto branch_name in one commit.
+
+    Args:
+        upload: the archive, already spooled by spool_upload().
+        replace: drop all existing notes instead of overlaying the archive on them.
+        may_write: notes for which it returns False are neither imported nor dropped.
+
+    Returns:
+        old head, new head, number of imported notes, number of skipped notes.
+
+    Raises:
+        LogicalError: The archive is malformed, has a member above MAX_NOTE_BYTES
+            or branch_name moved during the import.
+    """
+    head = git.get_commit_id(branch_name)
+    msg = message.encode()
+    commit_header = (
+        f"commit refs/heads/{branch_name}\n"
+        f"committer {git.get_committer_ident()}\n"
+        f"data {len(msg)}\n".encode() + msg + f"\nfrom {head}\n".encode()
+    )
+
+    deletions = b""
+    if replace and may_write is None:
+        deletions = b"deleteall\n"
+    elif replace:
+        deletions = "".join(f"D {note_path}\n" for note_path in git.list_files(head)
+                            if may_write(note_path)).encode()
+
+    threshold = settings.LFS_THRESHOLD_BYTES
+    imported = skipped = 0
+    with executor.slot(git.repo_path):
+        proc = git.fast_import()
+        try:
+            proc.stdin.write(commit_header + deletions)
+
+            for note_path, size, fh in _archive_members(upload, fmt):
+                if may_write is not None and not may_write(note_path):
+                    skipped += 1
+                    continue
+                if size > settings.MAX_NOTE_BYTES:
+                    raise LogicalError(f"{note_path} exceeds {settings.MAX_NOTE_BYTES} bytes")
+                if threshold and size > threshold:
+                    store = LargeObjectStore(git)
+                    tmp_file, oid, size = store.spool(fh)
+                    store.add(tmp_file, oid)
+                    pointer = make_pointer(oid, size)
+                    proc.stdin.write(f"M 100644 inline {note_path}\ndata {len(pointer)}\n".encode())
+                    proc.stdin.write(pointer)
+                else:
+                    proc.stdin.write(f"M 100644 inline {note_path}\ndata {size}\n".encode())
+                    shutil.copyfileobj(fh, proc.stdin, CHUNK_SIZE)
+                proc.stdin.write(b"\n")
+                imported += 1
+
+            proc.stdin.write(b"done\n")
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass  # fast-import died, its stderr explains why
+        except BaseException as e:
+            proc.kill()  # without "done" fast-import leaves branch_name alone
+            proc.wait()
+            if isinstance(e, (tarfile.TarError, zipfile.BadZipFile, EOFError)):
+                raise LogicalError(f"malformed {fmt} archive - {e}")
+            raise
+
+        stderr = proc.stderr.read()
+        if proc.wait() != 0:
+            raise LogicalError(f"import into {branch_name} failed - {stderr.decode(errors='replace')}")
+
+    return head, git.get_commit_id(branch_name), imported, skipped
+
+
+def _archive_members(upload: IO[bytes], fmt: str) -> Iterator[tuple[str, int, IO[bytes]]]:
+    if fmt == "zip":
+        with zipfile.ZipFile(upload) as archive:
+            for info in archive.infolist():
+                note_path = _member_note_path(info.filename)
+                if info.is_dir() or note_path is None:
+                    continue
+                with archive.open(info) as fh:
+                    yield note_path, info.file_size, fh
+        return
+
+    with tarfile.open(fileobj=upload, mode="r|*") as archive:
+        for member in archive:
+            note_path = _member_note_path(member.name)
+            if not member.isfile() or note_path is None:
+                continue
+            yield note_path, member.size, archive.extractfile(member)
+
+
+def _member_note_path(name: str) -> str | None:
+    """Normalized note path of an archive member, None for paths we refuse to import."""
+    # Imported here, the serializers import ARCHIVE_FORMATS from this module.
+    from .serializers import MAX_PATH_LENGTH, normalize_note_path
+
+    try:
+        note_path = normalize_note_path(name.lstrip("/"))
+    except ValueError:
+        return None
+    # A leading quote would make fast-import parse the path as a C-style string.
+    if not note_path or len(note_path) > MAX_PATH_LENGTH or note_path.startswith('"'):
+        return None
+    return note_path
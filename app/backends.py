@@ -0,0 +1,194 @@
+"""Storage backends of the note services.
+
+The read and compare-and-swap paths of app.services go through a
+`StorageBackend` instead of GitCommander directly, so the service logic
+can run against:
+
+    git     - the git CLI through GitCommander (default),
+    memory  - a pure-Python object store, for profiling the service layer
+              without any git at all.
+
+Without a worktree, creates, deletes and updates are committed on
+MAIN_BRANCH HEAD with a compare-and-swap; whatever needs a branch and
+merge (conflicting writes, conflict resolution) needs a git repository
+with a worktree and uses GitCommander directly.
+
+Typical usage example:
+    backend = get_backend(repo_path)
+    note = backend.read_blob("notes/a.md", "master")
+"""
+
+import hashlib
+import os
+import threading
+from typing import Protocol
+
+from .utils import GitCommander, get_batch_reader
+from .exceptions import LogicalError
+from config import settings
+
+
+class StorageBackend(Protocol):
+    repo_path: str
+    # False when the backend has no git repository behind it, which rules
+    # out worktree syncing, search indexing and branch-and-merge flows.
+    has_worktree: bool
+
+    def resolve_ref(self, rev: str) -> str | None:
+        """Commit id of a branch name or commit id, None if it does not exist."""
+
+    def read_blob(self, note_path: str, rev: str) -> bytes:
+        """Note content at rev; raises LogicalError if the note does not exist."""
+
+    def blob_id(self, note_path: str, rev: str) -> str | None:
+        """Object id of the note at rev, None if it does not exist there."""
+
+    def list_tree(self, rev: str) -> list[str]:
+        """All note paths at rev."""
+
+    def write_commit(self, parent: str, changes: dict[str, bytes | None], msg: str) -> str:
+        """Creates a commit on top of parent without moving any ref.
+
+        changes maps note paths to their new content, or None to delete them.
+        """
+
+    def cas_ref(self, branch_name: str, new_commit: str, old_commit: str) -> bool:
+        """Moves a branch from old_commit to new_commit, False if it moved meanwhile."""
+
+
+class GitCliBackend:
+    has_worktree = True
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        self.git = GitCommander(repo_path)
+
+    def resolve_ref(self, rev: str) -> str | None:
+        info = get_batch_reader(self.repo_path).resolve(f"{rev}^{{commit}}")
+        return info[0] if info is not None else None
+
+    def read_blob(self, note_path: str, rev: str) -> bytes:
+        return self.git.read_blob(note_path, rev)
+
+    def blob_id(self, note_path: str, rev: str) -> str | None:
+        return self.git.get_blob_id(note_path, rev)
+
+    def list_tree(self, rev: str) -> list[str]:
+        return self.git.list_files(rev)
+
+    def write_commit(self, parent: str, changes: dict[str, bytes | None], msg: str) -> str:
+        blob_ids = {
+            path: self.git.hash_object(data) if data is not None else None
+            for path, data in changes.items()
+        }
+        return self.git.write_tree_commit(parent, blob_ids, msg=msg)
+
+    def cas_ref(self, branch_name: str, new_commit: str, old_commit: str) -> bool:
+        return self.git.update_ref(branch_name, new_commit, old_commit)
+
+
+class _MemoryRepo:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs: dict[str, bytes] = {}
+        self.trees: dict[str, dict[str, str]] = {}  # commit id -> note path -> blob id
+        self.refs: dict[str, str] = {}
+
+
+_memory_repos: dict[str, _MemoryRepo] = {}
+_memory_repos_lock = threading.Lock()
+
+
+class MemoryBackend:
+    """Object store kept in process memory, one per repo_path.
+
+    A new repository starts with MAIN_BRANCH pointing at an empty commit.
+    Object ids are computed like git's, so they look alike in responses.
+    """
+
+    has_worktree = False
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        key = os.path.abspath(repo_path or os.curdir)
+        with _memory_repos_lock:
+            repo = _memory_repos.get(key)
+            if repo is None:
+                repo = _memory_repos[key] = _MemoryRepo()
+                root = _object_id(b"commit", b"root")
+                repo.trees[root] = {}
+                repo.refs[settings.MAIN_BRANCH] = root
+        self.repo = repo
+
+    def resolve_ref(self, rev: str) -> str | None:
+        with self.repo.lock:
+            return self._resolve(rev)
+
+    def _resolve(self, rev: str) -> str | None:
+        if rev in self.repo.refs:
+            return self.repo.refs[rev]
+        return rev if rev in self.repo.trees else None
+
+    def _tree(self, rev: str) -> dict[str, str] | None:
+        commit_id = self._resolve(rev)
+        return self.repo.trees[commit_id] if commit_id is not None else None
+
+    def read_blob(self, note_path: str, rev: str) -> bytes:
+        with self.repo.lock:
+            tree = self._tree(rev)
+            blob_id = tree.get(note_path) if tree is not None else None
+            if blob_id is None:
+                raise LogicalError(f"note does not exist - {rev}:{note_path}")
+            return self.repo.blobs[blob_id]
+
+    def blob_id(self, note_path: str, rev: str) -> str | None:
+        with self.repo.lock:
+            tree = self._tree(rev)
+            return tree.get(note_path) if tree is not None else None
+
+    def list_tree(self, rev: str) -> list[str]:
+        with self.repo.lock:
+            tree = self._tree(rev)
+            if tree is None:
+                raise LogicalError(f"not a valid tree - {rev}")
+            return sorted(tree)
+
+    def write_commit(self, parent: str, changes: dict[str, bytes | None], msg: str) -> str:
+        with self.repo.lock:
+            if parent not in self.repo.trees:
+                raise LogicalError(f"not a valid commit - {parent}")
+            tree = dict(self.repo.trees[parent])
+            for path, data in changes.items():
+                if data is None:
+                    tree.pop(path, None)
+                    continue
+                blob_id = _object_id(b"blob", data)
+                self.repo.blobs[blob_id] = data
+                tree[path] = blob_id
+
+            listing = "".join(f"{path}\0{oid}\n" for path, oid in sorted(tree.items()))
+            commit_id = _object_id(b"commit", f"{parent}\n{msg}\n{listing}".encode())
+            self.repo.trees[commit_id] = tree
+            return commit_id
+
+    def cas_ref(self, branch_name: str, new_commit: str, old_commit: str) -> bool:
+        with self.repo.lock:
+            if self.repo.refs.get(branch_name) != old_commit:
+                return False
+            self.repo.refs[branch_name] = new_commit
+            return True
+
+
+def _object_id(kind: bytes, data: bytes) -> str:
+    return hashlib.sha1(kind + b" %d\0" % len(data) + data).hexdigest()
+
+
+BACKENDS = {
+    "git": GitCliBackend,
+    "memory": MemoryBackend,
+}
+
+
+def get_backend(repo_path: str) -> StorageBackend:
+    """Backend of repo_path selected by settings.STORAGE_BACKEND."""
+    return BACKENDS[settings.STORAGE_BACKEND](repo_path)
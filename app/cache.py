@@ -0,0 +1,65 @@
+"""Caches for git data.
+
+Objects and history pages are keyed by git object ids, so entries never
+go stale and the caches need no invalidation, only eviction. Branches are
+not cached: GitCommander.get_commit_id reads their ref files directly. With SHARED_CACHE_PATH set all caches live in
+one segment shared by the workers of a node, otherwise each process keeps
+its own LRU caches.
+"""
+
+import threading
+from collections import OrderedDict
+
+from app import metrics
+from config import settings
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes: int, name: str = "cache"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._data: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                metrics.inc(f"{self.name}_miss")
+                return None
+            self._data.move_to_end(key)
+        metrics.inc(f"{self.name}_hit")
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._data[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+
+if settings.SHARED_CACHE_PATH:
+    from app.shmcache import SharedCache
+
+    blob_cache = tree_cache = history_cache = SharedCache(
+        settings.SHARED_CACHE_PATH, settings.SHARED_CACHE_BYTES
+    )
+else:
+    blob_cache = LRUCache(settings.BLOB_CACHE_BYTES, name="blob_cache")
+    tree_cache = LRUCache(settings.TREE_CACHE_BYTES, name="tree_cache")
+    history_cache = LRUCache(settings.HISTORY_CACHE_BYTES, name="history_cache")
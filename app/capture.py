@@ -0,0 +1,176 @@
+"""Capture of sanitized API traffic for offline replay.
+
+With CAPTURE_PATH set, every request (a CAPTURE_SAMPLE_RATE share of
+them) is appended to a compact binary log: a fixed struct header with the
+timestamp, duration, status, method and body sizes, followed by a small
+JSON payload with the endpoint and the parameters that shape the git and
+cache work.
+
+Query strings are captured as sent; JSON bodies as validated by their
+endpoint, which leaves the model in the CAPTURED_INPUT environ key.
+Only parameters in CAPTURED_PARAMS are kept: repositories, note paths,
+branches, commits and paging. Note contents are reduced to their size and
+search queries to their length; users are kept as HMAC pseudonyms when
+CAPTURE_SALT is set and dropped otherwise. Admin endpoints are never
+captured.
+
+All workers append to one file with O_APPEND, one write per record, so
+records of different workers never interleave. Replay with app.replay.
+
+Typical usage example:
+    for record in read_capture(path):
+        print(record.method, record.path, record.duration)
+"""
+
+import dataclasses
+import hashlib
+import hmac
+import json
+import os
+import struct
+import threading
+from typing import IO, Iterator
+
+from app import metrics
+from config import settings
+
+MAGIC = b"WNCAP1\n"
+# timestamp, duration, status, method, request body bytes, response bytes, payload length
+RECORD = struct.Struct("<dfHBIIH")
+METHODS = ("GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS")
+MAX_SIZE = 2 ** 32 - 1
+MAX_PAYLOAD = 2 ** 16 - 1
+
+CAPTURED_PARAMS = {
+    "repo_name", "repo_path", "note_path", "branch_name", "commit_id", "cursor", "limit",
+    "depth", "path", "from", "to", "patch", "format", "replace", "seq",
+}
+# Parameters whose value is replaced by its size.
+SIZED_PARAMS = {"note_value", "q"}
+# WSGI environ key of the validated JSON body of a request.
+CAPTURED_INPUT = "wenote.captured_input"
+
+
+@dataclasses.dataclass(frozen=True)
+class CaptureRecord:
+    timestamp: float
+    duration: float
+    status: int
+    method: str
+    path: str
+    params: dict
+    request_bytes: int
+    response_bytes: int
+    user: str | None = None
+
+
+def sanitize(params: dict) -> dict:
+    """Captured form of query or JSON body parameters."""
+    sanitized = {}
+    for key, value in params.items():
+        if key in CAPTURED_PARAMS and isinstance(value, (str, int, float, bool)):
+            sanitized[key] = value
+        elif key in SIZED_PARAMS and isinstance(value, str):
+            sanitized[f"{key}_size"] = len(value.encode())
+    return sanitized
+
+
+def pseudonym(user: str | None) -> str | None:
+    if user is None or not settings.CAPTURE_SALT:
+        return None
+    return hmac.new(settings.CAPTURE_SALT.encode(), user.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def encode(record: CaptureRecord) -> bytes:
+    data = {"p": record.path, "a": record.params}
+    if record.user is not None:
+        data["u"] = record.user
+    payload = json.dumps(data, separators=(",", ":")).encode()
+    if len(payload) > MAX_PAYLOAD:
+        payload = json.dumps({"p": record.path, "a": {}}, separators=(",", ":")).encode()
+    method = METHODS.index(record.method) if record.method in METHODS else 0xFF
+    return RECORD.pack(record.timestamp, record.duration, min(record.status, 0xFFFF), method,
+                       min(record.request_bytes, MAX_SIZE), min(record.response_bytes, MAX_SIZE),
+                       len(payload)) + payload
+
+
+def decode(fh: IO[bytes]) -> Iterator[CaptureRecord]:
+    """Records of an open capture, positioned after MAGIC; a torn last record is skipped."""
+    while True:
+        header = fh.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        (timestamp, duration, status, method,
+         request_bytes, response_bytes, length) = RECORD.unpack(header)
+        payload = fh.read(length)
+        if len(payload) < length:
+            return
+        data = json.loads(payload)
+        yield CaptureRecord(
+            timestamp=timestamp,
+            duration=duration,
+            status=status,
+            method=METHODS[method] if method < len(METHODS) else "?",
+            path=data["p"],
+            params=data["a"],
+            request_bytes=request_bytes,
+            response_bytes=response_bytes,
+            user=data.get("u"),
+        )
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    with open(path, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"not a wenote capture - {path}")
+        yield from decode(fh)
+
+
+class CaptureWriter:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._fd: int | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> int:
+        if self._fd is None or self._pid != os.getpid():  # reopened after a fork
+            if not os.path.exists(self.path):
+                self._create()
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _create(self) -> None:
+        """Creates the capture with its header in place, whichever worker gets there first."""
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as fh:
+            os.fchmod(fh.fileno(), 0o600)
+            fh.write(MAGIC)
+        try:
+            os.link(tmp_file, self.path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_file)
+
+    def write(self, record: CaptureRecord) -> None:
+        data = encode(record)
+        with self._lock:
+            fd = self._open()
+            if os.fstat(fd).st_size + len(data) > self.max_bytes:
+                metrics.inc("capture_full")
+                return
+            os.write(fd, data)
+        metrics.inc("capture_records")
+
+
+_writer: CaptureWriter | None = None
+
+
+def get_writer() -> CaptureWriter:
+    global _writer
+    if _writer is None or _writer.path != settings.CAPTURE_PATH:
+        _writer = CaptureWriter(settings.CAPTURE_PATH, settings.CAPTURE_MAX_BYTES)
+    return _writer
@@ -0,0 +1,90 @@
+"""Conflict sessions of notes being resolved on user branches.
+
+A session is opened when merging MAIN_BRANCH into a user branch conflicts.
+It records the blobs the conflict was made of and the MAIN_BRANCH commit
+that was merged, so later resolution rounds only need to look at what
+MAIN_BRANCH changed after that commit. Sessions are stored as one JSON
+file per branch in the repository's git directory.
+
+Typical usage example:
+    sessions = ConflictSessions(git)
+    session = sessions.get(branch_name)
+"""
+
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from urllib.parse import quote, unquote
+
+from .utils import GitCommander
+
+SESSIONS_DIR = "wenote-conflicts"
+
+
+@dataclass
+class ConflictSession:
+    note_path: str
+    branch_name: str
+    base_id: str | None
+    ours_id: str | None
+    theirs_id: str | None
+    main_commit: str
+    created_at: float = field(default_factory=time.time)
+    rounds: int = 1
+
+
+class ConflictSessions:
+    def __init__(self, git: GitCommander):
+        self.git = git
+        self.path = os.path.join(git.get_git_dir(), SESSIONS_DIR)
+
+    def _file(self, branch_name: str) -> str:
+        return os.path.join(self.path, quote(branch_name, safe="") + ".json")
+
+    def open(self, note_path: str, branch_name: str, main_branch: str) -> ConflictSession:
+        """Records a session for a merge of main_branch into branch_name that
+        is in progress (MERGE_HEAD still set)."""
+        main_commit = self.git.get_commit_id(main_branch)
+        base = self.git.merge_base(branch_name, main_commit)
+        session = ConflictSession(
+            note_path=note_path,
+            branch_name=branch_name,
+            base_id=self.git.get_blob_id(note_path, base) if base else None,
+            ours_id=self.git.get_blob_id(note_path, branch_name),
+            theirs_id=self.git.get_blob_id(note_path, main_commit),
+            main_commit=main_commit,
+        )
+        self.save(session)
+        return session
+
+    def save(self, session: ConflictSession) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        tmp_file = self._file(session.branch_name) + ".tmp"
+        with open(tmp_file, "w") as fh:
+            json.dump(asdict(session), fh)
+        os.replace(tmp_file, self._file(session.branch_name))
+
+    def get(self, branch_name: str) -> ConflictSession | None:
+        try:
+            with open(self._file(branch_name)) as fh:
+                return ConflictSession(**json.load(fh))
+        except FileNotFoundError:
+            return None
+
+    def close(self, branch_name: str) -> None:
+        try:
+            os.remove(self._file(branch_name))
+        except FileNotFoundError:
+            pass
+
+    def list(self) -> list[ConflictSession]:
+        if not os.path.isdir(self.path):
+            return []
+        sessions = []
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".json"):
+                session = self.get(unquote(name[:-len(".json")]))
+                if session is not None:
+                    sessions.append(session)
+        return sessions
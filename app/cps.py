@@ -1,5 +1,8 @@
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 conflict_marker_sep = "="*7
 conflict_marker_begin = "<"*7
 conflict_marker_end = ">"*7
@@ -31,7 +34,7 @@ def mask_conflicts(repo_path: str, file_path: str):
 
     search_for = is_begin
 
-    print(repo_path, file_path)
+    logger.debug("masking conflicts of %s in %s", file_path, repo_path)
     with open(os.path.join(repo_path, file_path), "r") as f:
         file_value = f.readlines()
 
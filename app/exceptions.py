@@ -13,3 +13,23 @@ class LogicalError(Exception):
     def __str__(self):
         return self.msg
 
+
+class GitError(LogicalError):
+    """A git command exited with an unexpected exit code."""
+
+    def __init__(self, args: list, returncode: int, stderr: bytes):
+        self.command = args
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(
+            f"`{' '.join(args[:2])}` exited with {returncode}: "
+            f"{stderr.decode(errors='replace').strip()}"
+        )
+
+
+class GitTimeoutError(GitError):
+    """A git command ran longer than its timeout and was killed."""
+
+
+class GitBusyError(LogicalError):
+    """No git process slot became free within the acquire timeout."""
@@ -0,0 +1,136 @@
+"""Central execution of git subprocesses.
+
+Every git command of GitCommander runs through the module level
+`executor`, which caps the number of simultaneous git processes of the
+node, globally and per repository, applies per-command timeouts and
+passes a pre-built environment.
+
+The caps are flock slots in GIT_LOCK_DIR (see app.slots), so they bind
+across all worker processes. Streaming processes hold a slot from start to
+exit, and the persistent `cat-file` processes of BatchReader hold one
+while they answer a request.
+
+Typical usage example:
+    output = executor.run(["git", "rev-parse", "HEAD"], cwd=repo_path)
+"""
+
+import hashlib
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from app import metrics
+from app.exceptions import GitBusyError, GitTimeoutError
+from app.logs import record_git_command
+from app.slots import SlotPool
+from config import settings
+
+# Commands that may walk the whole history or rewrite many files.
+SLOW_COMMANDS = {"archive", "blame", "commit-graph", "fast-import", "gc", "log", "merge",
+                 "read-tree"}
+
+
+def _build_env() -> dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "LC_ALL": "C",  # stable, parseable messages
+        "GIT_TERMINAL_PROMPT": "0",
+        "GIT_PAGER": "cat",
+        "GIT_EDITOR": ":",
+        "GIT_MERGE_AUTOEDIT": "no",
+    })
+    return env
+
+
+class GitExecutor:
+    def __init__(self, max_procs: int, max_procs_per_repo: int, acquire_timeout: float,
+                 lock_dir: str):
+        self.max_procs_per_repo = max_procs_per_repo
+        self.acquire_timeout = acquire_timeout
+        self.lock_dir = lock_dir
+        self.env = _build_env()
+        self._global = SlotPool(lock_dir, "git", max_procs)
+        self._per_repo: dict[str, SlotPool] = {}
+        self._lock = threading.Lock()
+        self._created = False
+
+    def _repo_pool(self, cwd: str | None) -> SlotPool:
+        key = os.path.abspath(cwd or os.curdir)
+        with self._lock:
+            if not self._created:
+                os.makedirs(self.lock_dir, exist_ok=True)
+                self._created = True
+            pool = self._per_repo.get(key)
+            if pool is None:
+                digest = hashlib.sha1(key.encode()).hexdigest()
+                pool = self._per_repo[key] = SlotPool(self.lock_dir, f"git-{digest[:16]}",
+                                                      self.max_procs_per_repo)
+            return pool
+
+    @contextmanager
+    def slot(self, cwd: str | None) -> Iterator[None]:
+        """Holds one global and one per-repo process slot, shared by all workers.
+
+        Raises:
+            GitBusyError: No slot was freed within the acquire timeout.
+        """
+        repo_pool = self._repo_pool(cwd)
+        deadline = time.monotonic() + self.acquire_timeout
+        global_fd = self._global.acquire(deadline)
+        if global_fd is None:
+            metrics.inc("git_busy")
+            raise GitBusyError("too many concurrent git processes")
+        try:
+            repo_fd = repo_pool.acquire(deadline)
+            if repo_fd is None:
+                metrics.inc("git_busy")
+                raise GitBusyError(f"too many concurrent git processes for {cwd}")
+            try:
+                yield
+            finally:
+                SlotPool.release(repo_fd)
+        finally:
+            SlotPool.release(global_fd)
+
+    def timeout_for(self, args: list[str]) -> float:
+        if len(args) > 1 and args[1] in SLOW_COMMANDS:
+            return settings.GIT_SLOW_TIMEOUT
+        return settings.GIT_TIMEOUT
+
+    def run(self, args: list[str], cwd: str | None, input: bytes | None = None,
+            env: dict[str, str] | None = None,
+            timeout: float | None = None) -> subprocess.CompletedProcess:
+        """Runs a git command to completion, capturing its output.
+
+        Raises:
+            GitBusyError: No process slot became free in time.
+            GitTimeoutError: The command was killed after its timeout.
+        """
+        timeout = timeout or self.timeout_for(args)
+        with self.slot(cwd):
+            started = time.perf_counter()
+            try:
+                return subprocess.run(
+                    args,
+                    input=input,
+                    capture_output=True,
+                    cwd=cwd,
+                    env={**self.env, **env} if env else self.env,
+                    timeout=timeout,
+                )
+            except subprocess.TimeoutExpired as e:
+                metrics.inc("git_timeout")
+                raise GitTimeoutError(args, -1, (e.stderr or b"") + f"timed out after {timeout}s".encode())
+            finally:
+                record_git_command(args, time.perf_counter() - started)
+
+    def popen(self, args: list[str], cwd: str | None, **kwargs) -> subprocess.Popen:
+        """Starts a streaming git process; callers hold a slot() while it works."""
+        return subprocess.Popen(args, cwd=cwd, env=self.env, **kwargs)
+
+
+executor = GitExecutor(settings.GIT_MAX_PROCS, settings.GIT_MAX_PROCS_PER_REPO,
+                       settings.GIT_ACQUIRE_TIMEOUT, settings.GIT_LOCK_DIR)
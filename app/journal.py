@@ -0,0 +1,360 @@
+"""Write-ahead journal of note mutations.
+
+With JOURNAL_WRITES enabled, create/update/delete requests are appended
+to an fsync'd journal in the repository's git directory and acknowledged
+right away. A background thread of each worker applies journaled entries
+to git in journal order; the apply lock makes sure only one process
+applies at a time.
+
+An entry's sequence number is its absolute byte offset in the journal, so
+the state file only has to remember how far the journal was applied. The
+entry being applied is recorded there too: if a worker dies half way
+through it, the next replay cleans up the worktree and the entry's scratch
+branch and applies it again. Once fully applied, the journal continues in
+a new file named after its starting offset.
+
+Handlers return the outcome of an entry as a status and a commit id.
+Only those are recorded, with the note path to check access against:
+results are readable by anyone who knows a sequence number, so they never
+hold note contents.
+
+A line that cannot be parsed as an entry (a write torn by a crash, a
+damaged disk block) is copied to the quarantine file and recorded as
+failed, so the entries behind it still apply. Writes that bypass the
+journal apply what is pending first when pending() says so; from there on
+they only take the worktree locks the services take for journaled writes
+too, so they do not queue behind the applier.
+
+Repositories register in JOURNAL_REGISTRY_DIR on their first journaled
+write, so startup can finish the journals of all of them, whichever
+repositories the requests named.
+
+Typical usage example:
+    seq = get_journal(repo_path, handlers).append("create", {"note_path": ...})
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterator
+
+from app import metrics
+from app.conflicts import ConflictSessions
+from app.exceptions import LogicalError
+from app.utils import GitCommander
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIR = "wenote-journal"
+# What an entry's result may show, results of older versions included.
+RESULT_FIELDS = ("seq", "status", "note_path", "commit_id", "error")
+
+# Applies an entry's args, returning its status and the commit id it led to.
+Handler = Callable[..., tuple[str, str | None]]
+
+
+class Journal:
+    def __init__(self, repo_path: str, handlers: dict[str, Handler]):
+        self.repo_path = repo_path
+        self.handlers = handlers
+        self.git = GitCommander(repo_path)
+        self.path = os.path.join(self.git.get_git_dir(), JOURNAL_DIR)
+        os.makedirs(self.path, exist_ok=True)
+        self.results_file = os.path.join(self.path, "results.log")
+        self.state_file = os.path.join(self.path, "state.json")
+        self.lock_file = os.path.join(self.path, "apply.lock")
+        self.append_lock_file = os.path.join(self.path, "append.lock")
+        self.quarantine_file = os.path.join(self.path, "quarantine.log")
+        self._registered = False
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self._start_lock = threading.Lock()
+
+    def append(self, op: str, args: dict) -> int:
+        """Durably records a mutation and returns its sequence number."""
+        if op not in self.handlers:
+            raise LogicalError(f"unknown journal operation - {op}")
+        line = json.dumps({"op": op, "args": args, "ts": time.time()}).encode() + b"\n"
+        self._register()
+
+        with open(self.append_lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            base = self._state()["base"]
+            with open(self._journal_file(base), "ab") as fh:
+                seq = base + fh.seek(0, os.SEEK_END)
+                fh.write(line)
+                fh.flush()
+                os.fsync(fh.fileno())
+
+        metrics.inc("journal_appended")
+        self.kick()
+        return seq
+
+    def kick(self) -> None:
+        """Wakes the applier thread of this worker, starting it if needed."""
+        with self._start_lock:
+            if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._wakeup = threading.Event()
+                self._thread = threading.Thread(target=self._run, name="journal-applier",
+                                                daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while os.path.isdir(self.path):  # stops when the repository is removed
+            self._wakeup.wait(settings.JOURNAL_POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.apply_pending()
+            except Exception:
+                logger.exception("applying the journal of %s failed", self.repo_path)
+
+    def apply_pending(self) -> int:
+        """Applies all complete, not yet applied entries in order.
+
+        Returns:
+            number of applied entries.
+        """
+        with self._apply_lock():
+            return self._apply_locked()
+
+    def pending(self) -> bool:
+        """Whether entries are appended but not yet (fully) applied."""
+        state = self._state()
+        return state["base"] + self._journal_size(state["base"]) > state["applied"]
+
+    @contextlib.contextmanager
+    def _apply_lock(self) -> Iterator[None]:
+        with open(self.lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _apply_locked(self) -> int:
+        applied = 0
+        state = self._state()
+        if state["applying"] is not None:
+            self._recover(state)
+
+        for seq, entry in self._entries(state, state["applied"]):
+            state["applying"] = seq
+            self._save_state(state)
+            if "_corrupt" in entry:
+                self._quarantine(seq, entry["_corrupt"])
+            else:
+                self._record(seq, entry["args"].get("note_path"), *self._apply(entry))
+                applied += 1
+            state["applied"] = seq + entry["_length"]
+            state["applying"] = None
+            self._save_state(state)
+
+        self._compact(state)
+        if applied:
+            metrics.inc("journal_applied", applied)
+        return applied
+
+    def _apply(self, entry: dict) -> tuple[str, str | None, str | None]:
+        """Status, commit id and error message of an entry."""
+        try:
+            status, commit_id = self.handlers[entry["op"]](self.repo_path, **entry["args"])
+        except LogicalError as e:
+            logger.warning("journaled %s failed: %s", entry["op"], e)
+            return "error", None, str(e)
+        except Exception:  # recorded like any other failure, later entries still apply
+            logger.exception("journaled %s failed", entry["op"])
+            return "error", None, "internal error"
+        return status, commit_id, None
+
+    def _recover(self, state: dict) -> None:
+        """Undoes what a crashed apply of the entry at state["applying"] left behind."""
+        metrics.inc("journal_recovered")
+        logger.warning("recovering interrupted journal entry %s of %s", state["applying"],
+                       self.repo_path)
+        with self.git.worktree_lock():
+            self.git.abort_merge()
+            self.git.reset_worktree()
+            if self.git.get_current_branch() != settings.MAIN_BRANCH:
+                self.git.checkout_branch(settings.MAIN_BRANCH)
+
+        _, entry = next(self._entries(state, state["applying"]), (None, None))
+        if entry is not None and "_corrupt" in entry:
+            entry = None
+        user = entry["args"].get("user") if entry is not None else None
+        if settings.USER_WORKTREES and user:  # let go of the scratch branch
+            worktree = self.git.switch_user(user, settings.MAIN_BRANCH)
+            with worktree.worktree_lock():
+                worktree.abort_merge()
+                worktree.detach(settings.MAIN_BRANCH, force=True)
+        scratch_branch = _scratch_branch(entry) if entry is not None else None
+        # A scratch branch with an open conflict session is a result, not debris.
+        if (scratch_branch and self.git.branch_exists(scratch_branch)
+                and ConflictSessions(self.git).get(scratch_branch) is None):
+            self.git.delete_branch(scratch_branch, force=True)
+
+    def _journal_file(self, base: int) -> str:
+        return os.path.join(self.path, f"journal-{base}.log")
+
+    def _entries(self, state: dict, seq: int):
+        """Complete entries from seq on; a torn last line is left for later.
+
+        Lines that are not valid entries come with the line in "_corrupt".
+        """
+        try:
+            fh = open(self._journal_file(state["base"]), "rb")
+        except FileNotFoundError:
+            return
+        with fh:
+            fh.seek(seq - state["base"])
+            for line in fh:
+                if not line.endswith(b"\n"):
+                    return
+                entry = self._parse(line)
+                entry["_length"] = len(line)
+                yield seq, entry
+                seq += len(line)
+
+    def _parse(self, line: bytes) -> dict:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return {"_corrupt": line}
+        if (not isinstance(entry, dict) or entry.get("op") not in self.handlers
+                or not isinstance(entry.get("args"), dict)):
+            return {"_corrupt": line}
+        return entry
+
+    def _quarantine(self, seq: int, line: bytes) -> None:
+        metrics.inc("journal_quarantined")
+        logger.error("quarantined corrupt journal entry %s of %s", seq, self.repo_path)
+        with open(self.quarantine_file, "a") as fh:
+            fh.write(json.dumps({"seq": seq, "line": line.decode(errors="backslashreplace")}) + "\n")
+        self._record(seq, None, "error", None, "corrupt journal entry, see quarantine.log")
+
+    def _register(self) -> None:
+        """Lists the repository in JOURNAL_REGISTRY_DIR for the replay at startup."""
+        if self._registered:
+            return
+        repo_path = os.path.abspath(self.repo_path or os.curdir)
+        path = os.path.join(settings.JOURNAL_REGISTRY_DIR,
+                            hashlib.sha1(repo_path.encode()).hexdigest())
+        if not os.path.exists(path):
+            os.makedirs(settings.JOURNAL_REGISTRY_DIR, exist_ok=True)
+            with open(f"{path}.{os.getpid()}.tmp", "w") as fh:
+                json.dump({"repo_path": repo_path, "journal": self.path}, fh)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        self._registered = True
+
+    def _record(self, seq: int, note_path: str | None, status: str, commit_id: str | None,
+                error: str | None) -> None:
+        result = {"seq": seq, "status": status, "note_path": note_path, "commit_id": commit_id}
+        if error is not None:
+            result["error"] = error
+        with open(self.results_file, "a") as fh:
+            fh.write(json.dumps(result) + "\n")
+
+    def _compact(self, state: dict) -> None:
+        """Starts a new journal file once everything in the current one is applied."""
+        with open(self.append_lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            old_base = state["base"]
+            size = self._journal_size(old_base)
+            # Keeps recent results around until the journal is worth compacting.
+            if size < settings.JOURNAL_COMPACT_BYTES or old_base + size != state["applied"]:
+                return
+            state["base"] = state["applied"]
+            self._save_state(state)
+        os.truncate(self.results_file, 0)
+        os.remove(self._journal_file(old_base))
+
+    def _journal_size(self, base: int) -> int:
+        try:
+            return os.path.getsize(self._journal_file(base))
+        except FileNotFoundError:
+            return 0
+
+    def _state(self) -> dict:
+        try:
+            with open(self.state_file) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {"base": 0, "applied": 0, "applying": None}
+
+    def _save_state(self, state: dict) -> None:
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as fh:
+            json.dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_file, self.state_file)
+
+    def status(self, seq: int | None = None) -> dict:
+        state = self._state()
+        end = state["base"] + self._journal_size(state["base"])
+        data = {"applied": state["applied"], "end": end, "pending": end > state["applied"]}
+        if seq is not None:
+            data["entry"] = self._result(seq, state)
+        return data
+
+    def _result(self, seq: int, state: dict) -> dict:
+        if seq >= state["applied"]:
+            return {"seq": seq, "status": "pending"}
+        try:
+            with open(self.results_file) as fh:
+                for line in fh:
+                    result = json.loads(line)
+                    if result["seq"] == seq:
+                        return {key: result[key] for key in RESULT_FIELDS if key in result}
+        except FileNotFoundError:
+            pass
+        return {"seq": seq, "status": "applied"}  # result already compacted away
+
+
+def journaled_repos() -> list[str]:
+    """Repositories registered by a journaled write whose journal still exists."""
+    try:
+        names = os.listdir(settings.JOURNAL_REGISTRY_DIR)
+    except FileNotFoundError:
+        return []
+    repos = []
+    for name in names:
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(settings.JOURNAL_REGISTRY_DIR, name)
+        try:
+            with open(path) as fh:
+                registered = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        if os.path.isdir(registered["journal"]):  # else the repository is gone
+            repos.append(registered["repo_path"])
+    return sorted(repos)
+
+
+def _scratch_branch(entry: dict) -> str | None:
+    """Branch the services create for an entry, see app.services."""
+    note_path = entry["args"].get("note_path")
+    if entry["op"] == "delete":
+        return f"user-delete-{note_path}"
+    if entry["op"] == "update" and entry["args"].get("branch_name") == f"user-{note_path}":
+        return None  # resolving on an existing conflict branch
+    return f"user-{note_path}"
+
+
+_journals: dict[str, Journal] = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(repo_path: str, handlers: dict[str, Handler]) -> Journal:
+    key = os.path.abspath(repo_path or os.curdir)
+    with _journals_lock:
+        journal = _journals.get(key)
+        if journal is None:
+            journal = _journals[key] = Journal(repo_path, handlers)
+        return journal
@@ -0,0 +1,164 @@
+"""Large notes: streamed blobs and a local content-addressed store.
+
+Notes are streamed into and out of git in chunks instead of being loaded
+whole. Uploads are spooled to a file next to the store first, so slow
+clients never hold a git process slot; git only reads the finished file.
+Uploads above LFS_THRESHOLD_BYTES are not stored in git at all:
+their content goes into a content-addressed store next to the repository
+and git only keeps a small git-lfs style pointer, so large attachments do
+not bloat packfiles or the blob caches.
+
+Typical usage example:
+    blob_id, size, large = store_note(git, request.stream)
+"""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from contextlib import ExitStack
+from typing import IO, Iterator
+
+from .utils import GitCommander
+from .executor import executor
+from .exceptions import LogicalError
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Blobs up to this size are read whole through the batch reader and blob cache.
+STREAM_BLOB_BYTES = 1024 * 1024
+POINTER_MAX_BYTES = 200
+POINTER_RE = re.compile(
+    rb"version https://git-lfs\.github\.com/spec/v1\noid sha256:([0-9a-f]{64})\nsize (\d+)\n"
+)
+
+
+def make_pointer(oid: str, size: int) -> bytes:
+    return f"version https://git-lfs.github.com/spec/v1\noid sha256:{oid}\nsize {size}\n".encode()
+
+
+def parse_pointer(data: bytes) -> tuple[str, int] | None:
+    """(oid, size) of a pointer blob, None for regular note content."""
+    if len(data) > POINTER_MAX_BYTES:
+        return None
+    match = POINTER_RE.fullmatch(data)
+    if match is None:
+        return None
+    return match.group(1).decode(), int(match.group(2))
+
+
+class LargeObjectStore:
+    def __init__(self, git: GitCommander):
+        self.path = settings.LFS_STORE_PATH or os.path.join(git.get_git_dir(), "wenote-lfs")
+
+    def _file(self, oid: str) -> str:
+        return os.path.join(self.path, oid[:2], oid[2:4], oid)
+
+    def spool(self, stream: IO[bytes]) -> tuple[str, str, int]:
+        """Writes stream to a new file in the store, hashing it as it arrives.
+
+        Returns:
+            path of the file, which the caller add()s or removes, its sha256 and size.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_file = tempfile.mkstemp(prefix="incoming-", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                while chunk := stream.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    fh.write(chunk)
+                    size += len(chunk)
+                fh.flush()
+                os.fsync(fh.fileno())
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        return tmp_file, digest.hexdigest(), size
+
+    def add(self, tmp_file: str, oid: str) -> None:
+        """Moves a spooled file into the store under its sha256."""
+        os.makedirs(os.path.dirname(self._file(oid)), exist_ok=True)
+        os.replace(tmp_file, self._file(oid))  # same content, same name
+
+    def open(self, oid: str) -> Iterator[bytes]:
+        try:
+            fh = open(self._file(oid), "rb")
+        except FileNotFoundError:
+            raise LogicalError(f"large note content is missing - {oid}")
+        return _file_chunks(fh)
+
+
+def _file_chunks(fh: IO[bytes]) -> Iterator[bytes]:
+    with fh:
+        while chunk := fh.read(CHUNK_SIZE):
+            yield chunk
+
+
+def store_note(git: GitCommander, stream: IO[bytes]) -> tuple[str, int, bool]:
+    """Writes an uploaded note into the object store without buffering it whole.
+
+    The upload is spooled first; a git process slot is only taken to hash
+    the finished file or the pointer.
+
+    Returns:
+        blob id to commit, content size, whether it went into the large object store.
+    """
+    store = LargeObjectStore(git)
+    tmp_file, oid, size = store.spool(stream)
+    threshold = settings.LFS_THRESHOLD_BYTES
+    if threshold and size > threshold:
+        store.add(tmp_file, oid)
+        return git.hash_object(make_pointer(oid, size)), size, True
+    try:
+        return git.hash_object_file(tmp_file), size, False
+    finally:
+        os.remove(tmp_file)
+
+
+def open_note(git: GitCommander, note_path: str, commit_id: str) -> tuple[str, int, Iterator[bytes]]:
+    """Opens the note at commit_id for streaming, following large object pointers.
+
+    Returns:
+        blob id, content size, iterable of content chunks.
+    """
+    blob_id, size = git.get_blob_info(note_path, commit_id)
+    if size > max(STREAM_BLOB_BYTES, POINTER_MAX_BYTES):
+        return blob_id, size, BlobStream(git, blob_id)
+
+    content = git.read_blob(note_path, commit_id)
+    pointer = parse_pointer(content)
+    if pointer is not None:
+        return blob_id, pointer[1], LargeObjectStore(git).open(pointer[0])
+    return blob_id, size, iter([content])
+
+
+class BlobStream:
+    """Iterable over `git cat-file blob` output holding a git process slot until closed."""
+
+    def __init__(self, git: GitCommander, blob_id: str):
+        self.blob_id = blob_id
+        self._slot = ExitStack()
+        self._slot.enter_context(executor.slot(git.repo_path))
+        try:
+            self._proc = git.cat_blob(blob_id)
+        except BaseException:
+            self._slot.close()
+            raise
+
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self._proc.stdout.read(CHUNK_SIZE):
+            yield chunk
+
+    def close(self) -> None:
+        proc = self._proc
+        proc.stdout.close()
+        if proc.poll() is None:  # client went away mid-stream
+            proc.kill()
+        if proc.wait() not in (0, -9):
+            logger.error("git cat-file of %s exited with %s", self.blob_id, proc.returncode)
+        self._slot.close()
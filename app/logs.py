@@ -0,0 +1,275 @@
+"""Structured, non-blocking logging.
+
+Log records are put on a bounded in-memory queue by the request threads
+and written as JSON lines, in batches, by one writer thread per worker, so
+file writes never sit on the request path. When the queue is full,
+records are dropped and counted rather than blocking the request.
+
+Every request gets an id, taken from the X-Request-Id header or generated,
+which is attached to all its records and returned in the response. Below
+WARNING, only a LOG_SAMPLE_RATE share of requests is logged; the decision is
+made once per request, so a sampled request is logged completely. Git
+commands run by a request are timed by the executor and summed into its
+access record.
+
+The time spent handing records to the queue is measured against the time
+spent handling requests and exposed as the log_overhead_ratio gauge.
+
+Typical usage example:
+    configure_logging()
+    app.wsgi_app = request_log_middleware(app.wsgi_app)
+"""
+
+import atexit
+import collections
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from werkzeug.wsgi import ClosingIterator
+
+from app import metrics
+from config import settings
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("app.access")
+
+MAX_REQUEST_ID_LENGTH = 128
+# Attributes of every LogRecord; anything else was passed with extra= and is logged as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class RequestContext:
+    __slots__ = ("request_id", "sampled", "git_commands", "git_seconds")
+
+    def __init__(self, request_id: str, sampled: bool):
+        self.request_id = request_id
+        self.sampled = sampled
+        self.git_commands = 0
+        self.git_seconds = 0.0
+
+
+_context: contextvars.ContextVar[RequestContext | None] = contextvars.ContextVar(
+    "wenote_request", default=None
+)
+
+
+def current_request_id() -> str | None:
+    context = _context.get()
+    return context.request_id if context is not None else None
+
+
+def record_git_command(args: list[str], seconds: float) -> None:
+    """Called by the executor after every git command."""
+    context = _context.get()
+    if context is not None:
+        context.git_commands += 1
+        context.git_seconds += seconds
+    if seconds >= settings.LOG_SLOW_GIT_SECONDS:
+        logger.warning("slow git command", extra={"git": args[1:3], "seconds": round(seconds, 4)})
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("git command", extra={"git": args[1:3], "seconds": round(seconds, 4)})
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, default=str, separators=(",", ":"))
+
+
+class SamplingFilter(logging.Filter):
+    """Drops records below WARNING of requests that are not sampled."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        context = _context.get()
+        return context is None or context.sampled
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: records are dropped while the queue is full.
+
+    The queue is a deque, whose appends take no lock and wake no thread;
+    the BatchWriter picks records up on its own schedule.
+    """
+
+    def __init__(self, records: collections.deque, max_records: int):
+        super().__init__(records)
+        self.max_records = max_records
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only what cannot be done later in the writer thread: rendering
+        # arguments and tracebacks, which may reference mutable state, and
+        # the request id held in this thread's context.
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if not hasattr(record, "request_id"):
+            record.request_id = current_request_id()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if len(self.queue) >= self.max_records:
+            metrics.inc("log_dropped")
+        else:
+            self.queue.append(record)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        started = time.perf_counter_ns()
+        super().emit(record)
+        metrics.inc("log_emit_ns", time.perf_counter_ns() - started)
+
+
+_formatter = logging.Formatter()
+
+
+class BatchWriter:
+    """Writes queued records every LOG_FLUSH_INTERVAL seconds, one write per batch."""
+
+    def __init__(self, records: collections.deque, target: logging.StreamHandler):
+        self.records = records
+        self.target = target
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(settings.LOG_FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except Exception:  # a full disk must not kill the writer
+                metrics.inc("log_write_failed")
+
+    def flush(self) -> None:
+        lines = []
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            lines.append(self.target.format(record) + "\n")
+        if not lines:
+            return
+        target = self.target
+        with target.lock:
+            if isinstance(target, logging.handlers.WatchedFileHandler):
+                target.reopenIfNeeded()  # moved away by logrotate
+            target.stream.write("".join(lines))
+            target.stream.flush()
+
+
+_writer: BatchWriter | None = None
+_writer_pid: int | None = None
+_writer_lock = threading.Lock()
+
+
+def configure_logging() -> None:
+    """Routes the root logger through a bounded queue to a JSON lines writer.
+
+    The writer is the LOG_FILE in LOGS_DIR, or stderr when LOG_FILE is
+    empty. Rotation is left to logrotate: the file is reopened when it is
+    moved away, without a rotation check on every record.
+    """
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is not None and _writer_pid == os.getpid():
+            return
+
+        if settings.LOG_FILE:
+            os.makedirs(settings.LOGS_DIR, exist_ok=True)
+            target = logging.handlers.WatchedFileHandler(
+                os.path.join(settings.LOGS_DIR, settings.LOG_FILE)
+            )
+        else:
+            target = logging.StreamHandler(sys.stderr)
+        target.setFormatter(JsonFormatter())
+
+        handler = DroppingQueueHandler(collections.deque(), settings.LOG_QUEUE_SIZE)
+        handler.addFilter(SamplingFilter())
+
+        root = logging.getLogger()
+        for old in [h for h in root.handlers if isinstance(h, DroppingQueueHandler)]:
+            root.removeHandler(old)
+        root.addHandler(handler)
+        root.setLevel(settings.LOG_LEVEL)
+
+        _writer = BatchWriter(handler.queue, target)
+        _writer.start()
+        _writer_pid = os.getpid()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Flushes queued records on shutdown."""
+    with _writer_lock:
+        if _writer is not None and _writer_pid == os.getpid():
+            _writer.stop()
+
+
+def request_log_middleware(app):
+    """Assigns request ids, samples requests and writes one access record per request."""
+
+    def middleware(environ, start_response):
+        started = time.perf_counter_ns()
+        request_id = environ.get("HTTP_X_REQUEST_ID", "")[:MAX_REQUEST_ID_LENGTH] or uuid.uuid4().hex
+        context = RequestContext(request_id, random.random() < settings.LOG_SAMPLE_RATE)
+        token = _context.set(context)
+        status = []
+
+        def logged_start_response(response_status, headers, exc_info=None):
+            status.append(response_status.split(" ", 1)[0])
+            return start_response(response_status, [*headers, ("X-Request-Id", request_id)],
+                                  exc_info)
+
+        def finish():
+            elapsed = time.perf_counter_ns() - started
+            access_logger.info("%s %s", environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"),
+                               extra={
+                                   "status": int(status[0]) if status else None,
+                                   "duration_ms": round(elapsed / 1e6, 3),
+                                   "git_commands": context.git_commands,
+                                   "git_ms": round(context.git_seconds * 1000, 3),
+                               })
+            metrics.inc("request_ns", elapsed)
+            metrics.set_gauge("log_overhead_ratio",
+                              metrics.get("log_emit_ns") / max(metrics.get("request_ns"), 1))
+            try:
+                _context.reset(token)
+            except ValueError:  # close() ran in another context than the request
+                pass
+
+        try:
+            return ClosingIterator(app(environ, logged_start_response), finish)
+        except BaseException:
+            finish()
+            raise
+    return middleware
@@ -1,21 +1,280 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import time
+from urllib.parse import parse_qs
+
 from flask import jsonify
+from pydantic import ValidationError
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import ClosingIterator
+
+from app import metrics
+from app.exceptions import GitBusyError, LogicalError
+from app.slots import SlotPool
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+BUSY_RETRY_AFTER = "1"
+
+
+def git_busy_response(e: GitBusyError):
+    response = jsonify({"error": "Server busy, retry later"})
+    response.status_code = 503
+    response.headers["Retry-After"] = BUSY_RETRY_AFTER
+    return response
+
+
+def access_denied_response(e: LogicalError):
+    response = jsonify({"error": "Access denied"})
+    response.status_code = 403
+    return response
+
+
+def validation_error_response(e: ValidationError):
+    # Inputs are left out: they may be whole notes.
+    details = [{"field": ".".join(map(str, error["loc"])), "message": error["msg"]}
+               for error in e.errors(include_url=False, include_input=False)]
+    response = jsonify({"error": "Invalid request", "details": details})
+    response.status_code = 400
+    return response
 
-from app.exceptions import LogicalError
 
 def exception_handler_middleware(app):
     def middleware(environ, start_response):
         try:
             return app(environ, start_response)
         except LogicalError as e:
-            # TODO: Add proper logging
-            print(f"LogicalError: {e}")
+            logger.warning("logical error: %s", e)
             response = jsonify({"error": "Logical error occurred"})
             response.status_code = 500
             return response(environ, start_response)
         except (FileNotFoundError, IOError) as e:
-            print(f"File error: {e}")
+            logger.exception("file error: %s", e)
             response = jsonify({"error": "File not found or IO error occurred"})
             response.status_code = 500
             return response(environ, start_response)
     return middleware
 
+
+
+WRITE_PATHS = {
+    "/apiv1/create-note",
+    "/apiv1/update-note",
+    "/apiv1/delete-note",
+    "/apiv1/import",
+    "/apiv1/note-raw",
+}
+EXEMPT_PATHS = {"/apiv1/metrics", "/apiv1/admin/profile"}
+MAX_PEEKED_BODY = 64 * 1024
+
+
+def _overloaded_response(status: int, message: str, retry_after: int) -> Response:
+    response = Response(json.dumps({"error": message}), status=status,
+                        mimetype="application/json")
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def _peek_json_body(environ) -> dict | None:
+    """JSON object body of the request, {} for other bodies, None for JSON
+    bodies too large (or chunked) to peek at.
+
+    A peeked body is put back into wsgi.input for the application.
+    """
+    if "json" not in environ.get("CONTENT_TYPE", ""):
+        return {}
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        return None
+    if not 0 < length <= MAX_PEEKED_BODY:
+        return None if length or environ.get("HTTP_TRANSFER_ENCODING") else {}
+
+    body = environ["wsgi.input"].read(length)
+    environ["wsgi.input"] = io.BytesIO(body)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _peek_repo_name(environ) -> str | None:
+    """repo_name of the request, from the query string or a small JSON body.
+
+    Returns:
+        "" when the request names no repository (REPO_PATH is used), None when
+        it could only be named in a JSON body too large to peek at.
+    """
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+    # repo_path is what older clients send.
+    repo_name = (query.get("repo_name") or query.get("repo_path") or [""])[0]
+    if repo_name:
+        return repo_name
+
+    body = _peek_json_body(environ)
+    if body is None:
+        return None
+    repo_name = body.get("repo_name", body.get("repo_path"))
+    return repo_name if isinstance(repo_name, str) else ""
+
+
+def admission_control_middleware(app):
+    """Bounds the number of requests in flight across all workers.
+
+    Reads and writes share ADMISSION_MAX_INFLIGHT slots, but writes may only
+    take ADMISSION_MAX_INFLIGHT - ADMISSION_READ_RESERVED of them and at most
+    ADMISSION_MAX_WRITES_PER_REPO per repository, so reads always keep
+    capacity. Requests wait for a slot up to their queue timeout and are then
+    rejected: 429 when their repository is saturated with writes, 503 when
+    the whole node is.
+
+    The repository is looked up in the query string, then in JSON bodies up
+    to MAX_PEEKED_BODY. Larger JSON writes that do not repeat repo_name in
+    the query string all share one extra bucket of
+    ADMISSION_MAX_WRITES_PER_REPO slots, whatever repository they write to.
+    """
+    os.makedirs(settings.ADMISSION_LOCK_DIR, exist_ok=True)
+    inflight = SlotPool(settings.ADMISSION_LOCK_DIR, "inflight", settings.ADMISSION_MAX_INFLIGHT)
+    writes = SlotPool(settings.ADMISSION_LOCK_DIR, "writes",
+                      max(settings.ADMISSION_MAX_INFLIGHT - settings.ADMISSION_READ_RESERVED, 1))
+
+    def repo_pool(repo_name: str | None) -> SlotPool:
+        if repo_name is None:
+            return SlotPool(settings.ADMISSION_LOCK_DIR, "repo-unpeeked",
+                            settings.ADMISSION_MAX_WRITES_PER_REPO)
+        digest = hashlib.sha1(os.path.abspath(repo_name or settings.REPO_PATH).encode()).hexdigest()
+        return SlotPool(settings.ADMISSION_LOCK_DIR, f"repo-{digest[:16]}",
+                        settings.ADMISSION_MAX_WRITES_PER_REPO)
+
+    def middleware(environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path in EXEMPT_PATHS:
+            return app(environ, start_response)
+
+        is_write = path in WRITE_PATHS and environ.get("REQUEST_METHOD") != "GET"
+        timeout = settings.ADMISSION_WRITE_TIMEOUT if is_write else settings.ADMISSION_READ_TIMEOUT
+        deadline = time.monotonic() + timeout
+        held = []
+
+        def release():
+            while held:
+                SlotPool.release(held.pop())
+
+        if is_write:
+            fd = repo_pool(_peek_repo_name(environ)).acquire(deadline)
+            if fd is None:
+                metrics.inc("admission_rejected_429")
+                return _overloaded_response(429, "Too many writes to this repository",
+                                            settings.ADMISSION_RETRY_AFTER)(environ, start_response)
+            held.append(fd)
+            fd = writes.acquire(deadline)
+            if fd is None:
+                release()
+                metrics.inc("admission_rejected_503")
+                return _overloaded_response(503, "Server busy, retry later",
+                                            settings.ADMISSION_RETRY_AFTER)(environ, start_response)
+            held.append(fd)
+
+        fd = inflight.acquire(deadline)
+        if fd is None:
+            release()
+            metrics.inc("admission_rejected_503")
+            return _overloaded_response(503, "Server busy, retry later",
+                                        settings.ADMISSION_RETRY_AFTER)(environ, start_response)
+        held.append(fd)
+        metrics.inc("admission_admitted")
+
+        try:
+            return ClosingIterator(app(environ, start_response), release)
+        except BaseException:
+            release()
+            raise
+    return middleware
+
+
+def profiling_middleware(app):
+    """Samples requests covered by a profiling session, see app.profiling."""
+    from app.profiling import profiler
+
+    def middleware(environ, start_response):
+        if environ.get("PATH_INFO", "").startswith("/apiv1/admin/"):
+            return app(environ, start_response)
+        profile_id, session = profiler.session_for(environ.get("HTTP_X_WENOTE_PROFILE"),
+                                                   environ.get("HTTP_X_ADMIN_TOKEN"))
+        if session is None:
+            return app(environ, start_response)
+
+        def profiled_start_response(status, headers, exc_info=None):
+            if profile_id is not None:
+                headers = [*headers, ("X-Profile-Id", profile_id)]
+            return start_response(status, headers, exc_info)
+
+        profiler.attach(session)
+        try:
+            return app(environ, profiled_start_response)
+        finally:
+            profiler.detach()
+    return middleware
+
+
+def capture_middleware(app):
+    """Records sanitized requests for replay, see app.capture.
+
+    Bodies are not read here: JSON bodies are taken from the request model
+    the endpoint validated (CAPTURED_INPUT), so notes are never parsed twice.
+    """
+    from app.capture import CAPTURED_INPUT, CaptureRecord, get_writer, pseudonym, sanitize
+
+    def middleware(environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path.startswith("/apiv1/admin/") or random.random() >= settings.CAPTURE_SAMPLE_RATE:
+            return app(environ, start_response)
+
+        started = time.time()
+        params = {key: values[0] for key, values in parse_qs(environ.get("QUERY_STRING", "")).items()}
+        try:
+            request_bytes = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            request_bytes = 0
+        status = []
+        response_bytes = 0
+
+        def captured_start_response(response_status, headers, exc_info=None):
+            status.append(int(response_status.split(" ", 1)[0]))
+            return start_response(response_status, headers, exc_info)
+
+        def counted(body):
+            nonlocal response_bytes
+            for chunk in body:
+                response_bytes += len(chunk)
+                yield chunk
+
+        def finish():
+            input_ = environ.get(CAPTURED_INPUT)
+            if input_ is not None:
+                params.update(input_.model_dump())
+            get_writer().write(CaptureRecord(
+                timestamp=started,
+                duration=time.time() - started,
+                status=status[0] if status else 0,
+                method=environ.get("REQUEST_METHOD", "GET"),
+                path=path,
+                params=sanitize(params),
+                request_bytes=request_bytes,
+                response_bytes=response_bytes,
+                user=pseudonym(environ.get("HTTP_X_WENOTE_USER")),
+            ))
+
+        try:
+            body = app(environ, captured_start_response)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(counted(body), [getattr(body, "close", lambda: None), finish])
+    return middleware
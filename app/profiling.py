@@ -0,0 +1,355 @@
+"""Sampling profiler of request handling.
+
+A profiling session collects stack samples of the threads handling the
+requests it covers, taken with sys._current_frames() by one sampler thread
+every PROFILE_INTERVAL seconds. Nothing is traced, so requests that are not
+profiled pay only for a header lookup and, every PROFILE_POLL_SECONDS, a
+read of the session control file.
+
+Sessions are started by an admin for a number of seconds or requests
+(/apiv1/admin/profile), or cover a single request sent with the
+X-Wenote-Profile header. Results are collapsed stacks, as consumed by
+flamegraph.pl and speedscope, plus per-GitCommander-method sample counts.
+
+Sessions span all worker processes of a node through PROFILE_DIR: the
+admin session is announced in a control file every worker polls, its
+request budget is claimed by appending to a shared claims file, and each
+worker writes its samples to a file of its own, which are merged when the
+profile is read. Any worker can therefore start, stop and report a session.
+
+Typical usage example:
+    profiler.start(seconds=30, requests=None)
+"""
+
+import collections
+import glob
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+from app.utils import GitCommander
+from config import settings
+
+MAX_STACK_DEPTH = 128
+KEPT_PROFILES = 256  # sample files kept in PROFILE_DIR
+PROFILE_POLL_SECONDS = 0.1
+FLUSH_SECONDS = 0.5
+CONTROL_FILE = "admin.json"
+PROFILE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def is_admin(token: str | None) -> bool:
+    return bool(settings.ADMIN_TOKEN) and token is not None and hmac.compare_digest(
+        token.encode(), settings.ADMIN_TOKEN.encode()
+    )
+
+
+class ProfileSession:
+    def __init__(self, profile_id: str, started: float, deadline: float | None = None,
+                 requests: int | None = None, claims_path: str | None = None):
+        self.profile_id = profile_id
+        self.started = started
+        self.deadline = deadline
+        self.budget = requests
+        self.claims_path = claims_path  # shared request budget, local when None
+        self.requests = 0
+        self.samples = 0
+        self.stacks: collections.Counter[str] = collections.Counter()
+        # method name -> [samples with the method on the stack, samples with it innermost]
+        self.git_methods: dict[str, list[int]] = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def claim(self) -> bool:
+        """Takes one request into the session, False once the session is over."""
+        with self._lock:
+            if self.deadline is not None and time.time() >= self.deadline:
+                return False
+            if self.budget is not None and self._claims(claim=True) > self.budget:
+                return False
+            self.requests += 1
+            self.dirty = True
+            return True
+
+    def _claims(self, claim: bool = False) -> int:
+        """Requests claimed by all workers, including this one, if claim is set."""
+        if self.claims_path is None:
+            return self.requests + claim
+        if not claim:
+            try:
+                return os.stat(self.claims_path).st_size
+            except FileNotFoundError:
+                return 0
+        # One byte per claim; the offset after an O_APPEND write numbers it.
+        fd = os.open(self.claims_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, b".")
+            return os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+
+    @property
+    def active(self) -> bool:
+        expired = self.deadline is not None and time.time() >= self.deadline
+        return not expired and (self.budget is None or self._claims() < self.budget)
+
+    def add_sample(self, stack: list[str], git_methods: list[str]) -> None:
+        with self._lock:
+            self.samples += 1
+            self.dirty = True
+            self.stacks[";".join(stack)] += 1
+            for name in set(git_methods):
+                self.git_methods.setdefault(name, [0, 0])[0] += 1
+            if git_methods:
+                self.git_methods[git_methods[-1]][1] += 1
+
+    def dump(self) -> dict:
+        with self._lock:
+            self.dirty = False
+            return {"started": self.started, "requests": self.requests, "samples": self.samples,
+                    "stacks": dict(self.stacks), "git_methods": self.git_methods}
+
+
+def _merge(parts: list[dict]) -> dict:
+    stacks: collections.Counter[str] = collections.Counter()
+    git_methods: dict[str, list[int]] = {}
+    for part in parts:
+        stacks.update(part["stacks"])
+        for name, (total, own) in part["git_methods"].items():
+            counts = git_methods.setdefault(name, [0, 0])
+            counts[0] += total
+            counts[1] += own
+    return {
+        "started": min(part["started"] for part in parts),
+        "requests": sum(part["requests"] for part in parts),
+        "samples": sum(part["samples"] for part in parts),
+        "stacks": stacks,
+        "git_methods": git_methods,
+    }
+
+
+class Profiler:
+    def __init__(self):
+        self.session: ProfileSession | None = None  # admin session
+        self._next_poll = 0.0
+        self._sessions: dict[str, ProfileSession] = {}  # with samples not yet written
+        self._attached: dict[int, ProfileSession] = {}
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+        self._git_codes: dict | None = None
+
+    @staticmethod
+    def _path(name: str) -> str:
+        return os.path.join(settings.PROFILE_DIR, name)
+
+    def start(self, seconds: float | None, requests: int | None) -> ProfileSession:
+        """Starts an admin session in all workers."""
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        started = time.time()
+        self._write_control({"id": uuid.uuid4().hex, "started": started,
+                             "deadline": started + seconds if seconds else None,
+                             "requests": requests})
+        self._prune()
+        return self._admin_session(poll=True)
+
+    def stop(self) -> None:
+        control = self._read_control()
+        if control is not None:
+            control["deadline"] = time.time()
+            self._write_control(control)
+        self._admin_session(poll=True)
+
+    def _write_control(self, control: dict) -> None:
+        tmp_file = self._path(f"{CONTROL_FILE}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as fh:
+            json.dump(control, fh)
+        os.replace(tmp_file, self._path(CONTROL_FILE))
+
+    def _read_control(self) -> dict | None:
+        try:
+            with open(self._path(CONTROL_FILE)) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def _admin_session(self, poll: bool = False) -> ProfileSession | None:
+        """The admin session, as last announced in the control file."""
+        now = time.monotonic()
+        if not poll and now < self._next_poll:
+            return self.session
+        self._next_poll = now + PROFILE_POLL_SECONDS
+        control = self._read_control()
+        if control is None:
+            return self.session
+        session = self.session
+        if session is None or session.profile_id != control["id"]:
+            session = ProfileSession(control["id"], control["started"],
+                                     requests=control["requests"],
+                                     claims_path=self._path(f"{control['id']}.claims"))
+        session.deadline = control["deadline"]
+        self.session = session
+        return session
+
+    def session_for(self, profile_header: str | None, token: str | None) -> tuple[str | None, ProfileSession | None]:
+        """Session covering a request, with the profile id of a single-request session."""
+        if profile_header is not None and is_admin(token):
+            session = ProfileSession(uuid.uuid4().hex, time.time(), requests=1)
+            session.claim()
+            return session.profile_id, session
+
+        session = self._admin_session()
+        if session is not None and session.claim():
+            return None, session
+        return None, None
+
+    def attach(self, session: ProfileSession) -> None:
+        """Samples the calling thread for session until detach()."""
+        with self._cond:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._attached[threading.get_ident()] = session
+            self._sessions[session.profile_id] = session
+            self._cond.notify()
+
+    def detach(self) -> None:
+        with self._cond:
+            session = self._attached.pop(threading.get_ident(), None)
+        if session is not None and session.claims_path is None:
+            # Single-request sessions are read right after the response.
+            self._flush(session)
+
+    def _run(self) -> None:
+        flushed = time.monotonic()
+        while True:
+            with self._cond:
+                while not self._attached and not self._sessions:
+                    self._cond.wait()
+                attached = dict(self._attached)
+
+            frames = sys._current_frames()
+            for thread_id, session in attached.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    session.add_sample(*self._walk(frame))
+            del frames
+            if time.monotonic() - flushed >= FLUSH_SECONDS:
+                self.flush()
+                flushed = time.monotonic()
+            time.sleep(settings.PROFILE_INTERVAL)
+
+    def flush(self) -> None:
+        """Writes the samples of this worker not written yet."""
+        with self._cond:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if session.dirty:
+                self._flush(session)
+        with self._cond:
+            attached = {session.profile_id for session in self._attached.values()}
+            for session in sessions:  # no more samples to come, attach() adds them back
+                if session.profile_id not in attached and not session.dirty:
+                    self._sessions.pop(session.profile_id, None)
+
+    def _flush(self, session: ProfileSession) -> None:
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        path = self._path(f"{session.profile_id}.{os.getpid()}-{id(self):x}.json")
+        with open(f"{path}.tmp", "w") as fh:
+            json.dump(session.dump(), fh)
+        os.replace(f"{path}.tmp", path)
+
+    def _prune(self) -> None:
+        files = []
+        for path in glob.glob(self._path("*.json")) + glob.glob(self._path("*.claims")):
+            try:
+                files.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                continue
+        for _, path in sorted(files)[:-KEPT_PROFILES]:
+            if not path.endswith(CONTROL_FILE):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def report(self, profile_id: str | None = None) -> dict | None:
+        """Report of a session merged over all workers; the admin session without an id."""
+        merged = self._merged(profile_id)
+        if merged is None:
+            return None
+        profile_id, active, data = merged
+        interval = settings.PROFILE_INTERVAL
+        return {
+            "active": active,
+            "started": data["started"],
+            "requests": data["requests"],
+            "samples": data["samples"],
+            "interval": interval,
+            "git_methods": {
+                name: {"samples": total, "self_samples": own, "seconds": total * interval}
+                for name, (total, own) in sorted(data["git_methods"].items(),
+                                                 key=lambda item: -item[1][0])
+            },
+            "stacks": [f"{stack} {count}" for stack, count in data["stacks"].most_common(50)],
+        }
+
+    def collapsed(self, profile_id: str | None = None) -> str | None:
+        merged = self._merged(profile_id)
+        if merged is None:
+            return None
+        return "".join(f"{stack} {count}\n" for stack, count in merged[2]["stacks"].most_common())
+
+    def _merged(self, profile_id: str | None) -> tuple[str, bool, dict] | None:
+        active = False
+        if profile_id is None:
+            session = self._admin_session(poll=True)
+            if session is None:
+                return None
+            profile_id, active = session.profile_id, session.active
+        elif not PROFILE_ID_RE.match(profile_id):
+            return None
+
+        local = self._sessions.get(profile_id)
+        if local is not None:
+            self._flush(local)
+        parts = []
+        for path in glob.glob(self._path(f"{profile_id}.*.json")):
+            try:
+                with open(path) as fh:
+                    parts.append(json.load(fh))
+            except (OSError, ValueError):  # pruned meanwhile
+                continue
+        if not parts:
+            if self.session is None or profile_id != self.session.profile_id:
+                return None
+            parts = [{"started": self.session.started, "requests": 0, "samples": 0,
+                      "stacks": {}, "git_methods": {}}]
+        return profile_id, active, _merge(parts)
+
+    def _walk(self, frame) -> tuple[list[str], list[str]]:
+        """Root-first stack of a frame and the GitCommander methods on it."""
+        if self._git_codes is None:
+            self._git_codes = {
+                value.__code__: name for name, value in vars(GitCommander).items()
+                if hasattr(value, "__code__")
+            }
+        stack, git_methods = [], []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append(f"{frame.f_globals.get('__name__', '?')}.{code.co_qualname}")
+            if code in self._git_codes:
+                git_methods.append(self._git_codes[code])
+            frame = frame.f_back
+        stack.reverse()
+        git_methods.reverse()
+        return stack, git_methods
+
+
+profiler = Profiler()
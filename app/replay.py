@@ -0,0 +1,184 @@
+"""Replay of captured traffic with latency and throughput reports.
+
+Re-drives a capture written with CAPTURE_PATH (see app.capture) against a
+clone of the captured repository, keeping the recorded arrival times
+scaled by --speed, or as fast as --concurrency allows with --speed 0.
+Requests go to a running server with --url, or to an in-process app
+otherwise, so service changes can be compared on the same workload
+without deploying them.
+
+Sanitized parameters are filled back in: note contents are replaced by
+filler of the recorded size, search queries by a filler word. Imports,
+whose archives are not captured, are skipped.
+
+Usage:
+    python -m app.replay CAPTURE --repo /path/to/clone [--speed 1] [--concurrency 8]
+        [--url http://localhost:8000] [--json]
+"""
+
+import argparse
+import collections
+import json
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from app.capture import CaptureRecord, read_capture
+
+SKIPPED_PATHS = {"/apiv1/import"}
+QUERY_FILLER = "note"
+
+
+def build_request(record: CaptureRecord, repo: str | None) -> tuple[str, dict, bytes | None, str]:
+    """Query, headers, body and content type reconstructing a captured request."""
+    params = dict(record.params)
+    if repo:
+        params.pop("repo_path", None)
+        params["repo_name"] = repo
+    if "q_size" in params:
+        params["q"] = QUERY_FILLER
+        del params["q_size"]
+    note_size = params.pop("note_value_size", None)
+
+    headers = {"X-Wenote-User": record.user} if record.user else {}
+    if record.method in ("GET", "HEAD"):
+        return urlencode(params), headers, None, ""
+    if record.path == "/apiv1/note-raw":
+        return urlencode(params), headers, b"x" * record.request_bytes, "application/octet-stream"
+    if note_size is not None:
+        params["note_value"] = "x" * note_size
+    return "", headers, json.dumps(params).encode(), "application/json"
+
+
+class Replayer:
+    def __init__(self, repo: str | None, url: str | None):
+        self.repo = repo
+        self.url = url.rstrip("/") if url else None
+        self._local = threading.local()
+        if self.url is None:
+            from app import create_app
+            self.app = create_app()
+
+    def send(self, record: CaptureRecord) -> int:
+        """Sends one captured request and returns its status."""
+        query, headers, body, content_type = build_request(record, self.repo)
+        if content_type:
+            headers["Content-Type"] = content_type
+        path = f"{record.path}?{query}" if query else record.path
+        if self.url:
+            request = urllib.request.Request(self.url + path, data=body, headers=headers,
+                                             method=record.method)
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        with client.open(path, method=record.method, data=body, headers=headers) as response:
+            response.get_data()
+            return response.status_code
+
+
+def replay(records: list[CaptureRecord], replayer: Replayer, speed: float,
+           concurrency: int) -> dict:
+    """Replays records in capture order and returns the report."""
+    skipped = sum(1 for record in records if record.path in SKIPPED_PATHS)
+    records = sorted((r for r in records if r.path not in SKIPPED_PATHS), key=lambda r: r.timestamp)
+    results: dict[str, list[tuple[float, int]]] = collections.defaultdict(list)
+    lock = threading.Lock()
+
+    def run(record: CaptureRecord, scheduled: float | None) -> None:
+        if scheduled is None:  # as fast as possible: there is no due time to be late for
+            scheduled = time.perf_counter()
+        try:
+            status = replayer.send(record)
+        except Exception:
+            status = 0
+        # From the time the request was due, not the time a thread picked it
+        # up, so queueing behind slow requests counts (no coordinated omission).
+        elapsed = time.perf_counter() - scheduled
+        with lock:
+            results[f"{record.method} {record.path}"].append((elapsed, status))
+
+    started = time.perf_counter()
+    first = records[0].timestamp if records else 0.0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            scheduled = None
+            if speed > 0:
+                scheduled = started + (record.timestamp - first) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(run, record, scheduled)
+    wall = time.perf_counter() - started
+
+    recorded = collections.defaultdict(list)
+    for record in records:
+        recorded[f"{record.method} {record.path}"].append(record.duration)
+    return {
+        "requests": sum(len(timings) for timings in results.values()),
+        "seconds": wall,
+        "throughput": sum(len(timings) for timings in results.values()) / wall if wall else 0.0,
+        "endpoints": {
+            endpoint: {
+                **_latencies([elapsed for elapsed, _ in timings]),
+                "errors": sum(1 for _, status in timings if status == 0 or status >= 500),
+                "recorded_p50": statistics.median(recorded[endpoint]),
+            }
+            for endpoint, timings in sorted(results.items())
+        },
+        "skipped": skipped,
+    }
+
+
+def _latencies(timings: list[float]) -> dict:
+    timings = sorted(timings)
+
+    def percentile(share: float) -> float:
+        return timings[min(int(share * len(timings)), len(timings) - 1)]
+
+    return {"count": len(timings), "p50": percentile(0.5), "p90": percentile(0.9),
+            "p99": percentile(0.99), "max": timings[-1]}
+
+
+def format_report(report: dict) -> str:
+    lines = [f"{report['requests']} requests in {report['seconds']:.2f}s, "
+             f"{report['throughput']:.1f} req/s, {report['skipped']} skipped",
+             f"{'endpoint':<32} {'count':>7} {'errors':>6} {'p50 ms':>9} {'p90 ms':>9} "
+             f"{'p99 ms':>9} {'max ms':>9} {'recorded p50':>13}"]
+    for endpoint, stats in report["endpoints"].items():
+        lines.append(f"{endpoint:<32} {stats['count']:>7} {stats['errors']:>6} "
+                     f"{stats['p50'] * 1000:>9.2f} {stats['p90'] * 1000:>9.2f} "
+                     f"{stats['p99'] * 1000:>9.2f} {stats['max'] * 1000:>9.2f} "
+                     f"{stats['recorded_p50'] * 1000:>13.2f}")
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.replay", description=__doc__.split("\n")[0])
+    parser.add_argument("capture")
+    parser.add_argument("--repo", help="repository to replay against, replaces captured repo names")
+    parser.add_argument("--url", help="base url of a running server, in-process app otherwise")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="multiple of the captured rate, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    records = list(read_capture(args.capture))
+    report = replay(records, Replayer(args.repo, args.url), args.speed, args.concurrency)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,63 +1,96 @@
-from flask import request, jsonify
+from flask import Response, request, jsonify
 import sys
 import os
 
 sys.path.append(os.path.abspath("../"))
 
+from app import metrics
+from app.archives import ARCHIVE_FORMATS
+from app.capture import CAPTURED_INPUT
+from app.profiling import is_admin, profiler
 from app.routes import bp as app
-from app.serializers import UpdateNoteInput, DeleteNoteInput
-from app.services import update_note, delete_note, create_note, get_note, get_note_names
+from app.serializers import (CreateNoteInput, DeleteNoteInput, DiffQuery, ExportQuery,
+                             ImportQuery, JournalQuery, NoteBlameQuery, NoteHistoryQuery,
+                             NoteNamesQuery, NoteQuery, ProfileQuery, PutNoteRawQuery, RepoQuery,
+                             SearchQuery, TreeQuery, UpdateNoteInput)
+from app.services import (apply_note_write, get_note, get_note_names, search_notes,
+                          get_note_history, get_note_blame, export_notes, import_notes,
+                          list_conflicts, get_note_raw, put_note_raw, submit_note_write, get_journal_status, get_tree, get_diff)
+from config import settings
+
+
+def _validate_json(model):
+    input_ = model.model_validate_json(request.get_data(cache=False))
+    request.environ[CAPTURED_INPUT] = input_  # recorded by capture_middleware
+    return input_
 
 
 @app.route("/apiv1/get-note", methods=["GET"])
 def get_note_view():
-    repo_name = request.args.get("repo_name")
-    note_path = request.args.get("note_path")
-    branch_name = request.args.get("branch_name")
+    query = NoteQuery.model_validate(request.args.to_dict())
 
-    if not note_path or not branch_name:
-        return jsonify({"error": "Missing required parameters"}), 400
-
-    data: dict = get_note(repo_name, note_path, branch_name)
+    data: dict = get_note(query.repo_name, query.note_path, query.branch_name,
+                          request.headers.get("X-Wenote-User"))
 
     return jsonify(data)
 
 
 @app.route("/apiv1/get-note-names", methods=["GET"])
 def get_note_names_view():
-    repo_name = request.args.get("repo_name")
-    branch_name = request.args.get("branch_name")
+    query = NoteNamesQuery.model_validate(request.args.to_dict())
 
-    if not branch_name:
-        return jsonify({"error": "Missing required parameters"}), 400
+    data: dict = get_note_names(query.repo_name, query.branch_name,
+                                request.headers.get("X-Wenote-User"))
 
-    data: dict = get_note_names(repo_name, branch_name)
+    return jsonify(data)
+
+
+@app.route("/apiv1/tree", methods=["GET"])
+def tree_view():
+    query = TreeQuery.model_validate(request.args.to_dict())
+
+    data: dict = get_tree(query.repo_name, query.branch_name, query.path, min(query.depth, 16),
+                          request.headers.get("X-Wenote-User"))
 
     return jsonify(data)
 
 
 @app.route("/apiv1/create-note", methods=["POST"])
 def create_note_view():
-    data = request.json
-    repo_name = data.get("repo_name")
-    note_path = data.get("note_path")
-    note_value = data.get("note_value")
+    request.max_content_length = settings.MAX_NOTE_BYTES
+    input_ = _validate_json(CreateNoteInput)
+    user = request.headers.get("X-Wenote-User")
+
+    if settings.JOURNAL_WRITES:
+        return jsonify(submit_note_write(input_.repo_name, "create", note_path=input_.note_path,
+                                         note_value=input_.note_value, user=user)), 202
 
-    data: dict = create_note(repo_name, note_path, note_value)
+    data: dict = apply_note_write(input_.repo_name, "create", note_path=input_.note_path,
+                                  note_value=input_.note_value, user=user)
 
     return jsonify(data)
 
 
 @app.route("/apiv1/update-note", methods=["PUT"])
 def update_note_view():
-    data = request.json
-    input_ = UpdateNoteInput(**data)
-
-    status, note_value, branch_name, commit_id = update_note(input_.repo_name, 
-                                                             input_.branch_name,
-                                                             input_.commit_id,
-                                                             input_.note_path,
-                                                             input_.note_value) 
+    request.max_content_length = settings.MAX_NOTE_BYTES
+    input_ = _validate_json(UpdateNoteInput)
+    user = request.headers.get("X-Wenote-User")
+
+    if settings.JOURNAL_WRITES:
+        return jsonify(submit_note_write(input_.repo_name, "update",
+                                         branch_name=input_.branch_name,
+                                         commit_id=input_.commit_id,
+                                         note_path=input_.note_path,
+                                         note_value=input_.note_value,
+                                         user=user)), 202
+
+    status, note_value, branch_name, commit_id = apply_note_write(input_.repo_name, "update",
+                                                                  branch_name=input_.branch_name,
+                                                                  commit_id=input_.commit_id,
+                                                                  note_path=input_.note_path,
+                                                                  note_value=input_.note_value,
+                                                                  user=user)
    
     return jsonify(
         {
@@ -71,12 +104,184 @@ def update_note_view():
 
 @app.route("/apiv1/delete-note", methods=["DELETE"])
 def delete_note_view():
-    data = request.json
-    input_ = DeleteNoteInput(**data)
+    request.max_content_length = settings.MAX_NOTE_BYTES
+    input_ = _validate_json(DeleteNoteInput)
+    user = request.headers.get("X-Wenote-User")
+
+    if settings.JOURNAL_WRITES:
+        return jsonify(submit_note_write(input_.repo_name, "delete",
+                                         note_path=input_.note_path,
+                                         branch_name=input_.branch_name,
+                                         user=user)), 202
 
-    status, note_value = delete_note(input_.repo_name, 
-                                     input_.note_path, 
-                                     input_.branch_name)
+    status, note_value = apply_note_write(input_.repo_name, "delete",
+                                          note_path=input_.note_path,
+                                          branch_name=input_.branch_name,
+                                          user=user)
 
     return jsonify({"status": status, "note_value": note_value or None})
 
+
+
+@app.route("/apiv1/search", methods=["GET"])
+def search_view():
+    query = SearchQuery.model_validate(request.args.to_dict())
+
+    data: dict = search_notes(query.repo_name, query.q, min(query.limit, 100),
+                              request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/note-history", methods=["GET"])
+def note_history_view():
+    query = NoteHistoryQuery.model_validate(request.args.to_dict())
+
+    data: dict = get_note_history(query.repo_name, query.note_path, query.branch_name,
+                                  query.cursor, min(query.limit, 500),
+                                  request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/diff", methods=["GET"])
+def diff_view():
+    query = DiffQuery.model_validate(request.args.to_dict())
+
+    data: dict = get_diff(query.repo_name, query.from_, query.to, query.patch,
+                          request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/note-blame", methods=["GET"])
+def note_blame_view():
+    query = NoteBlameQuery.model_validate(request.args.to_dict())
+
+    data: dict = get_note_blame(query.repo_name, query.note_path, query.branch_name,
+                                query.commit_id, query.cursor, min(query.limit, 500),
+                                request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/note-raw", methods=["GET"])
+def get_note_raw_view():
+    query = NoteQuery.model_validate(request.args.to_dict())
+
+    commit_id, blob_id, size, chunks = get_note_raw(query.repo_name, query.note_path,
+                                                    query.branch_name,
+                                                    request.headers.get("X-Wenote-User"))
+
+    return Response(
+        chunks,
+        mimetype="application/octet-stream",
+        headers={
+            "Content-Length": str(size),
+            "ETag": f'"{blob_id}"',
+            "X-Commit-Id": commit_id,
+        },
+    )
+
+
+@app.route("/apiv1/note-raw", methods=["PUT"])
+def put_note_raw_view():
+    query = PutNoteRawQuery.model_validate(request.args.to_dict())
+
+    # Limits chunked uploads too, the stream raises 413 past the limit.
+    request.max_content_length = settings.MAX_NOTE_BYTES
+    data: dict = put_note_raw(query.repo_name, query.note_path, query.commit_id, request.stream,
+                              request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/export", methods=["GET"])
+def export_view():
+    query = ExportQuery.model_validate(request.args.to_dict())
+
+    commit_id, chunks = export_notes(query.repo_name, query.branch_name, query.commit_id, query.fmt,
+                                     request.headers.get("X-Wenote-User"))
+
+    return Response(
+        chunks,
+        mimetype=ARCHIVE_FORMATS[query.fmt],
+        headers={
+            "Content-Disposition": f"attachment; filename=notes-{commit_id}.{query.fmt}",
+            "X-Commit-Id": commit_id,
+        },
+    )
+
+
+@app.route("/apiv1/import", methods=["POST"])
+def import_view():
+    query = ImportQuery.model_validate(request.args.to_dict())
+
+    # Limits chunked uploads too, the stream raises 413 past the limit.
+    request.max_content_length = settings.MAX_IMPORT_BYTES
+    data: dict = import_notes(query.repo_name, request.stream, query.fmt, query.replace,
+                              request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/conflicts", methods=["GET"])
+def conflicts_view():
+    query = RepoQuery.model_validate(request.args.to_dict())
+
+    data: dict = list_conflicts(query.repo_name, request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/journal", methods=["GET"])
+def journal_view():
+    query = JournalQuery.model_validate(request.args.to_dict())
+
+    data: dict = get_journal_status(query.repo_name, query.seq,
+                                    request.headers.get("X-Wenote-User"))
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/admin/profile", methods=["POST"])
+def start_profile_view():
+    if not is_admin(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "Forbidden"}), 403
+    query = ProfileQuery.model_validate(request.args.to_dict())
+    seconds, requests = query.seconds, query.requests
+
+    if seconds is None and requests is None:
+        return jsonify({"error": "Missing required parameters"}), 400
+
+    if seconds == 0 or requests == 0:
+        profiler.stop()
+    else:
+        profiler.start(min(seconds or settings.PROFILE_MAX_SECONDS, settings.PROFILE_MAX_SECONDS),
+                       requests)
+
+    return jsonify({"status": "ok"})
+
+
+@app.route("/apiv1/admin/profile", methods=["GET"])
+def profile_view():
+    if not is_admin(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "Forbidden"}), 403
+    profile_id = request.args.get("id")
+
+    if request.args.get("format") == "collapsed":
+        collapsed = profiler.collapsed(profile_id)
+        if collapsed is None:
+            return jsonify({"error": "No such profile"}), 404
+        return Response(collapsed, mimetype="text/plain")
+
+    data = profiler.report(profile_id)
+    if data is None:
+        return jsonify({"error": "No such profile"}), 404
+
+    return jsonify(data)
+
+
+@app.route("/apiv1/metrics", methods=["GET"])
+def metrics_view():
+    return jsonify(metrics.snapshot())
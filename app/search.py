@@ -0,0 +1,170 @@
+"""Full-text search over the notes of MAIN_BRANCH.
+
+The index is an SQLite FTS5 database kept next to the repository's git
+directory. It records the commit it was built from and is brought up to
+date incrementally from the tree diff between that commit and the branch
+HEAD, both after our own writes and lazily before each query.
+
+Typical usage example:
+    SearchIndex(repo_path).search("meeting notes", limit=20)
+"""
+
+import os
+import sqlite3
+
+import click
+
+from .utils import GitCommander, EMPTY_TREE
+from .exceptions import LogicalError
+from .lfs import parse_pointer
+from config import settings
+
+INDEX_NAME = "wenote-search.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS note_ids (note_path TEXT PRIMARY KEY, id INTEGER NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS notes USING fts5(note_path UNINDEXED, body);
+"""
+
+
+class SearchIndex:
+    def __init__(self, repo_path: str, branch_name: str | None = None):
+        self.git = GitCommander(repo_path)
+        self.branch_name = branch_name or settings.MAIN_BRANCH
+        self.path = os.path.join(self.git.get_git_dir(), INDEX_NAME)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def sync(self) -> str:
+        """Brings the index up to the branch HEAD, returns the indexed commit id."""
+        head = self.git.get_commit_id(self.branch_name)
+        conn = self._connect()
+        try:
+            if _indexed_commit(conn) == head:
+                return head
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                indexed = _indexed_commit(conn)  # another worker may have synced
+                if indexed != head:
+                    if indexed is None or not self.git.is_ancestor(indexed, head):
+                        self._reindex_all(conn, head)
+                    else:
+                        self._apply_diff(conn, indexed, head)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('commit', ?)",
+                        (head,),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        return head
+
+    def rebuild(self) -> str:
+        """Drops and rebuilds the whole index, for recovery."""
+        if self.exists():
+            os.remove(self.path)
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+        return self.sync()
+
+    def search(self, query: str, limit: int = 20) -> list[dict]:
+        match = _to_match_expression(query)
+        if not match:
+            return []
+
+        self.sync()
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT note_path, snippet(notes, 1, '[', ']', '...', 12) FROM notes "
+                "WHERE notes MATCH ? ORDER BY rank LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [{"note_path": note_path, "snippet": snippet} for note_path, snippet in rows]
+
+    def _reindex_all(self, conn: sqlite3.Connection, commit_id: str) -> None:
+        conn.execute("DELETE FROM notes")
+        conn.execute("DELETE FROM note_ids")
+        for _, note_path, _ in self.git.diff_tree(EMPTY_TREE, commit_id):
+            self._index_note(conn, commit_id, note_path)
+
+    def _apply_diff(self, conn: sqlite3.Connection, from_: str, to: str) -> None:
+        for status, note_path, _ in self.git.diff_tree(from_, to):
+            if status == "D":
+                self._remove_note(conn, note_path)
+            else:
+                self._index_note(conn, to, note_path)
+
+    def _index_note(self, conn: sqlite3.Connection, commit_id: str, note_path: str) -> None:
+        _, size = self.git.get_blob_info(note_path, commit_id)
+        content = self.git.read_blob(note_path, commit_id) if size <= settings.SEARCH_MAX_NOTE_BYTES else None
+        # Too large, binary or a large object pointer.
+        if content is None or b"\0" in content or parse_pointer(content) is not None:
+            self._remove_note(conn, note_path)
+            return
+
+        body = content.decode(errors="replace")
+        row = conn.execute(
+            "SELECT id FROM note_ids WHERE note_path = ?", (note_path,)
+        ).fetchone()
+        if row is None:
+            note_id = conn.execute(
+                "INSERT INTO notes (note_path, body) VALUES (?, ?)", (note_path, body)
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO note_ids (note_path, id) VALUES (?, ?)", (note_path, note_id)
+            )
+        else:
+            conn.execute("UPDATE notes SET body = ? WHERE rowid = ?", (body, row[0]))
+
+    def _remove_note(self, conn: sqlite3.Connection, note_path: str) -> None:
+        row = conn.execute(
+            "SELECT id FROM note_ids WHERE note_path = ?", (note_path,)
+        ).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM notes WHERE rowid = ?", (row[0],))
+            conn.execute("DELETE FROM note_ids WHERE note_path = ?", (note_path,))
+
+
+def _indexed_commit(conn: sqlite3.Connection) -> str | None:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'commit'").fetchone()
+    return row[0] if row else None
+
+
+def _to_match_expression(query: str) -> str:
+    """Quotes every term, so user input is never parsed as FTS5 syntax."""
+    terms = [term.replace('"', '""') for term in query.split()]
+    return " ".join(f'"{term}"' for term in terms if term)
+
+
+def update_index(repo_path: str) -> None:
+    """Called by write paths after MAIN_BRANCH moved; no-op until the index exists."""
+    index = SearchIndex(repo_path)
+    if index.exists():
+        index.sync()
+
+
+@click.command("rebuild-search-index")
+@click.argument("repo_path", required=False)
+def rebuild_search_index_command(repo_path: str | None) -> None:
+    """Rebuilds the full-text search index of REPO_PATH from scratch."""
+    try:
+        commit_id = SearchIndex(repo_path or settings.REPO_PATH).rebuild()
+    except LogicalError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"search index rebuilt at {commit_id}")
@@ -1,19 +1,175 @@
-from dataclasses import dataclass
+"""Request models of the API.
 
+Every endpoint validates its query string or JSON body with one of these
+models before any git command runs, so malformed input costs no
+subprocesses. JSON bodies are parsed straight from the raw request bytes
+with model_validate_json, without building an intermediate dict.
 
-@dataclass
-class UpdateNoteInput:
-    repo_name: str
-    note_path: str
-    note_value: str
-    branch_name: str
-    commit_id: str
+Note paths are normalized and confined to the work tree: absolute paths,
+`..` components, control characters and anything inside `.git` are rejected.
 
+Typical usage example:
+    input_ = UpdateNoteInput.model_validate_json(request.get_data(cache=False))
+    query = NoteQuery.model_validate(request.args.to_dict())
+"""
 
-@dataclass
-class DeleteNoteInput:
-    repo_name: str
-    note_path: str
-    branch_name: str
+from typing import Annotated
 
+from pydantic import AfterValidator, AliasChoices, BaseModel, ConfigDict, Field, StringConstraints
 
+from app.archives import ARCHIVE_FORMATS
+from config import settings
+
+MAX_PATH_LENGTH = 4096
+MAX_QUERY_LENGTH = 1024
+
+
+def normalize_note_path(value: str) -> str:
+    """Canonical form of a note path, raising ValueError for paths outside the work tree."""
+    # A newline would split a `git cat-file --batch` request in two.
+    if any(ord(char) < 0x20 or char == "\x7f" for char in value):
+        raise ValueError("path contains a control character")
+    if value.startswith("/"):
+        raise ValueError("path must be relative to the repository")
+    parts = [part for part in value.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError("path must not contain '..'")
+    if any(part.lower() == ".git" for part in parts):
+        raise ValueError("path must not point into .git")
+    return "/".join(parts)
+
+
+def _not_empty(value: str) -> str:
+    if not value:
+        raise ValueError("path must not be empty")
+    return value
+
+
+def _check_revision(value: str) -> str:
+    # A leading "-" would be taken for a git option.
+    if value.startswith("-") or ".." in value:
+        raise ValueError("not a valid branch name or commit id")
+    return value
+
+
+DirPath = Annotated[str, StringConstraints(max_length=MAX_PATH_LENGTH),
+                    AfterValidator(normalize_note_path)]
+NotePath = Annotated[DirPath, AfterValidator(_not_empty)]
+# Branch name or commit id, within the characters git allows in ref names.
+Revision = Annotated[str, StringConstraints(min_length=1, max_length=255,
+                                            pattern=r"^[^\x00-\x20~^:?*\[\\\x7f]+$"),
+                     AfterValidator(_check_revision)]
+CommitId = Annotated[str, StringConstraints(pattern=r"^(?:[0-9a-f]{40}|[0-9a-f]{64})$")]
+RepoName = Annotated[
+    Annotated[str, StringConstraints(max_length=MAX_PATH_LENGTH, pattern=r"^[^\x00]*$")] | None,
+    # repo_path is what older clients send.
+    Field(default=None, validation_alias=AliasChoices("repo_name", "repo_path")),
+]
+
+
+def _check_note_size(value: str) -> str:
+    # Bytes as stored, against the limit in force now rather than at import.
+    if len(value.encode()) > settings.MAX_NOTE_BYTES:
+        raise ValueError(f"note must not exceed {settings.MAX_NOTE_BYTES} bytes")
+    return value
+
+
+NoteValue = Annotated[str, AfterValidator(_check_note_size)]
+
+
+def _archive_format(value: str) -> str:
+    if value not in ARCHIVE_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(ARCHIVE_FORMATS)}")
+    return value
+
+
+ArchiveFormat = Annotated[str, Field(validation_alias="format"), AfterValidator(_archive_format)]
+
+
+class RequestModel(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
+
+class NoteNamesQuery(RequestModel):
+    repo_name: RepoName
+    branch_name: Revision
+
+
+class NoteQuery(NoteNamesQuery):
+    note_path: NotePath
+
+
+class TreeQuery(NoteNamesQuery):
+    path: DirPath = ""
+    depth: int = Field(default=1, ge=1)
+
+
+class CreateNoteInput(RequestModel):
+    repo_name: RepoName
+    note_path: NotePath
+    note_value: NoteValue
+
+
+class UpdateNoteInput(CreateNoteInput):
+    branch_name: Revision
+    commit_id: CommitId
+
+
+class DeleteNoteInput(RequestModel):
+    repo_name: RepoName
+    note_path: NotePath
+    branch_name: Revision
+
+
+class SearchQuery(RequestModel):
+    repo_name: RepoName
+    q: str = Field(min_length=1, max_length=MAX_QUERY_LENGTH)
+    limit: int = Field(default=20, ge=1)
+
+
+class NoteHistoryQuery(NoteQuery):
+    cursor: CommitId | None = None
+    limit: int = Field(default=50, ge=1)
+
+
+class NoteBlameQuery(NoteQuery):
+    commit_id: CommitId | None = None
+    cursor: int = Field(default=0, ge=0)
+    limit: int = Field(default=500, ge=1)
+
+
+class DiffQuery(RequestModel):
+    repo_name: RepoName
+    from_: Revision = Field(validation_alias="from")
+    to: Revision
+    patch: bool = False
+
+
+class PutNoteRawQuery(RequestModel):
+    repo_name: RepoName
+    note_path: NotePath
+    commit_id: CommitId
+
+
+class ExportQuery(NoteNamesQuery):
+    commit_id: CommitId | None = None
+    fmt: ArchiveFormat = "tar"
+
+
+class ImportQuery(RequestModel):
+    repo_name: RepoName
+    fmt: ArchiveFormat = "tar"
+    replace: bool = False
+
+
+class RepoQuery(RequestModel):
+    repo_name: RepoName
+
+
+class JournalQuery(RepoQuery):
+    seq: int | None = Field(default=None, ge=0)
+
+
+class ProfileQuery(RequestModel):
+    seconds: float | None = Field(default=None, ge=0)
+    requests: int | None = Field(default=None, ge=0)
@@ -5,64 +5,171 @@ Typical usage example:
     create_or_checkout_to_conflict_branch(GitCommander, 
 """
 
-from .utils import GitCommander
+import contextlib
+import json
+import os
+from typing import Iterator
+
+from .utils import GitCommander, refresh_commit_graph
+from .cache import history_cache
 from .exceptions import LogicalError
 from config import settings
 from app.cps import mask_conflicts
+from app.warmup import get_access_log
+from app.search import SearchIndex, update_index
+from app.archives import export_archive, import_archive, spool_upload
+from app.conflicts import ConflictSession, ConflictSessions
+from app.singleflight import reads
+from app.backends import get_backend
+from app.lfs import open_note, parse_pointer, store_note
+from app.journal import Journal, get_journal
+from app.acl import NONE, WRITE, AccessDeniedError, AclIndex, get_acl
+
+
+MAX_FAST_FORWARD_ATTEMPTS = 5
 
 
-def get_note(repo_path: str, note_path: str, branch_name: str):
+def get_note(repo_path: str, note_path: str, branch_name: str, user: str | None = None):
     """Gives note value.
  
     Args:
+        user: readonly and access are evaluated for this user, see app.acl.
 
     Returns:
+        dictionary with the note, its readonly flag and the commit id. Large
+        and non-UTF-8 notes come with note None, large or binary set and
+        their size; their content is only served by /apiv1/note-raw.
 
     Raises:
+        AccessDeniedError: The user may not read the note.
     """
-    git = GitCommander(repo_path)
-    git.file_exists(note_path, branch_name)
-    note = git.show_file(note_path, branch_name)
-
-    readonly = False  # TODO: implement, when we will have users
-
-    return {
+    backend = get_backend(repo_path)
+
+    def load():
+        commit_id = backend.resolve_ref(branch_name)
+        if commit_id is None:
+            raise LogicalError(f"branch does not exist - {branch_name}")
+        content = backend.read_blob(note_path, commit_id)
+        try:
+            note = content.decode()
+        except UnicodeDecodeError:
+            note = None
+        return note, parse_pointer(content), len(content), commit_id
+
+    # Concurrent reads of the same note share one git lookup.
+    key = ("get-note", os.path.abspath(repo_path), branch_name, note_path)
+    note, pointer, size, commit_id = reads.do(key, load)
+    access = get_acl(repo_path, commit_id).access(user, note_path)
+    if access == NONE:
+        raise AccessDeniedError(f"no access to {note_path}")
+    if backend.has_worktree:
+        get_access_log(repo_path).record(note_path)
+
+    readonly = access != WRITE
+
+    data = {
             "note": note,
             "readonly": readonly,
-            "commit_id": git.get_commit_id(branch_name),
+            "commit_id": commit_id,
         }
+    if pointer is not None:  # content is only served by /apiv1/note-raw
+        data.update(note=None, large=True, size=pointer[1])
+    elif note is None:
+        data.update(binary=True, size=size)
+    return data
 
 
-def get_note_names(repo_path: str, branch_name: str):
+def get_note_names(repo_path: str, branch_name: str, user: str | None = None):
     """Gives all files present in given repo.
     
     Args:
+        user: only notes readable by this user are listed, see app.acl.
 
     Returns:
 
     Raises:
 
     """
-    git = GitCommander(repo_path)
-    if not git.branch_exists(branch_name):
-        raise LogicalError(f"branch does not exist - {branch_name}")
+    backend = get_backend(repo_path)
+
+    def load():
+        commit_id = backend.resolve_ref(branch_name)
+        if commit_id is None:
+            raise LogicalError(f"branch does not exist - {branch_name}")
+        return commit_id, backend.list_tree(commit_id)
 
-    if branch_name != git.get_current_branch():
-        git.checkout_branch(branch_name)
+    commit_id, files = reads.do(("get-note-names", os.path.abspath(repo_path), branch_name), load)
+    files = get_acl(repo_path, commit_id).filter(user, files)
 
-    files = git.list_files(branch_name)
-    git.checkout_branch(settings.MAIN_BRANCH)
+    return {"branch_name": branch_name, "notes": list(files)}
 
-    return {"branch_name": branch_name, "notes": files}
 
+def get_tree(repo_path: str, branch_name: str, dir_path: str, depth: int,
+             user: str | None = None) -> dict:
+    """Gives depth levels of the note hierarchy below dir_path.
 
-def create_note(repo_path: str, note_path: str, note_value: str) -> dict:
+    Args:
+        repo_path: -
+        branch_name: branch or commit id.
+        dir_path: directory to list, empty for the root.
+        depth: number of levels to expand, 1 lists dir_path only.
+        user: only entries readable by this user are listed, see app.acl.
+
+    Returns:
+        dictionary with the commit id, the directory's tree id and note count and its entries.
+        Counts are None for directories with notes hidden from some users.
+
+    Raises:
+        LogicalError: dir_path is not a directory at branch_name.
+        AccessDeniedError: The user may not read anything in dir_path.
+    """
+    git = GitCommander(repo_path)
+    commit_id = git.get_commit_id(branch_name)
+    dir_path = dir_path.strip("/")
+    tree_id = git.get_tree_id(dir_path, commit_id)
+    if tree_id is None:
+        raise LogicalError(f"directory does not exist - {branch_name}:{dir_path}")
+    acl = get_acl(repo_path, commit_id)
+    if not acl.visible(user, dir_path):
+        raise AccessDeniedError(f"no access to {dir_path}")
+
+    return {
+        "commit_id": commit_id,
+        "path": dir_path,
+        "tree_id": tree_id,
+        "count": git.tree_snapshot(tree_id)["count"] if acl.uniform(dir_path) else None,
+        "entries": _tree_entries(git, tree_id, dir_path, depth, acl, user),
+    }
+
+
+def _tree_entries(git: GitCommander, tree_id: str, dir_path: str, depth: int,
+                  acl: AclIndex, user: str | None) -> list[dict]:
+    entries = []
+    for name, kind, oid, *count in git.tree_snapshot(tree_id)["entries"]:
+        path = f"{dir_path}/{name}" if dir_path else name
+        if kind == "blob":
+            if acl.empty or acl.access(user, path) != NONE:
+                entries.append({"name": name, "path": path, "type": kind, "blob_id": oid})
+            continue
+        if not acl.empty and not acl.visible(user, path):
+            continue
+        entry = {"name": name, "path": path, "type": kind, "tree_id": oid,
+                 "count": count[0] if acl.uniform(path) else None}
+        if depth > 1:
+            entry["entries"] = _tree_entries(git, oid, path, depth - 1, acl, user)
+        entries.append(entry)
+    return entries
+
+
+def create_note(repo_path: str, note_path: str, note_value: str,
+                user: str | None = None) -> dict:
     """Creates note in given repo.
 
     Args:
         repo_path: -
         note_path: -
         note_value: -
+        user: works in the user's own worktree, see _user_worktree.
 
     Returns:
         dictionary with status code and corresponding message.
@@ -73,41 +180,48 @@ def create_note(repo_path: str, note_path: str, note_value: str) -> dict:
         LogicalError: Unexpected confilcts emerged.
 
     """
-    git = GitCommander(repo_path)
     if not note_path or not note_value:
         return {"status": 400, "message": "Missing required parameters"}
+    _check_writable(repo_path, user, note_path)
+    if not get_backend(repo_path).has_worktree:
+        _commit_without_worktree(repo_path, note_path, note_value, f"create {note_path}")
+        return {"status": 201, "message": "created"}
 
-    branch_name = f"user-{note_path}"
-
-    if git.branch_exists(branch_name):
-        raise LogicalError(f"branch name already exists - {branch_name}")
+    with _user_worktree(repo_path, user, note_path) as git:
+        branch_name = f"user-{note_path}"
 
-    git.create_branch(branch_name)
-    git.write_note(note_path, note_value)
-    git.add_file(note_path)
-    git.commit(msg=f"update {note_path}")
+        if git.branch_exists(branch_name):
+            raise LogicalError(f"branch name already exists - {branch_name}")
 
-    conflict = git.merge(settings.MAIN_BRANCH)
-    if conflict:
-        mask_conflicts(repo_path, note_path)
+        git.create_branch(branch_name)
+        git.write_note(note_path, note_value)
         git.add_file(note_path)
-        git.commit(msg=f"conflict with {note_path}")
-        git.merge(settings.MAIN_BRANCH)
+        git.commit(msg=f"update {note_path}")
+
+        conflict = git.merge(settings.MAIN_BRANCH)
+        if conflict:
+            ConflictSessions(git).open(note_path, branch_name, settings.MAIN_BRANCH)
+            mask_conflicts(git.repo_path, note_path)
+            git.add_file(note_path)
+            git.commit(msg=f"conflict with {note_path}")
+            git.merge(settings.MAIN_BRANCH)
+            if git.is_user_worktree:
+                _checkout_main(git)
 
-        note_value = git.show_file(note_path, settings.MAIN_BRANCH)
-        return {"status": 201, "message": "conflict", "note": note_value}
+            note_value = git.show_file(note_path, settings.MAIN_BRANCH)
+            return {"status": 201, "message": "conflict", "note": note_value}
 
-    git.checkout_branch(settings.MAIN_BRANCH)
-    conflict = git.merge(branch_name)
-    if conflict:
-        raise LogicalError(f"Unexpected conflicts while merging {branch_name} into master")
-    git.delete_branch(branch_name)
+        conflict = _merge_into_main(git, branch_name)
+        if conflict:
+            raise LogicalError(f"Unexpected conflicts while merging {branch_name} into master")
+        git.delete_branch(branch_name)
+        update_index(repo_path)
 
-    return {"status": 201, "message": "created"}
+        return {"status": 201, "message": "created"}
 
 
 def update_note(repo_path: str, branch_name: str, commit_id: str,
-                note_path: str, note_value:str) -> tuple:
+                note_path: str, note_value:str, user: str | None = None) -> tuple:
     """Updates note in given repo.
     If not on conflict branch -> creates new branch from given commit id.
     If on conflict branch and on last commit -> checkout to that branch. 
@@ -117,6 +231,7 @@ def update_note(repo_path: str, branch_name: str, commit_id: str,
         branch_name: branch_name from the user.
         commit_id: commit_id from the user.
         note_path: path to the note.
+        user: works in the user's own worktree, see _user_worktree.
 
     Returns:
         status code, note value, branch name, commit id
@@ -125,85 +240,689 @@ def update_note(repo_path: str, branch_name: str, commit_id: str,
         LogicalError: Given branch name does not exist. 
         LogicalError: New branch name already exists.
         LogicalError: User commit id is behind HEAD.
+        AccessDeniedError: The user may not change the note.
+    """
+    _check_writable(repo_path, user, note_path)
+
+    if not get_backend(repo_path).has_worktree:
+        git = GitCommander(repo_path)
+        # Without a repository only the compare-and-swap on HEAD is possible.
+        fast_result = None
+        if branch_name == settings.MAIN_BRANCH:
+            fast_result = _update_note_on_head(git, commit_id, note_path, note_value)
+        if fast_result is None:
+            raise LogicalError(
+                f"update needs a branch and merge, unsupported by {settings.STORAGE_BACKEND} backend"
+            )
+        return fast_result
+
+    with _user_worktree(repo_path, user, note_path) as git:
+        sessions = ConflictSessions(git)
+        session = sessions.get(branch_name)
+        on_conflict_branch = session is not None or git.is_conflict_branch(branch_name)
+        not_head_commit = commit_id != git.get_commit_id(branch_name)
+
+        if not git.branch_exists(branch_name):
+            raise LogicalError(f"branch name does not exist - {branch_name}")
+
+        if not on_conflict_branch and branch_name == settings.MAIN_BRANCH:
+            fast_result = _update_note_on_head(git, commit_id, note_path, note_value)
+            if fast_result is not None:
+                return fast_result
+
+        if not on_conflict_branch:
+            branch_name = f"user-{note_path}"
+    
+            if git.branch_exists(branch_name):
+                raise LogicalError(f"branch name already exists - {branch_name}")
+        
+            git.checkout_branch(commit_id)
+            git.create_branch(branch_name)
+        elif not_head_commit:  # avoid fixing conflicts based on older commit
+            raise LogicalError(
+                "REQUEST_STATE_OUTDATED Incoming changes against older commit "
+                "- conflict resolution supported only against branch HEAD."
+            )
+        else:  # on conflict branch and on head (can resolve conflicts)
+            if session is not None and session.note_path == note_path:
+                resolved = _resolve_conflict_on_head(git, sessions, session, note_value)
+                if resolved is not None:
+                    return resolved
+            git.checkout_branch(branch_name)
+    
+        git.write_note(note_path, note_value)
+        git.add_file(note_path)
+        git.commit(msg=f"update {note_path}")
+
+        conflict = git.merge(settings.MAIN_BRANCH)
+        if conflict:
+            if session is None:
+                sessions.open(note_path, branch_name, settings.MAIN_BRANCH)
+            else:  # MAIN_BRANCH changed the note again during resolution
+                session.theirs_id = git.get_blob_id(note_path, "MERGE_HEAD")
+                session.main_commit = git.get_commit_id("MERGE_HEAD")
+                session.rounds += 1
+                sessions.save(session)
+            mask_conflicts(git.repo_path, note_path)
+            git.add_file(note_path) 
+            git.commit(msg=f"gonflict with {note_path}")
+            _checkout_main(git)
+
+            return ("conflict", git.show_file(note_path, branch_name),
+                    branch_name, git.get_commit_id(branch_name))
+
+        conflict_on_main = _merge_into_main(git, branch_name)
+        if conflict_on_main:
+            raise LogicalError(f"Unexpected conflicts while merging {branch_name} into {settings.MAIN_BRANCH}")
+    
+        if branch_name == "master":
+            raise LogicalError("Unexpected branch: cannot delete master")
+
+        git.delete_branch(branch_name)
+        sessions.close(branch_name)
+        update_index(repo_path)
+        return ("ok", git.show_file(note_path, settings.MAIN_BRANCH),
+                settings.MAIN_BRANCH,git.get_commit_id("HEAD"))
+
+
+def _update_note_on_head(git: GitCommander, commit_id: str, note_path: str,
+                         note_value: str) -> tuple | None:
+    """Commits the note directly on top of MAIN_BRANCH HEAD, if that cannot conflict.
+
+    That is the case when the note is unchanged between the client's commit
+    and HEAD.
+
+    Returns:
+        the same tuple as update_note, or None if the fast path does not apply.
     """
+    backend = get_backend(git.repo_path)
+    head = backend.resolve_ref(settings.MAIN_BRANCH)
+    if commit_id != head and backend.blob_id(note_path, commit_id) != backend.blob_id(note_path, head):
+        return None
 
+    new_head = _commit_note_on_head(git, head, note_path, note_value, f"update {note_path}")
+    if new_head is None:
+        return None
+    return ("ok", note_value, settings.MAIN_BRANCH, new_head)
+
+
+def _resolve_conflict_on_head(git: GitCommander, sessions: ConflictSessions,
+                              session: ConflictSession, note_value: str) -> tuple | None:
+    """Applies a conflict resolution directly on MAIN_BRANCH HEAD.
+
+    The conflict branch already contains MAIN_BRANCH as of the session
+    start, so if MAIN_BRANCH has not touched the note since, the resolved
+    value is final and neither checkout nor merge is needed.
+
+    Returns:
+        the same tuple as update_note, or None if MAIN_BRANCH changed the note again.
+    """
+    head = git.get_commit_id(settings.MAIN_BRANCH)
+    if git.get_blob_id(session.note_path, head) != session.theirs_id:
+        return None
+
+    new_head = _commit_note_on_head(git, head, session.note_path, note_value,
+                                    f"resolve conflict in {session.note_path}")
+    if new_head is None:
+        return None
+
+    git.delete_branch(session.branch_name, force=True)
+    sessions.close(session.branch_name)
+    return ("ok", note_value, settings.MAIN_BRANCH, new_head)
+
+
+def _commit_note_on_head(git: GitCommander, head: str, note_path: str,
+                         note_value: str, msg: str) -> str | None:
+    """Commits note_value on top of head and moves MAIN_BRANCH there.
+
+    MAIN_BRANCH is moved with a compare-and-swap, so a concurrent writer
+    makes this return None and the caller falls back to the branch-and-merge
+    flow.
+
+    Returns:
+        new MAIN_BRANCH commit id, or None if MAIN_BRANCH moved away from head.
+    """
+    backend = get_backend(git.repo_path)
+    data = note_value.encode()
+    if backend.blob_id(note_path, head) is not None and backend.read_blob(note_path, head) == data:
+        return head
+
+    new_head = backend.write_commit(head, {note_path: data}, msg=msg)
+    if not backend.has_worktree:
+        return new_head if backend.cas_ref(settings.MAIN_BRANCH, new_head, head) else None
+
+    with GitCommander(git.main_repo_path).worktree_lock():
+        if not backend.cas_ref(settings.MAIN_BRANCH, new_head, head):
+            return None
+        _sync_main_worktree(git, head, new_head)
+    update_index(git.repo_path)
+    return new_head
+
+
+def _commit_without_worktree(repo_path: str, note_path: str, note_value: str | None,
+                             msg: str) -> str:
+    """Creates, or deletes with note_value None, a note on MAIN_BRANCH HEAD of a
+    backend without a repository, with a compare-and-swap like the fast update path.
+
+    Returns:
+        new MAIN_BRANCH commit id.
+
+    Raises:
+        LogicalError: The note already exists (create) or does not (delete).
+        LogicalError: MAIN_BRANCH kept moving.
+    """
+    backend = get_backend(repo_path)
+    for _ in range(MAX_FAST_FORWARD_ATTEMPTS):
+        head = backend.resolve_ref(settings.MAIN_BRANCH)
+        exists = backend.blob_id(note_path, head) is not None
+        if note_value is not None and exists:
+            raise LogicalError(
+                f"create of an existing note needs a branch and merge, "
+                f"unsupported by {settings.STORAGE_BACKEND} backend"
+            )
+        if note_value is None and not exists:
+            raise LogicalError(f"note does not exist - {settings.MAIN_BRANCH}:{note_path}")
+
+        data = note_value.encode() if note_value is not None else None
+        new_head = backend.write_commit(head, {note_path: data}, msg=msg)
+        if backend.cas_ref(settings.MAIN_BRANCH, new_head, head):
+            return new_head
+    raise LogicalError(f"{settings.MAIN_BRANCH} keeps moving, could not commit {note_path}")
+
+
+def _check_writable(repo_path: str, user: str | None, note_path: str) -> None:
+    """Raises AccessDeniedError unless the MAIN_BRANCH rules let user change the note."""
+    head = get_backend(repo_path).resolve_ref(settings.MAIN_BRANCH)
+    if head is not None and get_acl(repo_path, head).access(user, note_path) != WRITE:
+        raise AccessDeniedError(f"{note_path} is readonly")
+
+
+def _check_readable(repo_path: str, commit_id: str, user: str | None, note_path: str) -> None:
+    """Raises AccessDeniedError unless the rules at commit_id let user read the note."""
+    if get_acl(repo_path, commit_id).access(user, note_path) == NONE:
+        raise AccessDeniedError(f"no access to {note_path}")
+
+
+@contextlib.contextmanager
+def _user_worktree(repo_path: str, user: str | None, note_path: str) -> Iterator[GitCommander]:
+    """Commander of the worktree the branch-and-merge flow of a user runs in,
+    locked for the flow.
+
+    With USER_WORKTREES every user gets a sparse worktree of their own, so
+    writes of different users do not share one checked out HEAD and run in
+    parallel; they only take turns on MAIN_BRANCH, see _merge_into_main. It
+    is reset to MAIN_BRANCH, with the note's directory checked out. Other
+    writes all run in the main worktree, one at a time.
+    """
     git = GitCommander(repo_path)
-    on_conflict_branch = git.is_conflict_branch(branch_name)
-    not_head_commit = commit_id != git.get_commit_id(branch_name)
+    if settings.USER_WORKTREES and user:
+        git = git.switch_user(user, settings.MAIN_BRANCH)
+    with git.worktree_lock():
+        if git.is_user_worktree:
+            git.abort_merge()  # left over by a request that failed half way
+            git.detach(settings.MAIN_BRANCH, force=True)
+            git.sparse_checkout_add(note_path)
+        yield git
+
+
+def _checkout_main(git: GitCommander) -> None:
+    """Leaves the user branch; user worktrees detach, as MAIN_BRANCH is checked
+    out in the main worktree."""
+    if git.is_user_worktree:
+        git.detach(settings.MAIN_BRANCH)
+    else:
+        git.checkout_branch(settings.MAIN_BRANCH)
 
-    if not git.branch_exists(branch_name):
-        raise LogicalError(f"branch name does not exist - {branch_name}")
 
-    if not on_conflict_branch:
-        branch_name = f"user-{note_path}"
-    
-        if git.branch_exists(branch_name):
-            raise LogicalError(f"branch name already exists - {branch_name}")
-        
-        git.checkout_branch(commit_id)
-        git.create_branch(branch_name)
-    elif not_head_commit:  # avoid fixing conflicts based on older commit
-        raise LogicalError(
-            "REQUEST_STATE_OUTDATED Incoming changes against older commit "
-            "- conflict resolution supported only against branch HEAD."
-        )
-    else:  # on conflict branch and on head (can resolve conflicts)
-        git.checkout_branch(branch_name)
-    
-    git.write_note(note_path, note_value)
-    git.add_file(note_path)
-    git.commit(msg=f"update {note_path}")
+def _merge_into_main(git: GitCommander, branch_name: str) -> bool:
+    """Merges branch_name, which already contains MAIN_BRANCH, into MAIN_BRANCH.
+
+    From a user worktree MAIN_BRANCH is fast-forwarded with a compare-and-swap
+    and the main worktree synced, merging MAIN_BRANCH into the branch again
+    when another writer moved it in between.
 
-    conflict = git.merge(settings.MAIN_BRANCH)
-    if conflict:
-        mask_conflicts(repo_path, note_path)
-        git.add_file(note_path) 
-        git.commit(msg=f"gonflict with {note_path}")
+    Returns:
+        True on conflicts.
+    """
+    if not git.is_user_worktree:
         git.checkout_branch(settings.MAIN_BRANCH)
+        return git.merge(branch_name)
+
+    for _ in range(MAX_FAST_FORWARD_ATTEMPTS):
+        head = git.get_commit_id(settings.MAIN_BRANCH)
+        if not git.is_ancestor(head, branch_name) and git.merge(settings.MAIN_BRANCH):
+            git.abort_merge()
+            return True
+
+        new_head = git.get_commit_id(branch_name)
+        with GitCommander(git.main_repo_path).worktree_lock():
+            moved = git.update_ref(settings.MAIN_BRANCH, new_head, head)
+            if moved:
+                _sync_main_worktree(git, head, new_head)
+        if moved:
+            git.detach(new_head)
+            return False
+    raise LogicalError(f"{settings.MAIN_BRANCH} keeps moving, could not merge {branch_name}")
+
+
+def _sync_main_worktree(git: GitCommander, old_commit: str, new_commit: str) -> None:
+    """Brings the main worktree from old_commit to new_commit.
+
+    Callers moving MAIN_BRANCH hold the main worktree lock from the
+    compare-and-swap on, so worktree syncs happen in the order of the moves.
+    """
+    main = GitCommander(git.main_repo_path)
+    with main.worktree_lock():
+        if main.get_current_branch() == settings.MAIN_BRANCH:
+            main.sync_worktree(old_commit, new_commit)
+
+
+def delete_note(repo_path: str, note_path: str, branch_name: str, user: str | None = None):
+    _check_writable(repo_path, user, note_path)
+    if not get_backend(repo_path).has_worktree:
+        if branch_name != settings.MAIN_BRANCH:
+            raise LogicalError(
+                f"delete needs a branch and merge, unsupported by {settings.STORAGE_BACKEND} backend"
+            )
+        _commit_without_worktree(repo_path, note_path, None, f"deleted {note_path}")
+        return "ok", None
+
+    with _user_worktree(repo_path, user, note_path) as git:
+        git.file_exists(note_path, branch_name)
+
+        branch_name = f"user-delete-{note_path}"
+        git.create_branch(branch_name)
 
-        return ("conflict", git.show_file(note_path, branch_name),
-                branch_name, git.get_commit_id(branch_name))
+        git.delete_file(note_path)
+        git.commit(msg=f"deleted {note_path}")
 
-    git.checkout_branch(settings.MAIN_BRANCH)
-    conflict_on_main = git.merge(branch_name)
-    if conflict_on_main:
-        raise LogicalError(f"Unexpected conflicts while merging {branch_name} into {settings.MAIN_BRANCH}")
-    
-    if branch_name == "master":
-        raise LogicalError("Unexpected branch: cannot delete master")
+        conflict = git.merge(settings.MAIN_BRANCH)
+        if conflict:
+            ConflictSessions(git).open(note_path, branch_name, settings.MAIN_BRANCH)
+            mask_conflicts(git.repo_path, note_path)
+            git.add_file(note_path)
+            git.commit(msg=f"conflict with deletion of {note_path}")
+            if git.is_user_worktree:
+                _checkout_main(git)
 
-    git.delete_branch(branch_name)
-    return ("ok", git.show_file(note_path, settings.MAIN_BRANCH),
-            settings.MAIN_BRANCH,git.get_commit_id("HEAD"))
+            note_value = git.show_file(note_path, settings.MAIN_BRANCH)
+            return "conflict", note_value
 
+        conflict_on_main = _merge_into_main(git, branch_name)
+        if conflict_on_main:
+            raise LogicalError(f"Unexpected conflicts while merging {branch_name} into {settings.MAIN_BRANCH}.")
 
-def delete_note(repo_path: str, note_path: str, branch_name: str):
+        git.delete_branch(branch_name)
+        update_index(repo_path)
+
+        return "ok", None
+
+
+def search_notes(repo_path: str, query: str, limit: int, user: str | None = None) -> dict:
+    """Full-text search over MAIN_BRANCH notes.
+
+    Args:
+        repo_path: -
+        query: whitespace separated terms, all of them must match.
+        limit: maximum number of results.
+        user: only notes readable by this user are returned, see app.acl.
+
+    Returns:
+        dictionary with the searched commit id and matching notes with snippets.
+    """
+    index = SearchIndex(repo_path)
+    commit_id = index.git.get_commit_id(settings.MAIN_BRANCH)
+    acl = get_acl(repo_path, commit_id)
+    fetch = limit
+    while True:
+        results = index.search(query, fetch)
+        readable = [result for result in results
+                    if acl.empty or acl.access(user, result["note_path"]) != NONE]
+        if len(readable) >= limit or len(results) < fetch:
+            break
+        fetch *= 4  # hidden notes took some of the places
+    return {"commit_id": commit_id, "notes": readable[:limit]}
+
+
+def get_note_history(repo_path: str, note_path: str, branch_name: str,
+                     cursor: str | None, limit: int, user: str | None = None) -> dict:
+    """Gives one page of commits touching the note, newest first.
+
+    Pages are keyed by the commit they start from, the last commit that
+    changed the note for the first page, so they are cached without
+    invalidation and survive commits to other notes.
+
+    Args:
+        cursor: commit id to start from, `next_cursor` of the previous page.
+        limit: page size.
+
+    Returns:
+        dictionary with commits and the cursor of the next page (None on the last page).
+
+    Raises:
+        AccessDeniedError: The user may not read the note.
+    """
     git = GitCommander(repo_path)
-    git.file_exists(note_path, branch_name)
+    head = cursor or git.get_commit_id(branch_name)
+    _check_readable(repo_path, head, user, note_path)
+    # A cursor is a commit that changed the note already.
+    start = cursor or _last_commit(git, note_path, head)
+    if start is None:
+        return {"commits": [], "next_cursor": None}
 
-    branch_name = f"user-delete-{note_path}"
-    git.create_branch(branch_name)
+    cache_key = f"history:{git.get_git_dir()}:{start}:{limit}:{note_path}"
+    cached = history_cache.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
 
-    git.delete_file(note_path)
-    git.commit(msg=f"deleted {note_path}")
+    commits = git.log_file(note_path, start, limit + 1)
+    page = {
+        "commits": commits[:limit],
+        "next_cursor": commits[limit]["commit_id"] if len(commits) > limit else None,
+    }
+    history_cache.set(cache_key, json.dumps(page).encode())
+    return page
 
-    conflict = git.merge(settings.MAIN_BRANCH)
-    if conflict:
-        mask_conflicts(repo_path, note_path)
-        git.add_file(note_path)
-        git.commit(msg=f"conflict with deletion of {note_path}")
 
-        note_value = git.show_file(note_path, settings.MAIN_BRANCH)
-        return "conflict", note_value
+def get_diff(repo_path: str, from_: str, to: str, patch: bool, user: str | None = None) -> dict:
+    """Gives the notes changed between two commits or branches, renames detected.
+
+    Diffs are cached by resolved commit pair, so clients catching up from the
+    same commit share one diff-tree run.
 
-    git.checkout_branch(settings.MAIN_BRANCH)
-    conflict_on_main = git.merge(branch_name)
-    if conflict_on_main:
-        raise LogicalError(f"Unexpected conflicts while merging {branch_name} into {settings.MAIN_BRANCH}.")
+    Args:
+        from_: branch or commit id the client has.
+        to: branch or commit id to catch up to.
+        patch: whether to include a unified patch per change.
 
-    git.delete_branch(branch_name)
+    Returns:
+        dictionary with both commit ids and the changes, each with its status, path and
+        old path of renames.
+    """
+    git = GitCommander(repo_path)
+    from_id, to_id = git.get_commit_id(from_), git.get_commit_id(to)
+
+    def load():
+        cache_key = f"diff:{git.get_git_dir()}:{from_id}:{to_id}:{int(patch)}"
+        cached = history_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+        changes = []
+        for status, note_path, old_path in git.diff_tree(from_id, to_id, renames=True):
+            change = {"status": status[0], "path": note_path, "old_path": old_path}
+            if status[1:]:
+                change["similarity"] = int(status[1:])
+            changes.append(change)
+        diff = {"changes": changes, "patch_truncated": False}
+        if patch:
+            patches = git.diff_patches(from_id, to_id, renames=True)
+            if sum(map(len, patches)) > settings.DIFF_MAX_PATCH_BYTES or len(patches) != len(changes):
+                diff["patch_truncated"] = True
+            else:
+                for change, text in zip(changes, patches):
+                    change["patch"] = text
+        history_cache.set(cache_key, json.dumps(diff).encode())
+        return diff
+
+    diff = reads.do(("diff", os.path.abspath(repo_path), from_id, to_id, patch), load)
+    # The old side of a change, renames' old_path included, is read with the ACL it had.
+    from_acl, to_acl = get_acl(repo_path, from_id), get_acl(repo_path, to_id)
+    changes = []
+    for change in diff["changes"]:
+        old_path = change["old_path"] or change["path"]
+        if ((change["status"] != "A" and from_acl.access(user, old_path) == NONE)
+                or (change["status"] != "D" and to_acl.access(user, change["path"]) == NONE)
+                or to_acl.access(user, old_path) == NONE):
+            continue
+        changes.append(change)
+    return {"from": from_id, "to": to_id, "changes": changes,
+            "patch_truncated": diff["patch_truncated"]}
+
+
+def get_note_blame(repo_path: str, note_path: str, branch_name: str,
+                   commit_id: str | None, cursor: int, limit: int,
+                   user: str | None = None) -> dict:
+    """Gives blame of `limit` note lines starting at line index `cursor`.
+
+    Returns:
+        dictionary with the blamed commit id, lines and the cursor of the next page.
+
+    Raises:
+        AccessDeniedError: The user may not read the note.
+    """
+    git = GitCommander(repo_path)
+    commit_id = commit_id or git.get_commit_id(branch_name)
+    _check_readable(repo_path, commit_id, user, note_path)
+    # Blame is the same at every commit up to the next change of the note.
+    last_commit = _last_commit(git, note_path, commit_id)
+    if last_commit is None:
+        raise LogicalError(f"note does not exist - {commit_id}:{note_path}")
+
+    cache_key = f"blame:{git.get_git_dir()}:{last_commit}:{note_path}"
+    cached = history_cache.get(cache_key)
+    if cached is not None:
+        lines = json.loads(cached)
+    else:
+        lines = git.blame(note_path, last_commit)
+        history_cache.set(cache_key, json.dumps(lines).encode())
+
+    end = cursor + limit
+    return {
+        "commit_id": commit_id,
+        "lines": lines[cursor:end],
+        "next_cursor": end if end < len(lines) else None,
+    }
+
+
+def _last_commit(git: GitCommander, note_path: str, commit_id: str) -> str | None:
+    """Last commit up to commit_id that changed the note, cached by commit_id."""
+    refresh_commit_graph(git.repo_path, commit_id, settings.COMMIT_GRAPH_MAX_AGE)
+    cache_key = f"last-commit:{git.get_git_dir()}:{commit_id}:{note_path}"
+    cached = history_cache.get(cache_key)
+    if cached is not None:
+        return cached.decode() or None
+    last_commit = git.get_last_commit(note_path, commit_id)
+    history_cache.set(cache_key, (last_commit or "").encode())
+    return last_commit
+
+
+def export_notes(repo_path: str, branch_name: str, commit_id: str | None, fmt: str,
+                 user: str | None = None) -> tuple:
+    """Streams all notes at commit_id (or branch HEAD) readable by user as one archive.
+
+    Returns:
+        commit id, iterator of archive chunks
+    """
+    git = GitCommander(repo_path)
+    commit_id = git.get_commit_id(commit_id or branch_name)
+    acl = get_acl(repo_path, commit_id)
+    if acl.empty:
+        return export_archive(git, commit_id, fmt)
+    return export_archive(git, commit_id, fmt,
+                          exclude=lambda note_path: acl.access(user, note_path) == NONE)
+
+
+def get_note_raw(repo_path: str, note_path: str, branch_name: str,
+                 user: str | None = None) -> tuple:
+    """Opens a note for streaming, large object store content included.
+
+    Returns:
+        commit id, blob id, content size, iterator of content chunks
 
-    return "ok", None
+    Raises:
+        AccessDeniedError: The user may not read the note.
+    """
+    git = GitCommander(repo_path)
+    commit_id = git.get_commit_id(branch_name)
+    _check_readable(repo_path, commit_id, user, note_path)
+    return (commit_id, *open_note(git, note_path, commit_id))
+
+
+def put_note_raw(repo_path: str, note_path: str, commit_id: str, stream,
+                 user: str | None = None) -> dict:
+    """Streams a note into MAIN_BRANCH, storing large content outside git.
+
+    The note is committed directly on MAIN_BRANCH HEAD; there is no conflict
+    masking for raw content.
+
+    Raises:
+        AccessDeniedError: The user may not change the note.
+        LogicalError: The note changed on MAIN_BRANCH since commit_id.
+        LogicalError: MAIN_BRANCH moved while storing the note.
+    """
+    _check_writable(repo_path, user, note_path)
+    _apply_journal_first(repo_path)
+    git = GitCommander(repo_path)
+    head = git.get_commit_id(settings.MAIN_BRANCH)
+    if commit_id != head and git.get_blob_id(note_path, commit_id) != git.get_blob_id(note_path, head):
+        raise LogicalError(f"REQUEST_STATE_OUTDATED {note_path} changed since {commit_id}")
+
+    blob_id, size, large = store_note(git, stream)
+    new_head = head
+    if blob_id != git.get_blob_id(note_path, head):
+        new_head = git.write_tree_commit(head, {note_path: blob_id}, msg=f"update {note_path}")
+        with git.worktree_lock():
+            if not git.update_ref(settings.MAIN_BRANCH, new_head, head):
+                raise LogicalError(f"REQUEST_STATE_OUTDATED {settings.MAIN_BRANCH} moved while storing {note_path}")
+            _sync_main_worktree(git, head, new_head)
+        update_index(repo_path)
+
+    return {"status": "ok", "branch_name": settings.MAIN_BRANCH, "commit_id": new_head,
+            "size": size, "large": large}
+
+
+def import_notes(repo_path: str, stream, fmt: str, replace: bool, user: str | None = None) -> dict:
+    """Imports an archive into MAIN_BRANCH as a single commit.
+
+    Notes the user may not change are skipped, and kept when replacing.
+
+    Raises:
+        LogicalError: Archive is malformed or has a note above MAX_NOTE_BYTES.
+        LogicalError: MAIN_BRANCH moved while importing.
+    """
+    git = GitCommander(repo_path)
+    with spool_upload(stream) as upload:
+        _apply_journal_first(repo_path)
+        with git.worktree_lock():
+            acl = get_acl(repo_path, git.get_commit_id(settings.MAIN_BRANCH))
+            old_head, new_head, imported, skipped = import_archive(
+                git, upload, fmt, settings.MAIN_BRANCH, replace=replace,
+                may_write=lambda note_path: acl.access(user, note_path) == WRITE,
+            )
+            _sync_main_worktree(git, old_head, new_head)
+    update_index(repo_path)
+
+    return {"status": "ok", "commit_id": new_head, "imported": imported, "skipped": skipped}
+
+
+def list_conflicts(repo_path: str, user: str | None = None) -> dict:
+    """Gives the open conflict sessions of the repo on notes the user may read."""
+    git = GitCommander(repo_path)
+    acl = get_acl(repo_path, git.get_commit_id(settings.MAIN_BRANCH))
+    conflicts = []
+    for session in ConflictSessions(git).list():
+        if acl.access(user, session.note_path) == NONE:
+            continue
+        if not git.branch_exists(session.branch_name):
+            continue  # branch removed outside of the API
+        conflicts.append({
+            "note_path": session.note_path,
+            "branch_name": session.branch_name,
+            "commit_id": git.get_commit_id(session.branch_name),
+            "main_commit": session.main_commit,
+            "created_at": session.created_at,
+            "rounds": session.rounds,
+        })
+    return {"conflicts": conflicts}
+
+
+NOTE_WRITES = {
+    "create": create_note,
+    "update": update_note,
+    "delete": delete_note,
+}
+
+
+def _journaled_create(repo_path: str, note_path: str, note_value: str,
+                      user: str | None = None) -> tuple[str, str | None]:
+    result = create_note(repo_path, note_path, note_value, user)
+    if result["message"] == "conflict":
+        return "conflict", GitCommander(repo_path).get_commit_id(f"user-{note_path}")
+    if result["message"] != "created":
+        raise LogicalError(result["message"])
+    return "ok", GitCommander(repo_path).get_commit_id(settings.MAIN_BRANCH)
+
+
+def _journaled_update(repo_path: str, **args) -> tuple[str, str | None]:
+    status, _, _, commit_id = update_note(repo_path, **args)
+    return status, commit_id
+
+
+def _journaled_delete(repo_path: str, note_path: str, branch_name: str,
+                      user: str | None = None) -> tuple[str, str | None]:
+    status, _ = delete_note(repo_path, note_path, branch_name, user)
+    branch_name = f"user-delete-{note_path}" if status == "conflict" else settings.MAIN_BRANCH
+    return status, GitCommander(repo_path).get_commit_id(branch_name)
+
+
+def get_note_journal(repo_path: str) -> Journal:
+    """Write-ahead journal of the repo, applying entries with the services above.
+
+    Only the status and commit id of an entry are kept, see app.journal.
+    """
+    return get_journal(repo_path, {
+        "create": _journaled_create,
+        "update": _journaled_update,
+        "delete": _journaled_delete,
+    })
+
+
+def submit_note_write(repo_path: str, op: str, **args) -> dict:
+    """Journals a create, update or delete; it is applied asynchronously.
+
+    Returns:
+        dictionary with the entry's sequence number, see get_journal_status.
+    """
+    seq = get_note_journal(repo_path).append(op, args)
+    return {"status": "accepted", "seq": seq}
+
+
+def apply_note_write(repo_path: str, op: str, **args):
+    """Runs a create, update or delete right away, after the journaled ones.
+
+    Returns:
+        what the service of op returns.
+    """
+    _apply_journal_first(repo_path)
+    return NOTE_WRITES[op](repo_path, **args)
+
+
+def _apply_journal_first(repo_path: str) -> None:
+    """Applies journaled writes acknowledged before a write that bypasses the journal.
+
+    Once the journal is caught up, the write runs alongside the applier
+    under the same worktree locks, see _user_worktree.
+    """
+    if not get_backend(repo_path).has_worktree:
+        return  # nothing to journal into
+    journal = get_note_journal(repo_path)
+    if journal.pending():
+        journal.apply_pending()
+
+
+def get_journal_status(repo_path: str, seq: int | None, user: str | None = None) -> dict:
+    """Gives how far the journal is applied and, for seq, the entry's outcome.
+
+    Raises:
+        AccessDeniedError: The user may not read the entry's note.
+    """
+    status = get_note_journal(repo_path).status(seq)
+    note_path = status.get("entry", {}).get("note_path")
+    if note_path is not None:
+        head = get_backend(repo_path).resolve_ref(settings.MAIN_BRANCH)
+        _check_readable(repo_path, head, user, note_path)
+    return status
 
 
 def write_add_commit(git, note_path, note_value):
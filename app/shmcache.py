@@ -0,0 +1,160 @@
+"""Cache segment shared by all worker processes of a node.
+
+The segment is a memory-mapped file (put it on tmpfs, e.g. /dev/shm) with
+a fixed byte budget:
+
+    header | slot table | data ring
+
+Values are appended to the data ring, so the oldest values are evicted
+first. Each key hashes to one slot of the table; a newer key mapping to
+the same slot evicts the older one. Writers serialize on a file lock.
+Readers take no lock: every slot carries a sequence number that is odd
+while the slot is being written (a seqlock). Readers never retry: a torn or
+overwritten read is simply reported as a miss.
+
+The layout version and byte budget are part of the file name, so workers
+started with another version or budget during a rolling restart use a
+file of their own. A file in use is never resized under the workers that
+have it mapped, which would kill them with SIGBUS. Files of old layouts
+are left behind for the workers still using them.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+from app import metrics
+
+MAGIC = 0x574E4348  # "WNCH"
+LAYOUT_VERSION = 1  # bump on any change to the structs or sizes below
+
+_HEADER = struct.Struct("<III4xQQ")  # magic, version, nslots, data size, cursor
+_HEADER_SIZE = 64
+_CURSOR_OFFSET = 24
+_U64 = struct.Struct("<Q")
+_SLOT = struct.Struct("<Q16sQI4x")  # seq, key digest, data position, length
+_SLOT_BYTES_PER_ENTRY = 4096
+
+
+class SharedCache:
+    def __init__(self, path: str, max_bytes: int):
+        nslots = max(64, max_bytes // _SLOT_BYTES_PER_ENTRY)
+        table_size = nslots * _SLOT.size
+        data_size = max_bytes - _HEADER_SIZE - table_size
+        if data_size <= 0:
+            raise ValueError(f"shared cache budget too small - {max_bytes}")
+
+        self.path = f"{path}.v{LAYOUT_VERSION}-{max_bytes}"
+        self.nslots = nslots
+        self.data_size = data_size
+        self.max_value_size = data_size // 4
+        self._data_offset = _HEADER_SIZE + table_size
+        self._write_lock = threading.Lock()
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size == max_bytes and self._header_matches(max_bytes):
+                self._map = mmap.mmap(self._fd, max_bytes)
+            elif size in (0, max_bytes):
+                # New, or its creator died before writing the header: nobody
+                # maps a file without a valid header, and everything past the
+                # header is still zero.
+                os.ftruncate(self._fd, max_bytes)
+                self._map = mmap.mmap(self._fd, max_bytes)
+                _HEADER.pack_into(self._map, 0, MAGIC, LAYOUT_VERSION, nslots, data_size, 0)
+            else:
+                raise ValueError(f"not a shared cache file of this layout - {self.path}")
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _header_matches(self, max_bytes: int) -> bool:
+        with mmap.mmap(self._fd, max_bytes) as existing:
+            header = _HEADER.unpack_from(existing, 0)
+        return header[:4] == (MAGIC, LAYOUT_VERSION, self.nslots, self.data_size)
+
+    def _locked_fd(self) -> int:
+        # flock is held per open file description, which forked workers
+        # would share; every process needs its own descriptor to exclude.
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._pid = os.getpid()
+        return self._fd
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def _slot_offset(self, digest: bytes) -> int:
+        index = int.from_bytes(digest[:8], "little") % self.nslots
+        return _HEADER_SIZE + index * _SLOT.size
+
+    def _cursor(self) -> int:
+        return _U64.unpack_from(self._map, _CURSOR_OFFSET)[0]
+
+    def _is_live(self, position: int, length: int) -> bool:
+        # Data at `position` survives until the ring wraps around onto it.
+        return self._cursor() <= position + self.data_size and length <= self.data_size
+
+    def get(self, key: str) -> bytes | None:
+        digest = self._digest(key)
+        offset = self._slot_offset(digest)
+
+        seq, slot_digest, position, length = _SLOT.unpack_from(self._map, offset)
+        if seq & 1 or slot_digest != digest or not self._is_live(position, length):
+            metrics.inc("shared_cache_miss")
+            return None
+
+        start = self._data_offset + position % self.data_size
+        value = self._map[start:start + length]
+
+        if _SLOT.unpack_from(self._map, offset)[0] != seq or not self._is_live(position, length):
+            metrics.inc("shared_cache_miss")
+            return None
+        metrics.inc("shared_cache_hit")
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        length = len(value)
+        if length > self.max_value_size:
+            return
+
+        digest = self._digest(key)
+        offset = self._slot_offset(digest)
+        with self._write_lock:
+            fcntl.flock(self._locked_fd(), fcntl.LOCK_EX)
+            try:
+                position = self._cursor()
+                if position % self.data_size + length > self.data_size:
+                    position += self.data_size - position % self.data_size
+
+                # Publish the new cursor before touching the ring, so readers
+                # of the values being overwritten already see them as dead.
+                _U64.pack_into(self._map, _CURSOR_OFFSET, position + length)
+                start = self._data_offset + position % self.data_size
+                self._map[start:start + length] = value
+
+                seq = _SLOT.unpack_from(self._map, offset)[0]
+                _U64.pack_into(self._map, offset, seq | 1)
+                _SLOT.pack_into(self._map, offset, seq | 1, digest, position, length)
+                _U64.pack_into(self._map, offset, (seq | 1) + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def clear(self) -> None:
+        """Invalidates every entry by moving the cursor a full ring ahead."""
+        with self._write_lock:
+            fcntl.flock(self._locked_fd(), fcntl.LOCK_EX)
+            try:
+                _U64.pack_into(self._map, _CURSOR_OFFSET, self._cursor() + self.data_size + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
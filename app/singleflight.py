@@ -0,0 +1,124 @@
+"""Deduplication of identical concurrent calls ("single-flight").
+
+The first caller of a key runs the function; callers arriving while it is
+in flight wait for it and receive the same result (or exception) instead
+of starting their own git lookups.
+
+Within a worker this merges the requests of its threads (gunicorn gthread
+workers). With a shared cache (SHARED_CACHE_PATH) calls are also merged
+across worker processes, which matters for single-threaded sync workers:
+the leader of a key holds a flock on the key's lock file in
+SINGLEFLIGHT_LOCK_DIR while it runs and publishes its result in the shared
+cache; a caller in another worker waits for the flock and takes the
+published result if it was finished after the caller arrived. Exceptions
+are not shared across workers; such callers run the function themselves.
+
+Typical usage example:
+    notes = reads.do(("get-note", repo, branch, path), lambda: load(...))
+"""
+
+import fcntl
+import hashlib
+import os
+import pickle
+import struct
+import threading
+import time
+from typing import Any, Callable, Hashable
+
+from app import metrics
+from app.cache import history_cache
+from config import settings
+
+LOCK_FILES = 1024  # keys share lock files by hash, collisions only serialize
+_FINISHED = struct.Struct("<d")
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    def __init__(self, name: str = "singleflight", shared_cache=None, lock_dir: str | None = None):
+        self.name = name
+        self.shared_cache = shared_cache
+        self.lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.inc(f"{self.name}_shared")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.shared_cache is not None and self.lock_dir:
+                call.result = self._do_shared(key, fn)
+            else:
+                call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_shared(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Runs fn once for all workers calling with key at the same time."""
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        os.makedirs(self.lock_dir, exist_ok=True)
+        path = os.path.join(self.lock_dir, f"{self.name}.{int(digest, 16) % LOCK_FILES}")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                metrics.inc(f"{self.name}_waits")
+                arrived = time.time()
+                if self._wait(fd):
+                    published = self.shared_cache.get(f"flight:{self.name}:{digest}")
+                    if published is not None and _FINISHED.unpack_from(published)[0] >= arrived:
+                        metrics.inc(f"{self.name}_shared")
+                        return pickle.loads(published[_FINISHED.size:])
+
+            result = fn()
+            self.shared_cache.set(f"flight:{self.name}:{digest}",
+                                  _FINISHED.pack(time.time()) + pickle.dumps(result))
+            return result
+        finally:
+            os.close(fd)  # releases the flock
+
+    @staticmethod
+    def _wait(fd: int) -> bool:
+        """Waits for the leader of another worker, up to GIT_TIMEOUT."""
+        deadline = time.monotonic() + settings.GIT_TIMEOUT
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 0.02)
+
+
+reads = SingleFlight("singleflight_reads", history_cache if settings.SHARED_CACHE_PATH else None,
+                     settings.SINGLEFLIGHT_LOCK_DIR)
@@ -0,0 +1,56 @@
+"""Counting semaphores shared by all worker processes of a node.
+
+Used for admission control of requests and for the git process caps of
+the executor, which must hold across gunicorn workers, not only within one.
+
+Typical usage example:
+    pool = SlotPool(lock_dir, "inflight", 32)
+    fd = pool.acquire(time.monotonic() + 2.0)
+    if fd is not None:
+        try:
+            ...
+        finally:
+            SlotPool.release(fd)
+"""
+
+import fcntl
+import os
+import random
+import time
+
+
+class SlotPool:
+    """Counting semaphore shared by all worker processes of a node.
+
+    Each slot is a lock file; holding a slot means holding an exclusive
+    flock on it, so slots are released by the kernel if a worker dies.
+    """
+
+    def __init__(self, directory: str, name: str, size: int):
+        self.paths = [os.path.join(directory, f"{name}.{index}") for index in range(size)]
+
+    def try_acquire(self) -> int | None:
+        start = random.randrange(len(self.paths)) if self.paths else 0
+        for index in range(len(self.paths)):
+            path = self.paths[(start + index) % len(self.paths)]
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def acquire(self, deadline: float) -> int | None:
+        delay = 0.001
+        while True:
+            fd = self.try_acquire()
+            if fd is not None or time.monotonic() >= deadline:
+                return fd
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.02)
+
+    @staticmethod
+    def release(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
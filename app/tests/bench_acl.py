@@ -0,0 +1,77 @@
+"""Benchmark of ACL evaluation over large listings; not collected by pytest.
+
+Usage:
+    python -m app.tests.bench_acl [NOTES] [RULES]
+"""
+
+import random
+import sys
+import time
+
+from app.acl import NONE, AclIndex
+
+
+def make_paths(count: int, rng: random.Random) -> list[str]:
+    return [
+        "/".join(f"dir{rng.randrange(20)}" for _ in range(rng.randrange(1, 6))) + f"/note{index}.md"
+        for index in range(count)
+    ]
+
+
+def make_rules(count: int, rng: random.Random) -> list[dict]:
+    rules = []
+    for _ in range(count):
+        depth = rng.randrange(1, 4)
+        rules.append({
+            "path": "/".join(f"dir{rng.randrange(20)}" for _ in range(depth)),
+            "user": rng.choice(["*", "alice", "bob"]),
+            "access": rng.choice(["none", "read", "write"]),
+        })
+    return rules
+
+
+def linear_access(rules: list[dict], user: str, note_path: str) -> str:
+    """Reference evaluation scanning every rule, as done without the trie."""
+    best = (-1, 0, "write")
+    for rule in rules:
+        path = rule["path"]
+        if note_path == path or note_path.startswith(path + "/"):
+            rank = (path.count("/"), rule["user"] == user, rule["access"])
+            if rule["user"] in (user, "*") and rank[:2] >= best[:2]:  # later rules win
+                best = rank
+    return best[2]
+
+
+def bench(name: str, fn, repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    print(f"{name:<40} {best * 1000:10.1f} ms")
+    return best
+
+
+def main(notes: int = 100_000, rule_count: int = 200) -> None:
+    rng = random.Random(42)
+    paths = make_paths(notes, rng)
+    rules = make_rules(rule_count, rng)
+
+    print(f"{notes} notes, {rule_count} rules")
+    bench("compile trie", lambda: AclIndex(rules))
+    acl = AclIndex(rules)
+    bench("filter listing (trie)", lambda: acl.filter("alice", paths))
+    bench("readonly of every note (trie)", lambda: [acl.access("alice", p) for p in paths])
+    sample = paths[: max(1, notes // 100)]
+    linear = bench(f"readonly of {len(sample)} notes (linear)",
+                   lambda: [linear_access(rules, "alice", p) for p in sample], repeat=1)
+    print(f"{'linear, extrapolated to all notes':<40} {linear * notes / len(sample) * 1000:10.1f} ms")
+
+    mismatches = sum(acl.access("alice", p) != linear_access(rules, "alice", p) for p in sample)
+    readable = sum(acl.access("alice", p) != NONE for p in paths)
+    print(f"{readable} readable notes, {mismatches} mismatches against the linear evaluation")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,53 @@
+"""Benchmark of the logging overhead on requests; not collected by pytest.
+
+Usage:
+    python -m app.tests.bench_logging [REQUESTS]
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from app import create_app, metrics
+from app.logs import configure_logging, shutdown_logging
+from config import settings
+
+
+def main(requests: int = 2000) -> None:
+    with tempfile.TemporaryDirectory() as repo, tempfile.TemporaryDirectory() as logs:
+        subprocess.run(["git", "init", "-q", "-b", "master", repo], check=True)
+        os.makedirs(os.path.join(repo, "docs"))
+        for index in range(50):
+            with open(os.path.join(repo, "docs", f"note{index}.md"), "w") as fh:
+                fh.write(f"note {index}\n")
+        subprocess.run(["git", "-C", repo, "add", "."], check=True)
+        subprocess.run(["git", "-C", repo, "-c", "user.name=bench", "-c", "user.email=bench@localhost",
+                        "commit", "-q", "-m", "notes"], check=True)
+
+        settings.LOGS_DIR = logs
+        configure_logging()
+        logging.getLogger().setLevel(logging.DEBUG)  # worst case: a record per git command
+        client = create_app().test_client()
+        url = f"/apiv1/tree?repo_name={repo}&branch_name=master&depth=2"
+
+        started = time.perf_counter()
+        for _ in range(requests):
+            with client.get(url):
+                pass
+        elapsed = time.perf_counter() - started
+        shutdown_logging()
+
+        counters = metrics.snapshot()["counters"]
+        emit_seconds = counters.get("log_emit_ns", 0) / 1e9
+        print(f"{requests} requests in {elapsed * 1000:.1f} ms, "
+              f"{elapsed / requests * 1e6:.1f} us per request")
+        print(f"logging: {emit_seconds * 1000:.1f} ms on the request threads, "
+              f"{counters.get('log_dropped', 0)} records dropped")
+        print(f"log_overhead_ratio {metrics.snapshot()['gauges']['log_overhead_ratio']:.4%}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,9 @@
+import pytest
+
+from config import settings
+
+
+@pytest.fixture(autouse=True, scope="session")
+def logs_dir(tmp_path_factory):
+    """Keeps the log files of the apps the tests create out of the working directory."""
+    settings.LOGS_DIR = str(tmp_path_factory.mktemp("logs"))
@@ -176,6 +176,29 @@ def test_create_note_conflict(client, temp_repo):
     # The final file content should not simply be the new content.
     assert data["note"] != new_note_content
 
+    # The conflict is listed and resolved like one of update-note.
+    _resolve_listed_conflict(client, temp_repo, file_name, f"user-{file_name}")
+
+
+def _resolve_listed_conflict(client, temp_repo, note_path, branch_name):
+    conflicts = client.get(f"/apiv1/conflicts?repo_name={temp_repo}").get_json()["conflicts"]
+    assert [(c["note_path"], c["branch_name"]) for c in conflicts] == [(note_path, branch_name)]
+    data = client.put(
+        "/apiv1/update-note",
+        json={
+            "repo_name": temp_repo,
+            "note_path": note_path,
+            "note_value": "Resolved.",
+            "branch_name": branch_name,
+            "commit_id": conflicts[0]["commit_id"],
+        }
+    ).get_json()
+    assert data["status"] == "ok"
+    gc = GitCommander(temp_repo)
+    assert gc.show_file(note_path, "master") == "Resolved."
+    assert not gc.branch_exists(branch_name)
+    assert client.get(f"/apiv1/conflicts?repo_name={temp_repo}").get_json()["conflicts"] == []
+
 
 def test_update_note_conflict(client, temp_repo):
     """
@@ -279,3 +302,903 @@ def test_delete_note_conflict(client, temp_repo):
     assert data.get("status") == "conflict"
     assert data.get("note_value") is not None
 
+    _resolve_listed_conflict(client, temp_repo, file_name, f"user-delete-{file_name}")
+
+
+
+def test_search(client, temp_repo):
+    add_file_to_repo(temp_repo, "groceries.txt", "buy milk and bread")
+    add_file_to_repo(temp_repo, "todo.txt", "call the bank")
+
+    response = client.get(f"/apiv1/search?repo_name={temp_repo}&q=milk")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [note["note_path"] for note in data["notes"]] == ["groceries.txt"]
+
+    # The index catches up with commits made after it was built.
+    add_file_to_repo(temp_repo, "recipes.txt", "pancakes need milk")
+    os.system(f"git -C {temp_repo} rm -q groceries.txt")
+    os.system(f"git -C {temp_repo} commit -q -m 'Remove groceries'")
+
+    response = client.get(f"/apiv1/search?repo_name={temp_repo}&q=milk")
+    data = response.get_json()
+    assert [note["note_path"] for note in data["notes"]] == ["recipes.txt"]
+
+
+def test_note_history_and_blame(client, temp_repo):
+    import time
+
+    file_name = "history_note.txt"
+    for version in range(3):
+        add_file_to_repo(temp_repo, file_name, f"first line\nversion {version}\n")
+    add_file_to_repo(temp_repo, "other.txt", "unrelated")
+
+    url = f"/apiv1/note-history?repo_name={temp_repo}&note_path={file_name}&branch_name=master&limit=2"
+    first_page = client.get(url).get_json()
+    assert len(first_page["commits"]) == 2
+    assert first_page["next_cursor"]
+
+    second_page = client.get(f"{url}&cursor={first_page['next_cursor']}").get_json()
+    assert len(second_page["commits"]) == 1
+    assert second_page["next_cursor"] is None
+    assert second_page["commits"][0]["message"] == f"Add {file_name}"
+
+    response = client.get(f"/apiv1/note-blame?repo_name={temp_repo}&note_path={file_name}&branch_name=master")
+    data = response.get_json()
+    assert [line["line"] for line in data["lines"]] == ["first line", "version 2"]
+    assert data["lines"][0]["commit_id"] == second_page["commits"][0]["commit_id"]
+    assert data["lines"][1]["commit_id"] == first_page["commits"][0]["commit_id"]
+
+    # Pages are cached by the last commit of the note, so they survive unrelated commits.
+    from app.cache import history_cache
+    from app.utils import COMMIT_GRAPH_STAMP
+    add_file_to_repo(temp_repo, "another.txt", "unrelated")
+    gc = GitCommander(temp_repo)
+    key = f"history:{gc.get_git_dir()}:{first_page['commits'][0]['commit_id']}:2:{file_name}"
+    assert history_cache.get(key) is not None
+    assert client.get(url).get_json() == first_page
+
+    response = client.get(f"/apiv1/note-blame?repo_name={temp_repo}&note_path={file_name}"
+                          f"&branch_name=master&limit=100000")
+    assert response.status_code == 200
+
+    # The commit-graph is written in the background and stamped with its tip.
+    stamp = os.path.join(gc.get_git_dir(), COMMIT_GRAPH_STAMP)
+    for _ in range(500):
+        if os.path.exists(stamp):
+            break
+        time.sleep(0.01)
+    # A newer tip waits for max_age, so busy repos are not rewritten on every commit.
+    assert not gc.commit_graph_stale(gc.get_commit_id("master"), max_age=300)
+    assert gc.commit_graph_stale(gc.get_commit_id("master"), max_age=0)
+
+
+def test_export_import(client, temp_repo):
+    import io
+    import tarfile
+    import zipfile
+
+    add_file_to_repo(temp_repo, "exported.txt", "exported content")
+
+    response = client.get(f"/apiv1/export?repo_name={temp_repo}&branch_name=master&format=tar")
+    assert response.status_code == 200
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        assert archive.extractfile("exported.txt").read() == b"exported content"
+
+    upload = io.BytesIO()
+    with zipfile.ZipFile(upload, "w") as archive:
+        archive.writestr("imported/one.txt", "one")
+        archive.writestr("../escape.txt", "refused")
+    response = client.post(
+        f"/apiv1/import?repo_name={temp_repo}&format=zip&replace=1",
+        data=upload.getvalue(),
+        content_type="application/zip",
+    )
+    data = response.get_json()
+    assert data["status"] == "ok"
+    assert data["imported"] == 1
+
+    gc = GitCommander(temp_repo)
+    assert gc.get_commit_id("master") == data["commit_id"]
+    assert gc.list_files("master") == ["imported/one.txt"]
+    with open(os.path.join(temp_repo, "imported", "one.txt")) as f:
+        assert f.read() == "one"
+    assert not os.path.exists(os.path.join(temp_repo, "exported.txt"))
+
+
+def test_import_limits(client, temp_repo, monkeypatch):
+    import io
+    import tarfile
+
+    monkeypatch.setattr(settings, "LFS_THRESHOLD_BYTES", 1024)
+    monkeypatch.setattr(settings, "MAX_NOTE_BYTES", 4096)
+    monkeypatch.setattr(settings, "MAX_IMPORT_BYTES", 64 * 1024)
+
+    def tar(members):
+        upload = io.BytesIO()
+        with tarfile.open(fileobj=upload, mode="w") as archive:
+            for name, content in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        return upload.getvalue()
+
+    def post(body):
+        return client.post(f"/apiv1/import?repo_name={temp_repo}&format=tar", data=body,
+                           content_type="application/x-tar")
+
+    large = os.urandom(2048)
+    data = post(tar({"small.txt": b"small", "large.bin": large, "bad\x01name.txt": b"refused"})).get_json()
+    assert (data["status"], data["imported"]) == ("ok", 2)
+    gc = GitCommander(temp_repo)
+    assert "bad\x01name.txt" not in gc.list_files("master")
+    assert gc.read_blob("large.bin", "master").startswith(b"version https://git-lfs")
+    response = client.get(f"/apiv1/note-raw?repo_name={temp_repo}&note_path=large.bin&branch_name=master")
+    assert response.data == large
+
+    head = gc.get_commit_id("master")
+    response = post(tar({"other.txt": b"other", "huge.bin": b"x" * 5000}))
+    assert response.get_json() == {"error": "Logical error occurred"}
+    assert gc.get_commit_id("master") == head
+
+    response = post(tar({"huge.bin": b"x" * (65 * 1024)}))
+    assert response.status_code == 413
+    assert gc.get_commit_id("master") == head
+
+
+def test_update_note_fast_path(client, temp_repo):
+    file_name = "fast_note.txt"
+    gc = GitCommander(temp_repo)
+    add_file_to_repo(temp_repo, file_name, "original")
+    client_commit = gc.get_commit_id("master")
+    # MAIN_BRANCH moves on, but without touching the note.
+    add_file_to_repo(temp_repo, "unrelated.txt", "unrelated")
+    head = gc.get_commit_id("master")
+
+    response = client.put(
+        "/apiv1/update-note",
+        json={
+            "repo_name": temp_repo,
+            "note_path": file_name,
+            "note_value": "updated",
+            "branch_name": "master",
+            "commit_id": client_commit,
+        }
+    )
+    data = response.get_json()
+    assert data["status"] == "ok"
+    assert data["branch_name"] == "master"
+    assert data["commit_id"] == gc.get_commit_id("master")
+    assert gc.get_commit_id("master~1") == head
+    assert "user-" not in gc.list_branches()
+    with open(os.path.join(temp_repo, file_name)) as f:
+        assert f.read() == "updated"
+
+
+def test_update_note_conflict_session(client, temp_repo):
+    file_name = "session_note.txt"
+    gc = GitCommander(temp_repo)
+    add_file_to_repo(temp_repo, file_name, "Initial content.")
+    old_commit = gc.get_commit_id("master")
+    add_file_to_repo(temp_repo, file_name, "Master update.")
+
+    def update(branch_name, commit_id, note_value):
+        return client.put(
+            "/apiv1/update-note",
+            json={
+                "repo_name": temp_repo,
+                "note_path": file_name,
+                "note_value": note_value,
+                "branch_name": branch_name,
+                "commit_id": commit_id,
+            }
+        ).get_json()
+
+    data = update("master", old_commit, "Client update.")
+    assert data["status"] == "conflict"
+    conflict_branch = data["branch_name"]
+
+    conflicts = client.get(f"/apiv1/conflicts?repo_name={temp_repo}").get_json()["conflicts"]
+    assert [c["branch_name"] for c in conflicts] == [conflict_branch]
+    assert conflicts[0]["commit_id"] == data["commit_id"]
+    # Sessions on notes a user cannot read are not listed to them.
+    add_file_to_repo(temp_repo, settings.ACL_FILE,
+                     '{"rules": [{"path": "%s", "user": "bob", "access": "none"}]}' % file_name)
+    url = f"/apiv1/conflicts?repo_name={temp_repo}"
+    assert client.get(url, headers={"X-Wenote-User": "bob"}).get_json()["conflicts"] == []
+    assert len(client.get(url, headers={"X-Wenote-User": "alice"}).get_json()["conflicts"]) == 1
+
+    # MAIN_BRANCH moves on elsewhere; the resolution still applies on top of it.
+    add_file_to_repo(temp_repo, "unrelated.txt", "unrelated")
+    data = update(conflict_branch, data["commit_id"], "Resolved.")
+    assert data["status"] == "ok"
+    assert data["commit_id"] == gc.get_commit_id("master")
+    assert gc.show_file(file_name, "master") == "Resolved."
+    assert not gc.branch_exists(conflict_branch)
+    assert client.get(f"/apiv1/conflicts?repo_name={temp_repo}").get_json()["conflicts"] == []
+
+
+def test_admission_control(temp_repo, monkeypatch):
+    from app.slots import SlotPool
+
+    monkeypatch.setattr(settings, "ADMISSION_CONTROL", True)
+    monkeypatch.setattr(settings, "ADMISSION_LOCK_DIR", os.path.join(temp_repo, ".admission"))
+    monkeypatch.setattr(settings, "ADMISSION_MAX_INFLIGHT", 2)
+    monkeypatch.setattr(settings, "ADMISSION_READ_RESERVED", 1)
+    monkeypatch.setattr(settings, "ADMISSION_WRITE_TIMEOUT", 0.05)
+    app = create_app()
+    app.config["TESTING"] = True
+    client = app.test_client()
+
+    # Another worker is busy writing: the only write slot is taken.
+    busy = SlotPool(settings.ADMISSION_LOCK_DIR, "writes", 1).try_acquire()
+    response = client.delete(
+        "/apiv1/delete-note",
+        json={"repo_name": temp_repo, "note_path": "missing.txt", "branch_name": "master"}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+    # Reads still get the reserved capacity.
+    response = client.get(f"/apiv1/get-note-names?repo_name={temp_repo}&branch_name=master")
+    assert response.status_code == 200
+    SlotPool.release(busy)
+
+
+def test_admission_control_large_writes(temp_repo, monkeypatch):
+    from app.slots import SlotPool
+
+    monkeypatch.setattr(settings, "ADMISSION_CONTROL", True)
+    monkeypatch.setattr(settings, "ADMISSION_LOCK_DIR", os.path.join(temp_repo, ".admission"))
+    monkeypatch.setattr(settings, "ADMISSION_MAX_WRITES_PER_REPO", 1)
+    monkeypatch.setattr(settings, "ADMISSION_WRITE_TIMEOUT", 0.05)
+    app = create_app()
+    app.config["TESTING"] = True
+    client = app.test_client()
+
+    # JSON bodies above MAX_PEEKED_BODY are not parsed for repo_name: they
+    # share one bucket unless the query string names the repository.
+    busy = SlotPool(settings.ADMISSION_LOCK_DIR, "repo-unpeeked", 1).try_acquire()
+    body = {"repo_name": temp_repo, "note_path": "big.txt", "note_value": "x" * (100 * 1024)}
+    response = client.post("/apiv1/create-note", json=body)
+    assert response.status_code == 429
+    with client.post(f"/apiv1/create-note?repo_name={temp_repo}", json=body) as response:
+        assert response.get_json()["message"] == "created"
+    SlotPool.release(busy)
+
+    # Small bodies are bucketed by their repository, repo_path included.
+    busy = SlotPool(settings.ADMISSION_LOCK_DIR, "repo-unpeeked", 1).try_acquire()
+    with client.post("/apiv1/create-note",
+                     json={"repo_path": temp_repo, "note_path": "small.txt", "note_value": "x"}) as response:
+        assert response.get_json()["message"] == "created"
+    SlotPool.release(busy)
+
+
+def test_note_raw_large_notes(client, temp_repo, monkeypatch):
+    monkeypatch.setattr(settings, "LFS_THRESHOLD_BYTES", 1024)
+    monkeypatch.setattr(settings, "MAX_NOTE_BYTES", 64 * 1024)
+    monkeypatch.setattr("app.lfs.STREAM_BLOB_BYTES", 4)  # stream everything but pointers
+    gc = GitCommander(temp_repo)
+    head = gc.get_commit_id("master")
+
+    small = b"small note"
+    response = client.put(f"/apiv1/note-raw?repo_name={temp_repo}&note_path=small.txt&commit_id={head}",
+                          data=small)
+    data = response.get_json()
+    assert (data["status"], data["large"], data["size"]) == ("ok", False, len(small))
+
+    large = os.urandom(8 * 1024)
+    response = client.put(
+        f"/apiv1/note-raw?repo_name={temp_repo}&note_path=large.bin&commit_id={data['commit_id']}",
+        data=large,
+    )
+    data = response.get_json()
+    assert data["large"] and data["size"] == len(large)
+    assert gc.get_commit_id("master") == data["commit_id"]
+    # git only keeps the pointer.
+    assert gc.read_blob("large.bin", "master").startswith(b"version https://git-lfs")
+
+    response = client.get(f"/apiv1/note-raw?repo_name={temp_repo}&note_path=large.bin&branch_name=master")
+    assert response.status_code == 200
+    assert response.data == large
+    assert response.headers["X-Commit-Id"] == data["commit_id"]
+    response = client.get(f"/apiv1/note-raw?repo_name={temp_repo}&note_path=small.txt&branch_name=master")
+    assert response.data == small
+
+    response = client.get(f"/apiv1/get-note?repo_name={temp_repo}&note_path=large.bin&branch_name=master")
+    note = response.get_json()
+    assert note["note"] is None and note["large"] and note["size"] == len(large)
+
+    response = client.put(
+        f"/apiv1/note-raw?repo_name={temp_repo}&note_path=huge.bin&commit_id={data['commit_id']}",
+        data=b"x" * (65 * 1024),
+    )
+    assert response.status_code == 413
+
+
+def test_note_raw_upload_holds_no_git_slot(client, temp_repo, monkeypatch):
+    import io
+    from contextlib import contextmanager
+    from app.executor import executor
+    monkeypatch.setattr(settings, "LFS_THRESHOLD_BYTES", 1024)
+    held = []
+    slot = executor.slot
+
+    @contextmanager
+    def counting_slot(cwd):
+        with slot(cwd):
+            held.append(cwd)
+            try:
+                yield
+            finally:
+                held.remove(cwd)
+
+    class SlowUpload(io.BytesIO):
+        def read(self, size=-1):
+            assert not held, "a git slot is held while reading the upload"
+            return super().read(min(size, 100) if size and size > 0 else 100)
+
+        def readinto(self, buffer):
+            chunk = self.read(len(buffer))
+            buffer[:len(chunk)] = chunk
+            return len(chunk)
+
+    monkeypatch.setattr(executor, "slot", counting_slot)
+    head = GitCommander(temp_repo).get_commit_id("master")
+    for note_path, size in (("small.txt", 500), ("large.bin", 4096)):
+        body = os.urandom(size)
+        response = client.put(f"/apiv1/note-raw?repo_name={temp_repo}&note_path={note_path}&commit_id={head}",
+                              input_stream=SlowUpload(body), content_length=size)
+        data = response.get_json()
+        assert data["status"] == "ok" and data["size"] == size
+        head = data["commit_id"]
+        assert client.get(f"/apiv1/note-raw?repo_name={temp_repo}&note_path={note_path}&branch_name=master").data == body
+
+
+def test_get_note_binary(client, temp_repo):
+    head = GitCommander(temp_repo).get_commit_id("master")
+    content = b"\x89PNG\r\n\x1a\n\xff\xfe"
+    response = client.put(f"/apiv1/note-raw?repo_name={temp_repo}&note_path=image.png&commit_id={head}",
+                          data=content)
+    assert response.status_code == 200
+
+    response = client.get(f"/apiv1/get-note?repo_name={temp_repo}&note_path=image.png&branch_name=master")
+    assert response.status_code == 200
+    note = response.get_json()
+    assert note["note"] is None and note["binary"] and note["size"] == len(content)
+    response = client.get(f"/apiv1/note-raw?repo_name={temp_repo}&note_path=image.png&branch_name=master")
+    assert response.data == content
+
+
+def test_journaled_writes(client, temp_repo, monkeypatch, tmp_path):
+    import json
+    import time
+    from app import metrics
+    from app.journal import Journal, journaled_repos
+    from app.services import get_note_journal
+
+    monkeypatch.setattr(settings, "JOURNAL_WRITES", True)
+    monkeypatch.setattr(settings, "JOURNAL_REGISTRY_DIR", str(tmp_path))
+    response = client.post("/apiv1/create-note", json={
+        "repo_name": temp_repo, "note_path": "journaled.txt", "note_value": "journaled",
+    })
+    assert response.status_code == 202
+    seq = response.get_json()["seq"]
+
+    journal = get_note_journal(temp_repo)
+    journal.apply_pending()
+    for _ in range(100):  # the applier thread may still hold the apply lock
+        entry = client.get(f"/apiv1/journal?repo_name={temp_repo}&seq={seq}").get_json()["entry"]
+        if entry["status"] != "pending":
+            break
+        time.sleep(0.05)
+    gc = GitCommander(temp_repo)
+    assert entry == {"seq": seq, "status": "ok", "note_path": "journaled.txt",
+                     "commit_id": gc.get_commit_id("master")}
+    assert gc.show_file("journaled.txt", "master") == "journaled"
+
+    # Results are only shown to users who may read the note.
+    add_file_to_repo(temp_repo, settings.ACL_FILE, json.dumps({"rules": [
+        {"path": "journaled.txt", "user": "*", "access": "none"},
+        {"path": "journaled.txt", "user": "alice", "access": "read"},
+    ]}))
+    url = f"/apiv1/journal?repo_name={temp_repo}&seq={seq}"
+    assert client.get(url, headers={"X-Wenote-User": "bob"}).status_code == 403
+    assert client.get(url, headers={"X-Wenote-User": "alice"}).get_json()["entry"]["status"] == "ok"
+
+    # A worker died half way through an entry: on the scratch branch with a dirty worktree.
+    monkeypatch.setattr(Journal, "kick", lambda self: None)
+    seq = journal.append("create", {"note_path": "crashed.txt", "note_value": "recovered"})
+    gc.create_branch("user-crashed.txt")
+    gc.write_note("crashed.txt", "half written")
+    journal._save_state({**journal._state(), "applying": seq})
+
+    assert journal.apply_pending() == 1
+    assert journal.status(seq)["entry"]["status"] == "ok"
+    assert gc.get_current_branch() == "master"
+    assert gc.show_file("crashed.txt", "master") == "recovered"
+    assert not gc.branch_exists("user-crashed.txt")
+    assert journaled_repos() == [os.path.abspath(temp_repo)]
+
+    # A corrupt line is quarantined instead of blocking the entries behind it.
+    quarantined = metrics.get("journal_quarantined")
+    with open(journal._journal_file(journal._state()["base"]), "ab") as fh:
+        fh.write(b'{"op": "create", "args": {"note_pa\n')
+    corrupt_seq = journal.status()["end"] - len(b'{"op": "create", "args": {"note_pa\n')
+    seq = journal.append("create", {"note_path": "behind.txt", "note_value": "behind"})
+    assert journal.apply_pending() == 1
+    assert journal.status(corrupt_seq)["entry"]["status"] == "error"
+    assert journal.status(seq)["entry"]["status"] == "ok"
+    assert metrics.get("journal_quarantined") == quarantined + 1
+    with open(journal.quarantine_file) as fh:
+        assert '"note_pa' in fh.read()
+
+    # Writes bypassing the journal apply after the entries journaled before them.
+    seq = journal.append("create", {"note_path": "first.txt", "note_value": "journaled"})
+    monkeypatch.setattr(settings, "JOURNAL_WRITES", False)
+    response = client.delete("/apiv1/delete-note", json={
+        "repo_name": temp_repo, "note_path": "first.txt", "branch_name": "master",
+    })
+    assert response.status_code == 200
+    assert journal.status(seq)["entry"]["status"] == "ok"
+    assert "first.txt" not in gc.list_files("master")
+
+
+def test_profiling(client, temp_repo, monkeypatch, tmp_path):
+    import time
+    from app.profiling import Profiler
+
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(settings, "PROFILE_INTERVAL", 0.001)
+    monkeypatch.setattr(settings, "PROFILE_DIR", str(tmp_path))
+    admin = {"X-Admin-Token": "secret"}
+    add_file_to_repo(temp_repo, "profiled.txt", "profiled")
+    url = f"/apiv1/get-note?repo_name={temp_repo}&note_path=profiled.txt&branch_name=master"
+
+    assert client.post("/apiv1/admin/profile?seconds=10").status_code == 403
+    # Without the admin token the header is ignored.
+    assert "X-Profile-Id" not in client.get(url, headers={"X-Wenote-Profile": "1"}).headers
+
+    response = client.get(url, headers={"X-Wenote-Profile": "1", **admin})
+    profile_id = response.headers["X-Profile-Id"]
+    report = client.get(f"/apiv1/admin/profile?id={profile_id}", headers=admin).get_json()
+    assert report["requests"] == 1 and not report["active"]
+
+    assert client.post("/apiv1/admin/profile?requests=20", headers=admin).status_code == 200
+    for _ in range(20):
+        client.get(url)
+    report = client.get("/apiv1/admin/profile", headers=admin).get_json()
+    assert report["requests"] == 20 and not report["active"]
+    assert report["samples"] > 0
+    # Samples are only taken inside the profiled request.
+    assert all("profiling_middleware" in line for line in report["stacks"])
+    collapsed = client.get("/apiv1/admin/profile?format=collapsed", headers=admin)
+    assert collapsed.mimetype == "text/plain"
+    assert collapsed.data.decode().endswith("\n")
+    assert client.get("/apiv1/admin/profile?id=unknown", headers=admin).status_code == 404
+
+    # Another worker takes part in the session and reports the merged samples.
+    assert client.post("/apiv1/admin/profile?requests=4", headers=admin).status_code == 200
+    worker = Profiler()
+    for _ in range(2):
+        client.get(url)
+        _, session = worker.session_for(None, None)
+        worker.attach(session)
+        time.sleep(0.01)
+        worker.detach()
+    assert worker.session_for(None, None) == (None, None)  # the shared budget is spent
+    worker.flush()
+    report = client.get("/apiv1/admin/profile", headers=admin).get_json()
+    assert report["requests"] == 4 and not report["active"]
+    assert worker.report() == report
+
+
+def test_tree(client, temp_repo):
+    add_file_to_repo(temp_repo, "docs/a.txt", "a")
+    add_file_to_repo(temp_repo, "docs/deep/b.txt", "b")
+    gc = GitCommander(temp_repo)
+
+    data = client.get(f"/apiv1/tree?repo_name={temp_repo}&branch_name=master").get_json()
+    assert data["commit_id"] == gc.get_commit_id("master")
+    assert data["count"] == 3  # .gitkeep, docs/a.txt, docs/deep/b.txt
+    docs = next(entry for entry in data["entries"] if entry["name"] == "docs")
+    assert docs["type"] == "tree" and docs["count"] == 2 and "entries" not in docs
+
+    data = client.get(f"/apiv1/tree?repo_name={temp_repo}&branch_name=master&path=docs&depth=2").get_json()
+    assert data["tree_id"] == docs["tree_id"]
+    by_name = {entry["name"]: entry for entry in data["entries"]}
+    assert by_name["a.txt"]["blob_id"] == gc.get_blob_id("docs/a.txt", "master")
+    assert [entry["path"] for entry in by_name["deep"]["entries"]] == ["docs/deep/b.txt"]
+
+    # An unchanged subtree keeps its id, and so its cached snapshot, across commits.
+    add_file_to_repo(temp_repo, "other.txt", "other")
+    data = client.get(f"/apiv1/tree?repo_name={temp_repo}&branch_name=master").get_json()
+    assert next(e for e in data["entries"] if e["name"] == "docs")["tree_id"] == docs["tree_id"]
+
+
+def test_user_worktrees(client, temp_repo, monkeypatch):
+    monkeypatch.setattr(settings, "USER_WORKTREES", True)
+    gc = GitCommander(temp_repo)
+    alice, bob = {"X-Wenote-User": "alice"}, {"X-Wenote-User": "bob"}
+
+    response = client.post("/apiv1/create-note", headers=alice, json={
+        "repo_name": temp_repo, "note_path": "a/one.txt", "note_value": "one",
+    })
+    assert response.get_json()["message"] == "created"
+    response = client.post("/apiv1/create-note", headers=bob, json={
+        "repo_name": temp_repo, "note_path": "b/two.txt", "note_value": "two",
+    })
+    assert response.get_json()["message"] == "created"
+
+    # MAIN_BRANCH moved by compare-and-swap and the main worktree followed.
+    assert gc.get_current_branch() == "master"
+    assert gc.list_files("master") == [".gitkeep", "a/one.txt", "b/two.txt"]
+    with open(os.path.join(temp_repo, "b", "two.txt")) as f:
+        assert f.read() == "two"
+    assert not gc.branch_exists("user-a/one.txt")
+
+    # Worktrees only check out the directories their user worked in.
+    alice_worktree = gc.switch_user("alice", "master").repo_path
+    assert os.path.isdir(os.path.join(alice_worktree, "a"))
+    assert not os.path.exists(os.path.join(alice_worktree, "b"))
+
+    client_commit = gc.get_commit_id("master")
+    add_file_to_repo(temp_repo, "a/one.txt", "changed on master")
+    response = client.put("/apiv1/update-note", headers=alice, json={
+        "repo_name": temp_repo, "branch_name": "master", "commit_id": client_commit,
+        "note_path": "a/one.txt", "note_value": "changed by alice",
+    })
+    data = response.get_json()
+    assert data["status"] == "conflict"
+    assert data["branch_name"] == "user-a/one.txt"
+    assert gc.get_current_branch() == "master"
+
+    response = client.put("/apiv1/update-note", headers=alice, json={
+        "repo_name": temp_repo, "branch_name": data["branch_name"], "commit_id": data["commit_id"],
+        "note_path": "a/one.txt", "note_value": "resolved",
+    })
+    assert response.get_json()["status"] == "ok"
+    assert gc.show_file("a/one.txt", "master") == "resolved"
+    with open(os.path.join(temp_repo, "a", "one.txt")) as f:
+        assert f.read() == "resolved"
+
+
+def test_user_worktrees_write_in_parallel(client, temp_repo, monkeypatch):
+    import threading
+
+    monkeypatch.setattr(settings, "USER_WORKTREES", True)
+    gc = GitCommander(temp_repo)
+    in_commit, release = threading.Event(), threading.Event()
+    commit = GitCommander.commit
+
+    def slow_commit(self, *args, **kwargs):
+        if os.path.basename(self.repo_path) == "alice":
+            in_commit.set()
+            release.wait(10)
+        return commit(self, *args, **kwargs)
+
+    monkeypatch.setattr(GitCommander, "commit", slow_commit)
+
+    def write(user, note_path, results):
+        response = client.application.test_client().post(
+            "/apiv1/create-note", headers={"X-Wenote-User": user},
+            json={"repo_name": temp_repo, "note_path": note_path, "note_value": user},
+        )
+        results.append(response.get_json()["message"])
+
+    alice_results, bob_results = [], []
+    alice = threading.Thread(target=write, args=("alice", "a/one.txt", alice_results))
+    alice.start()
+    try:
+        assert in_commit.wait(10)
+        # Bob's write goes all the way through while alice's is half done.
+        write("bob", "b/two.txt", bob_results)
+        assert bob_results == ["created"] and alice.is_alive()
+        assert "b/two.txt" in gc.list_files("master")
+    finally:
+        release.set()
+        alice.join(10)
+    assert alice_results == ["created"]
+    assert {"a/one.txt", "b/two.txt"} <= set(gc.list_files("master"))
+
+
+def test_acl(client, temp_repo):
+    import json
+
+    add_file_to_repo(temp_repo, "public.txt", "public")
+    add_file_to_repo(temp_repo, "handbook/rules.txt", "rules")
+    add_file_to_repo(temp_repo, "private/alice/diary.txt", "diary")
+    add_file_to_repo(temp_repo, settings.ACL_FILE, json.dumps({"rules": [
+        {"path": "handbook", "user": "*", "access": "read"},
+        {"path": "private", "user": "*", "access": "none"},
+        {"path": "private/alice", "user": "alice", "access": "write"},
+    ]}))
+    alice, bob = {"X-Wenote-User": "alice"}, {"X-Wenote-User": "bob"}
+
+    def names(headers):
+        url = f"/apiv1/get-note-names?repo_name={temp_repo}&branch_name=master"
+        return client.get(url, headers=headers).get_json()["notes"]
+
+    def note(path, headers):
+        url = f"/apiv1/get-note?repo_name={temp_repo}&note_path={path}&branch_name=master"
+        return client.get(url, headers=headers)
+
+    assert "private/alice/diary.txt" in names(alice)
+    assert "private/alice/diary.txt" not in names(bob)
+    assert note("private/alice/diary.txt", bob).status_code == 403
+    assert note("private/alice/diary.txt", alice).get_json()["readonly"] is False
+    assert note("handbook/rules.txt", alice).get_json()["readonly"] is True
+    assert note("public.txt", {}).get_json()["readonly"] is False
+
+    response = client.post("/apiv1/create-note", headers=bob, json={
+        "repo_name": temp_repo, "note_path": "handbook/new.txt", "note_value": "new",
+    })
+    assert response.status_code == 403
+
+    # The rules themselves are read-only without a rule of their own.
+    response = client.post("/apiv1/create-note", headers=bob, json={
+        "repo_name": temp_repo, "note_path": settings.ACL_FILE, "note_value": "{}",
+    })
+    assert response.status_code == 403
+
+
+def test_acl_on_every_endpoint(client, temp_repo):
+    import io
+    import json
+    import tarfile
+
+    from app.acl import NONE, AclIndex
+
+    add_file_to_repo(temp_repo, "public.txt", "public secret")
+    add_file_to_repo(temp_repo, "handbook/rules.txt", "rules")
+    add_file_to_repo(temp_repo, "private/alice/diary.txt", "diary secret")
+    add_file_to_repo(temp_repo, settings.ACL_FILE, json.dumps({"rules": [
+        {"path": "handbook", "user": "*", "access": "read"},
+        {"path": "./private/", "user": "*", "access": "none"},
+        {"path": "private/alice", "user": "alice", "access": "write"},
+    ]}))
+    assert AclIndex([{"path": "private", "access": "none"}]).access("bob", "./private//x") == NONE
+    alice, bob = {"X-Wenote-User": "alice"}, {"X-Wenote-User": "bob"}
+    repo = f"repo_name={temp_repo}"
+    diary = "note_path=private/alice/diary.txt&branch_name=master"
+
+    tree = client.get(f"/apiv1/tree?{repo}&branch_name=master", headers=bob).get_json()
+    names = [entry["name"] for entry in tree["entries"]]
+    assert "handbook" in names and "public.txt" in names and "private" not in names
+    assert tree["count"] is None
+    tree = client.get(f"/apiv1/tree?{repo}&branch_name=master", headers=alice).get_json()
+    private = next(entry for entry in tree["entries"] if entry["name"] == "private")
+    assert private["count"] is None
+    assert client.get(f"/apiv1/tree?{repo}&branch_name=master&path=private",
+                      headers=bob).status_code == 403
+
+    def search(headers):
+        data = client.get(f"/apiv1/search?{repo}&q=secret", headers=headers).get_json()
+        return [note["note_path"] for note in data["notes"]]
+
+    assert search(bob) == ["public.txt"]
+    assert sorted(search(alice)) == ["private/alice/diary.txt", "public.txt"]
+
+    for endpoint in ("note-history", "note-blame", "note-raw"):
+        assert client.get(f"/apiv1/{endpoint}?{repo}&{diary}", headers=bob).status_code == 403
+        assert client.get(f"/apiv1/{endpoint}?{repo}&{diary}", headers=alice).status_code == 200
+
+    head = GitCommander(temp_repo).get_commit_id("master")
+    response = client.put(f"/apiv1/note-raw?{repo}&note_path=handbook/rules.txt&commit_id={head}",
+                          data=b"changed", headers=bob)
+    assert response.status_code == 403
+
+    response = client.get(f"/apiv1/export?{repo}&branch_name=master", headers=bob)
+    assert response.headers["X-Commit-Id"] == head
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        assert "private/alice/diary.txt" not in archive.getnames()
+        assert archive.extractfile("public.txt").read() == b"public secret"
+
+    upload = io.BytesIO()
+    with tarfile.open(fileobj=upload, mode="w") as archive:
+        for name in ("handbook/rules.txt", "private/alice/diary.txt", "bob.txt"):
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            archive.addfile(info, io.BytesIO(b"bob"))
+    response = client.post(f"/apiv1/import?{repo}&replace=1", data=upload.getvalue(), headers=bob)
+    data = response.get_json()
+    assert (data["imported"], data["skipped"]) == (1, 2)
+    gc = GitCommander(temp_repo)
+    assert set(gc.list_files("master")) == {settings.ACL_FILE, "bob.txt", "handbook/rules.txt",
+                                            "private/alice/diary.txt"}
+    assert gc.show_file("private/alice/diary.txt", "master") == "diary secret"
+
+    # A note moved out of a private folder, whose rule is dropped on the way,
+    # stays out of diffs of users who could not read it before.
+    start = gc.get_commit_id("master")
+    os.system(f"git -C {temp_repo} mv private/alice/diary.txt diary.txt")
+    add_file_to_repo(temp_repo, settings.ACL_FILE, json.dumps({"rules": []}))
+    url = f"/apiv1/diff?{repo}&from={start}&to=master&patch=1"
+    assert "diary.txt" not in [change["path"] for change in client.get(url, headers=bob).get_json()["changes"]]
+    assert "diary.txt" in [change["path"] for change in client.get(url, headers=alice).get_json()["changes"]]
+
+
+def test_diff(client, temp_repo):
+    add_file_to_repo(temp_repo, "keep.txt", "keep")
+    add_file_to_repo(temp_repo, "moved.txt", "a note long enough\nto be recognised\nas renamed\n")
+    start = GitCommander(temp_repo).get_commit_id("master")
+    os.system(f"git -C {temp_repo} mv moved.txt renamed.txt")
+    os.system(f"git -C {temp_repo} commit -m 'Rename moved.txt'")
+    add_file_to_repo(temp_repo, "keep.txt", "kept\n")
+
+    url = f"/apiv1/diff?repo_name={temp_repo}&from={start}&to=master"
+    data = client.get(url).get_json()
+    assert data["from"] == start
+    changes = {change["path"]: change for change in data["changes"]}
+    assert changes["renamed.txt"]["status"] == "R" and changes["renamed.txt"]["old_path"] == "moved.txt"
+    assert changes["keep.txt"]["status"] == "M" and "patch" not in changes["keep.txt"]
+
+    data = client.get(f"{url}&patch=1").get_json()
+    patch = next(change["patch"] for change in data["changes"] if change["path"] == "keep.txt")
+    assert "-keep" in patch and "+kept" in patch
+    assert client.get(f"/apiv1/diff?repo_name={temp_repo}&from={start}").status_code == 400
+
+
+def test_request_logging(client, temp_repo):
+    import collections
+    import logging
+    from app import metrics
+    from app.logs import DroppingQueueHandler, access_logger, current_request_id
+
+    records = collections.deque()
+    handler = DroppingQueueHandler(records, 1)
+    access_logger.addHandler(handler)
+    access_logger.setLevel(logging.INFO)
+    dropped = metrics.get("log_dropped")
+    outer_request_id = current_request_id()  # left over by unclosed responses of other tests
+    try:
+        url = f"/apiv1/tree?repo_name={temp_repo}&branch_name=master"
+        with client.get(url, headers={"X-Request-Id": "client-id"}) as response:
+            assert response.headers["X-Request-Id"] == "client-id"
+        with client.get(url) as response:
+            assert response.headers["X-Request-Id"] not in ("", "client-id")
+        assert current_request_id() == outer_request_id  # restored when the response closes
+    finally:
+        access_logger.removeHandler(handler)
+        access_logger.setLevel(logging.NOTSET)
+
+    record, = records
+    assert record.request_id == "client-id" and record.status == 200
+    assert record.git_commands >= 1 and record.levelno == logging.INFO
+    assert metrics.get("log_dropped") == dropped + 1  # the queue was full for the second request
+
+
+def test_invalid_requests_rejected_before_git(client, temp_repo):
+    gc = GitCommander(temp_repo)
+    branches = gc.list_branches()
+
+    for note_path in ["../escape.txt", "/etc/passwd", ".git/config", "a\0b.txt", ""]:
+        response = client.post("/apiv1/create-note", json={
+            "repo_name": temp_repo, "note_path": note_path, "note_value": "x",
+        })
+        assert response.status_code == 400
+        assert response.get_json()["details"][0]["field"] == "note_path"
+
+    response = client.put("/apiv1/update-note", json={
+        "repo_name": temp_repo, "note_path": "a.txt", "note_value": "x",
+        "branch_name": "--orphan", "commit_id": "not-a-commit",
+    })
+    assert response.status_code == 400
+    assert {detail["field"] for detail in response.get_json()["details"]} == {"branch_name", "commit_id"}
+    assert client.post("/apiv1/create-note", data=b"{not json").status_code == 400
+    assert client.get(f"/apiv1/tree?repo_name={temp_repo}&branch_name=master&depth=0").status_code == 400
+    assert gc.list_branches() == branches
+
+    add_file_to_repo(temp_repo, "dir/note.txt", "normalized")
+    response = client.get(f"/apiv1/get-note?repo_name={temp_repo}&note_path=dir//./note.txt&branch_name=master")
+    assert response.get_json()["note"] == "normalized"
+
+
+def test_capture_and_replay(temp_repo, monkeypatch):
+    import time
+
+    from app.capture import read_capture
+    from app.replay import Replayer, replay
+
+    capture_file = os.path.join(temp_repo, ".git", "traffic.cap")
+    monkeypatch.setattr(settings, "CAPTURE_PATH", capture_file)
+    monkeypatch.setattr(settings, "CAPTURE_SALT", "salt")
+    client = create_app().test_client()
+    with client.post("/apiv1/create-note", headers={"X-Wenote-User": "alice"}, json={
+        "repo_name": temp_repo, "note_path": "captured.txt", "note_value": "secret content",
+    }) as response:
+        assert response.status_code == 200
+    with client.get(f"/apiv1/get-note?repo_name={temp_repo}&note_path=captured.txt&branch_name=master"):
+        pass
+    with client.get(f"/apiv1/search?repo_name={temp_repo}&q=secret"):
+        pass
+
+    create, get, search = records = list(read_capture(capture_file))
+    assert (create.method, create.path, create.status) == ("POST", "/apiv1/create-note", 200)
+    assert create.params == {"repo_name": temp_repo, "note_path": "captured.txt",
+                             "note_value_size": len("secret content")}
+    assert create.user not in (None, "alice") and create.request_bytes > 0
+    assert get.response_bytes > 0 and get.duration > 0
+    assert search.params == {"repo_name": temp_repo, "q_size": 6}
+    with open(capture_file, "rb") as fh:
+        assert b"secret" not in fh.read()
+
+    # Bodies past what middlewares peek at are taken from the validated request.
+    with client.post("/apiv1/create-note", json={
+        "repo_name": temp_repo, "note_path": "big.txt", "note_value": "x" * 100_000,
+    }) as response:
+        assert response.status_code == 200
+    big = list(read_capture(capture_file))[-1]
+    assert big.params == {"repo_name": temp_repo, "note_path": "big.txt",
+                          "note_value_size": 100_000}
+
+    monkeypatch.setattr(settings, "CAPTURE_PATH", "")
+    report = replay(records, Replayer(temp_repo, None), speed=0, concurrency=2)
+    assert report["requests"] == 3
+    assert report["endpoints"]["GET /apiv1/get-note"]["errors"] == 0
+
+    # Latency counts from the scheduled send time: requests queued behind a
+    # slow one are reported as slow too.
+    class SlowReplayer:
+        def send(self, record):
+            time.sleep(0.05)
+            return 200
+
+    report = replay([get] * 3, SlowReplayer(), speed=1, concurrency=1)
+    assert report["endpoints"]["GET /apiv1/get-note"]["max"] >= 0.15
+    # As fast as possible has no schedule: only the send itself is timed.
+    report = replay([get] * 3, SlowReplayer(), speed=0, concurrency=1)
+    assert report["endpoints"]["GET /apiv1/get-note"]["max"] < 0.1
+
+
+def test_control_characters_in_note_path_rejected(client, temp_repo):
+    add_file_to_repo(temp_repo, "p.txt", "p")
+    add_file_to_repo(temp_repo, "s.txt", "s")
+
+    url = f"/apiv1/get-note?repo_name={temp_repo}&branch_name=master&note_path="
+    response = client.get(url + "a%0Ab")
+    assert response.status_code == 400
+    assert response.get_json()["details"][0]["field"] == "note_path"
+    assert client.get(url + "a%0Db").status_code == 400
+    assert client.get(url + "a%7Fb").status_code == 400
+
+    # The batch reader is still in step afterwards.
+    assert client.get(url + "p.txt").get_json()["note"] == "p"
+    assert client.get(url + "s.txt").get_json()["note"] == "s"
+
+
+def test_note_value_size_in_bytes(monkeypatch):
+    from pydantic import ValidationError
+    from app.serializers import CreateNoteInput
+
+    def validate(note_value):
+        return CreateNoteInput.model_validate({"note_path": "a.txt", "note_value": note_value})
+
+    monkeypatch.setattr(settings, "MAX_NOTE_BYTES", 4)
+    assert validate("abcd").note_value == "abcd"
+    with pytest.raises(ValidationError):
+        validate("ééé")  # three characters, six bytes
+    # The limit in force is read on every request.
+    monkeypatch.setattr(settings, "MAX_NOTE_BYTES", 6)
+    assert validate("ééé").note_value == "ééé"
+
+
+def test_memory_backend_api(client, monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "memory")
+    repo = tempfile.mkdtemp(prefix="memory-")  # only used as a key, never written
+    note = {"repo_name": repo, "note_path": "a.md"}
+
+    response = client.post("/apiv1/create-note", json={**note, "note_value": "hello"})
+    assert response.get_json()["message"] == "created"
+    data = client.get(f"/apiv1/get-note?repo_name={repo}&note_path=a.md&branch_name=master").get_json()
+    assert data["note"] == "hello"
+    # Creating over an existing note would need a merge.
+    response = client.post("/apiv1/create-note", json={**note, "note_value": "again"})
+    assert response.get_json() == {"error": "Logical error occurred"}
+
+    response = client.delete("/apiv1/delete-note", json={**note, "branch_name": "master"})
+    assert response.get_json()["status"] == "ok"
+    data = client.get(f"/apiv1/get-note-names?repo_name={repo}&branch_name=master").get_json()
+    assert data["notes"] == []
+    response = client.delete("/apiv1/delete-note", json={**note, "branch_name": "master"})
+    assert response.get_json() == {"error": "Logical error occurred"}
@@ -38,6 +38,24 @@ def test_get_commit_id(git_commander):
     # Verify that commit_id is a valid 40-character SHA-1 hash.
     assert len(commit_id) == 40
 
+    # Branches are read from their ref file, then from packed-refs after gc.
+    branch = git_commander.get_current_branch()
+    assert git_commander.get_commit_id(branch) == commit_id
+    subprocess.run(["git", "commit", "--allow-empty", "-m", "Second commit"],
+                   cwd=git_commander.repo_path, check=True)
+    second = git_commander.get_commit_id("HEAD")
+    # Rewritten within the same mtime tick, with the same size: still seen.
+    ref_file = os.path.join(git_commander.get_git_dir(), "refs", "heads", branch)
+    stat = os.stat(ref_file)
+    assert git_commander.get_commit_id(branch) == second
+    subprocess.run(["git", "update-ref", f"refs/heads/{branch}", commit_id],
+                   cwd=git_commander.repo_path, check=True)
+    os.utime(ref_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert git_commander.get_commit_id(branch) == commit_id
+    subprocess.run(["git", "pack-refs", "--all"], cwd=git_commander.repo_path, check=True)
+    assert not os.path.exists(ref_file)
+    assert git_commander.get_commit_id(branch) == commit_id
+
 def test_file_exists(git_commander):
     branch_name = "master"
     note_path = "notes/note1.txt"
@@ -212,3 +230,262 @@ def test_get_current_branch(git_commander):
     current_branch = git_commander.get_current_branch()
     assert current_branch == "master"
 
+
+def test_warm_repo_prefetches_hot_notes(git_commander):
+    from app.cache import blob_cache
+    from app.warmup import get_access_log, warm_repo
+
+    note_path = "hot.txt"
+    git_commander.write_note(note_path, "hot note")
+    subprocess.run(["git", "add", note_path], cwd=git_commander.repo_path, check=True)
+    subprocess.run(["git", "commit", "-m", "Add hot note"], cwd=git_commander.repo_path, check=True)
+
+    access_log = get_access_log(git_commander.repo_path)
+    access_log.record(note_path)
+    access_log.flush()
+    assert access_log.hottest(10) == [note_path]
+
+    blob_cache.clear()
+    assert warm_repo(git_commander.repo_path) == 1
+    oid = git_commander.get_commit_id(f"master:{note_path}")
+    assert blob_cache.get(oid) == b"hot note"
+
+def test_shared_cache(temp_git_repo):
+    from app.shmcache import SharedCache
+
+    path = os.path.join(temp_git_repo, "shared-cache")
+    writer = SharedCache(path, 1024 * 1024)
+    reader = SharedCache(path, 1024 * 1024)
+
+    writer.set("blob-a", b"value a")
+    assert reader.get("blob-a") == b"value a"
+    assert reader.get("blob-b") is None
+
+    # Filling the ring evicts the oldest values.
+    for index in range(64):
+        writer.set(f"filler-{index}", bytes(writer.max_value_size))
+    assert reader.get("blob-a") is None
+
+    writer.set("blob-c", b"value c")
+    writer.clear()
+    assert reader.get("blob-c") is None
+
+    # Workers with another budget get their own file instead of resizing
+    # the one mapped by the others.
+    writer.set("blob-d", b"value d")
+    other = SharedCache(path, 2 * 1024 * 1024)
+    assert other.path != writer.path
+    assert os.path.getsize(writer.path) == 1024 * 1024
+    assert other.get("blob-d") is None
+    assert reader.get("blob-d") == b"value d"
+
+def test_diff_tree(git_commander):
+    git_commander.write_note("a.txt", "first note body\n" * 20)
+    git_commander.write_note("b.txt", "b")
+    subprocess.run(["git", "add", "."], cwd=git_commander.repo_path, check=True)
+    subprocess.run(["git", "commit", "-m", "first"], cwd=git_commander.repo_path, check=True)
+    subprocess.run(["git", "mv", "a.txt", "moved.txt"], cwd=git_commander.repo_path, check=True)
+    subprocess.run(["git", "rm", "-q", "b.txt"], cwd=git_commander.repo_path, check=True)
+    subprocess.run(["git", "commit", "-m", "second"], cwd=git_commander.repo_path, check=True)
+
+    changes = git_commander.diff_tree("HEAD~1", "HEAD", renames=True)
+    assert ("D", "b.txt", None) in changes
+    assert ("R100", "moved.txt", "a.txt") in changes
+
+    # Header-like text inside notes does not split their patches.
+    git_commander.write_note("c.txt", "see diff --git a/x b/x\ndiff --git a/y b/y\n")
+    subprocess.run(["git", "add", "."], cwd=git_commander.repo_path, check=True)
+    subprocess.run(["git", "commit", "-m", "third"], cwd=git_commander.repo_path, check=True)
+    patches = git_commander.diff_patches("HEAD~2", "HEAD", renames=True)
+    assert len(patches) == len(git_commander.diff_tree("HEAD~2", "HEAD", renames=True)) == 3
+    assert all(patch.startswith("diff --git ") and patch.endswith("\n") for patch in patches)
+    patch, = [patch for patch in patches if patch.startswith("diff --git a/c.txt ")]
+    assert patch.endswith("+see diff --git a/x b/x\n+diff --git a/y b/y\n")
+
+def test_executor_limits(git_commander, tmp_path, monkeypatch):
+    import subprocess
+    import sys
+
+    from app.exceptions import GitBusyError, GitError, GitTimeoutError
+    from app.executor import GitExecutor
+    from app.utils import BatchReader
+
+    executor = GitExecutor(max_procs=1, max_procs_per_repo=1, acquire_timeout=0.01,
+                           lock_dir=str(tmp_path))
+    with executor.slot(git_commander.repo_path):
+        with pytest.raises(GitBusyError):
+            executor.run(["git", "status"], cwd=git_commander.repo_path)
+        # Batch readers count against the caps too.
+        monkeypatch.setattr("app.utils.executor", executor)
+        with pytest.raises(GitBusyError):
+            BatchReader(git_commander.repo_path).resolve("HEAD")
+
+    # The slots are shared with other worker processes.
+    holder = subprocess.Popen(
+        [sys.executable, "-c", "import fcntl, os, sys; "
+         "fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT); fcntl.flock(fd, fcntl.LOCK_EX); "
+         "print(flush=True); sys.stdin.read()", str(tmp_path / "git.0")],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+    holder.stdout.readline()
+    with pytest.raises(GitBusyError):
+        executor.run(["git", "status"], cwd=git_commander.repo_path)
+    holder.communicate()
+    executor.run(["git", "status"], cwd=git_commander.repo_path)
+
+    with pytest.raises(GitTimeoutError):
+        executor.run(["sleep", "5"], cwd=git_commander.repo_path, timeout=0.1)
+
+    # Errors are classified by exit code, not by words in the output.
+    with pytest.raises(GitError) as excinfo:
+        git_commander.checkout_branch("no-such-branch")
+    assert excinfo.value.returncode != 0
+
+
+def test_singleflight_shares_inflight_call():
+    import threading
+    import time
+    from app import metrics
+    from app.singleflight import SingleFlight
+
+    group = SingleFlight("singleflight_test")
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(group.do("key", load)))
+               for _ in range(5)]
+    shared = metrics.get("singleflight_test_shared")
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while metrics.get("singleflight_test_shared") < shared + 4 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+    # Finished calls are forgotten, so the next call runs again.
+    assert group.do("key", lambda: "fresh") == "fresh"
+
+
+def test_singleflight_shares_across_workers(tmp_path):
+    import threading
+    import time
+    from app import metrics
+    from app.shmcache import SharedCache
+    from app.singleflight import SingleFlight
+
+    # Two groups on one shared cache and lock directory stand for two workers.
+    cache = SharedCache(str(tmp_path / "cache"), 1024 * 1024)
+    workers = [SingleFlight("singleflight_workers", cache, str(tmp_path / "flights"))
+               for _ in range(2)]
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"notes": ["a.txt"]}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(workers[0].do("key", load)))
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(workers[1].do("key", load)))
+    waits = metrics.get("singleflight_workers_waits")
+    follower.start()
+    deadline = time.monotonic() + 5
+    while metrics.get("singleflight_workers_waits") == waits and time.monotonic() < deadline:
+        time.sleep(0.001)  # until the follower waits on the leader's lock
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert results == [{"notes": ["a.txt"]}] * 2
+    assert len(calls) == 1
+    # A result published before the caller arrived is not reused.
+    assert workers[1].do("key", lambda: "fresh") == "fresh"
+
+
+@pytest.mark.parametrize("backend_name", ["git", "memory"])
+def test_storage_backends(backend_name, git_commander):
+    from app.backends import BACKENDS
+    from config import settings
+
+    if backend_name == "git":
+        subprocess.run(["git", "commit", "--allow-empty", "-m", "Initial commit"],
+                       cwd=git_commander.repo_path, check=True)
+        main = git_commander.get_current_branch()
+    else:
+        main = settings.MAIN_BRANCH
+    backend = BACKENDS[backend_name](git_commander.repo_path)
+
+    head = backend.resolve_ref(main)
+    assert backend.resolve_ref("no-such-branch") is None
+    new_head = backend.write_commit(head, {"dir/a.md": b"hello"}, msg="add a")
+    assert backend.resolve_ref(main) == head  # writing a commit moves no ref
+
+    assert backend.cas_ref(main, new_head, head)
+    assert not backend.cas_ref(main, head, head)
+    assert backend.read_blob("dir/a.md", main) == b"hello"
+    assert backend.blob_id("dir/a.md", head) is None
+    assert "dir/a.md" in backend.list_tree(main)
+
+    removed = backend.write_commit(new_head, {"dir/a.md": None}, msg="remove a")
+    assert "dir/a.md" not in backend.list_tree(removed)
+
+
+def test_services_on_memory_backend(monkeypatch):
+    from app import services
+    from config import settings
+
+    monkeypatch.setattr(settings, "STORAGE_BACKEND", "memory")
+    repo_path = tempfile.mkdtemp(prefix="memory-")  # only used as a key, never written
+    head = services.get_note_names(repo_path, settings.MAIN_BRANCH)
+    assert head["notes"] == []
+
+    from app.backends import get_backend
+    commit_id = get_backend(repo_path).resolve_ref(settings.MAIN_BRANCH)
+    status, note, branch_name, new_head = services.update_note(
+        repo_path, settings.MAIN_BRANCH, commit_id, "a.md", "hello"
+    )
+    assert (status, note, branch_name) == ("ok", "hello", settings.MAIN_BRANCH)
+    assert services.get_note(repo_path, "a.md", settings.MAIN_BRANCH)["commit_id"] == new_head
+
+
+def test_batch_reader_stays_in_step(git_commander):
+    from app.exceptions import LogicalError
+    from app.utils import get_batch_reader
+
+    repo = git_commander.repo_path
+    for name, content in (("p.txt", "p"), ("s.txt", "s")):
+        with open(os.path.join(repo, name), "w") as f:
+            f.write(content)
+    subprocess.run(["git", "add", "."], cwd=repo, check=True)
+    subprocess.run(["git", "commit", "-m", "notes"], cwd=repo, check=True)
+    reader = get_batch_reader(repo)
+
+    assert reader.resolve("HEAD:my note.txt") is None
+    with pytest.raises(LogicalError):
+        reader.resolve("HEAD:a\nHEAD:s.txt")
+    assert git_commander.read_blob("p.txt", "HEAD") == b"p"
+    assert git_commander.read_blob("s.txt", "HEAD") == b"s"
+
+    # A stray answer left on the pipe is detected and the reader restarted.
+    reader.start()
+    reader._check.stdin.write(b"HEAD:s.txt\n")
+    with pytest.raises(LogicalError):
+        reader.resolve("HEAD:p.txt")
+    assert reader.resolve("HEAD:p.txt")[0] == git_commander.get_blob_id("p.txt", "HEAD")
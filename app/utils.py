@@ -1,92 +1,407 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
 import os
-from subprocess import run, CompletedProcess
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+from subprocess import CompletedProcess, Popen, PIPE, DEVNULL
+from typing import Iterator
 
-from app.exceptions import LogicalError
+from app.cache import blob_cache, tree_cache
+from app.exceptions import GitError, LogicalError
+from app.executor import executor
+
+logger = logging.getLogger(__name__)
+
+
+# Object id that never exists, sent after every request to detect answers out of step.
+SYNC_MARKER = b"ffffffffffffffffffffffff%016x"
+OBJECT_TYPES = {b"blob", b"tree", b"commit", b"tag"}
+MAX_REF_FILE_SIZE = 256
+HEX_DIGITS = frozenset(b"0123456789abcdef")
+PATCH_HEADER_RE = re.compile(r"^(?=diff --git )", re.MULTILINE)
+
+
+def _is_hex(value: bytes) -> bool:
+    return HEX_DIGITS.issuperset(value)
+
+
+class BatchReader:
+    """Long-lived `git cat-file --batch-check` / `--batch` pair for one repo.
+
+    Resolving and reading objects through these processes avoids forking
+    git for every note read. An executor slot is held while a request is
+    answered, so the processes count against the git process caps only
+    while they work.
+    """
 
-class GitCommander:
     def __init__(self, repo_path: str):
         self.repo_path = repo_path
+        self._lock = threading.Lock()
+        self._check: Popen | None = None
+        self._batch: Popen | None = None
+        self._pid = os.getpid()
+        self._requests = 0
+
+    def _spawn(self, mode: str) -> Popen:
+        return executor.popen(
+            ["git", "cat-file", mode],
+            cwd=self.repo_path,
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
+        )
+
+    def start(self) -> None:
+        with self._lock:
+            self._ensure_started()
+
+    def _ensure_started(self) -> None:
+        if self._pid != os.getpid():  # forked (e.g. gunicorn --preload)
+            self._check = self._batch = None
+            self._pid = os.getpid()
+        if self._check is None or self._check.poll() is not None:
+            self._check = self._spawn("--batch-check")
+        if self._batch is None or self._batch.poll() is not None:
+            self._batch = self._spawn("--batch")
+
+    def _request(self, proc: Popen, rev: str) -> tuple[bytes, bytes]:
+        """Sends rev followed by a marker object id, whose answer is checked by _sync."""
+        if "\n" in rev:  # would be taken for two requests
+            raise LogicalError(f"invalid revision - {rev!r}")
+        self._requests += 1
+        marker = SYNC_MARKER % self._requests
+        proc.stdin.write(rev.encode() + b"\n" + marker + b"\n")
+        proc.stdin.flush()
+        return proc.stdout.readline(), marker
+
+    def _sync(self, proc: Popen, rev: str, marker: bytes) -> None:
+        """Checks that the answers read so far were the answers to rev.
+
+        Raises:
+            LogicalError: the output is out of step; the processes are restarted.
+        """
+        line = proc.stdout.readline()
+        if line != marker + b" missing\n":
+            self._restart()
+            raise LogicalError(f"git cat-file answered out of step to {rev!r}")
+
+    def _parse_header(self, rev: str, line: bytes) -> tuple[str, str, int] | None:
+        """(object id, type, size) of a header line, None if rev is missing."""
+        if line.endswith((b" missing\n", b" ambiguous\n")):
+            return None
+        fields = line.split()
+        if len(fields) != 3 or fields[1] not in OBJECT_TYPES or not fields[2].isdigit():
+            self._restart()
+            raise LogicalError(f"git cat-file answered {line[:100]!r} to {rev!r}")
+        return fields[0].decode(), fields[1].decode(), int(fields[2])
+
+    def _restart(self) -> None:
+        """Drops the processes; they are started again on next use."""
+        for proc in (self._check, self._batch):
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        self._check = self._batch = None
+
+    def resolve(self, rev: str) -> tuple[str, str, int] | None:
+        """Returns (object id, type, size) of rev or None, if it is missing."""
+        with self._lock, executor.slot(self.repo_path):
+            self._ensure_started()
+            line, marker = self._request(self._check, rev)
+            header = self._parse_header(rev, line)
+            self._sync(self._check, rev, marker)
+            return header
+
+    def read(self, oid: str) -> bytes | None:
+        with self._lock, executor.slot(self.repo_path):
+            self._ensure_started()
+            line, marker = self._request(self._batch, oid)
+            header = self._parse_header(oid, line)
+            content = self._batch.stdout.read(header[2] + 1) if header is not None else b"\n"
+            self._sync(self._batch, oid, marker)
+            if header is None:
+                return None
+        return content[:-1]
+
+    def close(self) -> None:
+        with self._lock:
+            for proc in (self._check, self._batch):
+                if proc is not None and proc.poll() is None:
+                    proc.stdin.close()
+                    proc.wait()
+            self._check = self._batch = None
+
+
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+# In the git directory, the commit the commit-graph was last written for.
+COMMIT_GRAPH_STAMP = "wenote-commit-graph"
+
+_batch_readers: dict[str, BatchReader] = {}
+_git_dirs: dict[str, str] = {}
+_batch_readers_lock = threading.Lock()
+
+
+def get_batch_reader(repo_path: str | None) -> BatchReader:
+    key = os.path.abspath(repo_path or os.curdir)
+    with _batch_readers_lock:
+        reader = _batch_readers.get(key)
+        if reader is None:
+            reader = _batch_readers[key] = BatchReader(key)
+        return reader
+
+
+
+WORKTREES_DIR = "wenote-worktrees"
+WORKTREE_LOCKS_DIR = "wenote-worktree-locks"
+
+_held_worktrees = threading.local()  # worktrees whose lock the thread holds
+
+
+class GitCommander:
+    def __init__(self, repo_path: str, main_repo_path: str | None = None):
+        self.repo_path = repo_path
+        # Worktree MAIN_BRANCH is checked out in; differs for user worktrees.
+        self.main_repo_path = main_repo_path or repo_path
+
+    @property
+    def is_user_worktree(self) -> bool:
+        return self.main_repo_path != self.repo_path
 
     def create_repo(self) -> None:
         """Creates a Git repository with a default branch, if it does not exist.
         """
-        output = run(
-            ["git", "-C", self.repo_path, "rev-parse", "--is-inside-work-tree"],
-            capture_output=True
-        )
+        output = self._run(["git", "-C", self.repo_path, "rev-parse", "--is-inside-work-tree"])
         if output.returncode == 0 and output.stdout.decode().strip() == "true":
-            print("Repository already exists!")
+            logger.info("repository %s already exists", self.repo_path)
             return
 
-        output = run(["git", "init"], capture_output=True, cwd=self.repo_path)
+        output = self._run(["git", "init"])
         self._check_output(output)
 
         # Create an initial commit to ensure a default branch exists.
         initial_file = os.path.join(self.repo_path, ".gitkeep")
         with open(initial_file, "w") as f:
             f.write("")
-        run(["git", "add", ".gitkeep"], capture_output=True, cwd=self.repo_path)
-        output = run(
-            ["git", "commit", "-m", "Initial commit"],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        self._run(["git", "add", ".gitkeep"])
+        output = self._run(["git", "commit", "-m", "Initial commit"])
         self._check_output(output)
 
     def get_commit_id(self, from_: str) -> str:
-        output = run(
-            ["git", "rev-parse", from_],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        commit_id = self._read_branch_ref(from_)
+        if commit_id is not None:
+            return commit_id
+
+        output = self._run(["git", "rev-parse", from_])
         return self._check_output(output).strip("\n")
 
-    def switch_user(self):
+    def _read_branch_ref(self, branch_name: str) -> str | None:
+        """Commit id of a branch read from its ref file or packed-refs, without forking git.
+
+        None for anything else (symbolic refs, revisions, other ref backends);
+        git rev-parse resolves those.
         """
-        Placeholder for user (and branch) switching logic.
+        git_dir = self.get_git_dir()
+        try:
+            with open(os.path.join(git_dir, "refs", "heads", branch_name), "rb") as fh:
+                content = fh.read(MAX_REF_FILE_SIZE)
+        except FileNotFoundError:
+            return self._read_packed_ref(git_dir, branch_name)
+        except (OSError, ValueError):  # a directory, an invalid name
+            return None
+        # Refs are written to a lock file and renamed into place, so a read
+        # is never torn; an object id and a newline is a plain branch.
+        if len(content) in (41, 65) and content.endswith(b"\n") and _is_hex(content[:-1]):
+            return content[:-1].decode()
+        return None
+
+    @staticmethod
+    def _read_packed_ref(git_dir: str, branch_name: str) -> str | None:
+        try:
+            with open(os.path.join(git_dir, "packed-refs"), "rb") as fh:
+                packed = fh.read()
+        except OSError:
+            return None
+        ref = f" refs/heads/{branch_name}\n".encode()
+        end = packed.find(ref)
+        if end < 0:
+            return None
+        start = packed.rfind(b"\n", 0, end) + 1
+        if end - start in (40, 64) and _is_hex(packed[start:end]):
+            return packed[start:end].decode()
+        return None
+
+    @contextlib.contextmanager
+    def worktree_lock(self) -> Iterator[None]:
+        """Keeps writers of all workers out of this worktree; re-entrant within a thread."""
+        key = os.path.abspath(self.repo_path or os.curdir)
+        held = _held_worktrees.__dict__.setdefault("keys", set())
+        if key in held:
+            yield
+            return
+
+        lock_dir = os.path.join(self.get_git_dir(), WORKTREE_LOCKS_DIR)
+        os.makedirs(lock_dir, exist_ok=True)
+        name = hashlib.sha1(key.encode()).hexdigest()[:16]
+        with open(os.path.join(lock_dir, f"{name}.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # released with the file
+            held.add(key)
+            try:
+                yield
+            finally:
+                held.discard(key)
+
+    def switch_user(self, user: str, start_point: str) -> "GitCommander":
+        """Commander of the user's own worktree, created at start_point on first use.
+
+        User worktrees are sparse: only top-level notes are checked out until
+        sparse_checkout_add() adds the directories the user works in.
         """
-        # TODO: Implement user switching logic as needed.
-        pass
+        worktrees_dir = os.path.join(self.get_git_dir(), WORKTREES_DIR)
+        path = os.path.join(worktrees_dir, quote(user, safe=""))
+        if not os.path.isdir(path):
+            os.makedirs(worktrees_dir, exist_ok=True)
+            with open(os.path.join(worktrees_dir, ".lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)  # another worker may be creating it
+                if not os.path.isdir(path):
+                    self._create_sparse_worktree(path, start_point)
+        return GitCommander(path, main_repo_path=self.repo_path)
+
+    def _create_sparse_worktree(self, path: str, start_point: str) -> None:
+        output = self._run(["git", "worktree", "add", "--detach", "--no-checkout", path, start_point])
+        self._check_output(output)
+        worktree = GitCommander(path, main_repo_path=self.repo_path)
+        output = worktree._run(["git", "sparse-checkout", "set", "--cone"])
+        worktree._check_output(output)
+        output = worktree._run(["git", "checkout", "--detach", start_point])
+        worktree._check_output(output)
+
+    def sparse_checkout_add(self, note_path: str) -> None:
+        """Makes sure the directory of note_path is checked out in a user worktree."""
+        dir_path = os.path.dirname(note_path)
+        if self.is_user_worktree and dir_path:
+            output = self._run(["git", "sparse-checkout", "add", dir_path])
+            self._check_output(output)
+
+    def detach(self, rev: str, force: bool = False) -> str:
+        args = ["git", "checkout", "--detach", rev]
+        if force:
+            args.insert(2, "--force")
+        output = self._run(args)
+        return self._check_output(output)
 
     def file_exists(self, note_path: str, branch_name: str) -> bool:
-        output = run(
-            ["git", "cat-file", "-e", f"{branch_name}:{note_path}"],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        output = self._run(["git", "cat-file", "-e", f"{branch_name}:{note_path}"])
         return not self._check_output(output)
 
     def show_file(self, note_path: str, branch_name: str) -> str:
-        output = run(
-            ["git", "show", f"{branch_name}:{note_path}"],
-            capture_output=True,
-            cwd=self.repo_path
+        return self.read_blob(note_path, branch_name).decode()
+
+    def read_blob(self, note_path: str, branch_name: str) -> bytes:
+        """Reads note content through the batch reader and the blob cache."""
+        reader = get_batch_reader(self.repo_path)
+        info = reader.resolve(f"{branch_name}:{note_path}")
+        if info is None or info[1] != "blob":
+            raise LogicalError(f"note does not exist - {branch_name}:{note_path}")
+
+        oid = info[0]
+        content = blob_cache.get(oid)
+        if content is None:
+            content = reader.read(oid)
+            if content is None:
+                raise LogicalError(f"object vanished while reading - {oid}")
+            blob_cache.set(oid, content)
+        return content
+
+    def get_blob_id(self, note_path: str, rev: str) -> str | None:
+        """Object id of the note at rev, None if it does not exist there."""
+        info = get_batch_reader(self.repo_path).resolve(f"{rev}:{note_path}")
+        if info is None or info[1] != "blob":
+            return None
+        return info[0]
+
+    def get_blob_info(self, note_path: str, rev: str) -> tuple[str, int]:
+        """Object id and size of the note at rev, without reading its content."""
+        info = get_batch_reader(self.repo_path).resolve(f"{rev}:{note_path}")
+        if info is None or info[1] != "blob":
+            raise LogicalError(f"note does not exist - {rev}:{note_path}")
+        return info[0], info[2]
+
+    def hash_object(self, data: bytes) -> str:
+        """Writes data into the object store, returns the blob id."""
+        output = self._run(["git", "hash-object", "-w", "--stdin"], input=data)
+        return self._check_output(output).strip("\n")
+
+    def write_tree_commit(self, parent: str, changes: dict[str, str | None], msg: str) -> str:
+        """Creates a commit on top of parent without touching HEAD, index or worktree.
+
+        Args:
+            parent: parent commit id.
+            changes: note path -> new blob id, or None to delete the note.
+            msg: commit message.
+
+        Returns:
+            new commit id.
+        """
+        fd, index_file = tempfile.mkstemp(prefix="wenote-index-", dir=self.get_git_dir())
+        os.close(fd)
+        env = {"GIT_INDEX_FILE": index_file}
+        try:
+            output = self._run(["git", "read-tree", parent], env=env)
+            self._check_output(output)
+
+            index_info = "".join(
+                f"100644 {oid}\t{path}\0" if oid else f"0 {'0' * 40}\t{path}\0"
+                for path, oid in changes.items()
+            )
+            output = self._run(["git", "update-index", "-z", "--index-info"],
+                               input=index_info.encode(), env=env)
+            self._check_output(output)
+
+            output = self._run(["git", "write-tree"], env=env)
+            tree = self._check_output(output).strip("\n")
+        finally:
+            os.remove(index_file)
+
+        output = self._run(["git", "commit-tree", tree, "-p", parent, "-m", msg])
+        return self._check_output(output).strip("\n")
+
+    def update_ref(self, branch_name: str, new_commit: str, old_commit: str) -> bool:
+        """Compare-and-swap of a branch ref; False if it no longer points at old_commit."""
+        output = self._run(["git", "update-ref", f"refs/heads/{branch_name}", new_commit, old_commit])
+        return output.returncode == 0
+
+    def list_refs(self) -> dict[str, str]:
+        output = self._run(["git", "for-each-ref", "--format=%(refname) %(objectname)"])
+        return dict(
+            line.split(" ", 1) for line in self._check_output(output).splitlines()
         )
-        return self._check_output(output)
+
+    def get_git_dir(self) -> str:
+        """Absolute path of the repository's common git directory."""
+        key = os.path.abspath(self.repo_path or os.curdir)
+        git_dir = _git_dirs.get(key)
+        if git_dir is None:
+            output = self._run(["git", "rev-parse", "--path-format=absolute", "--git-common-dir"])
+            git_dir = _git_dirs[key] = self._check_output(output).strip("\n")
+        return git_dir
 
     # TODO: the function should just create a branch, without checkouting it.
     def create_branch(self, branch_name: str) -> str:
-        output = run(
-            ["git", "checkout", "-b", branch_name],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        output = self._run(["git", "checkout", "-b", branch_name])
         return self._check_output(output)
 
     def checkout_branch(self, branch_name: str) -> str:
-        output = run(
-            ["git", "checkout", branch_name],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        output = self._run(["git", "checkout", branch_name])
         return self._check_output(output)
 
     def list_branches(self, name: str = "--all") -> str:
-        output = run(
-            ["git", "branch", "-l", name],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        output = self._run(["git", "branch", "-l", name])
         return self._check_output(output)
 
     def branch_exists(self, name: str) -> bool:
@@ -105,83 +420,341 @@ class GitCommander:
             fh.write(note_value)
 
     def add_file(self, file: str) -> str:
-        output = run(
-            ["git", "add", file],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        output = self._run(["git", "add", file])
         return self._check_output(output)
 
     def commit(self, file_path: str | None = None, msg: str = "msg") -> str:
         if file_path:
-            output = run(
-                ["git", "commit", file_path, "-m", msg],
-                capture_output=True,
-                cwd=self.repo_path
-            )
+            output = self._run(["git", "commit", file_path, "-m", msg])
         else:
-            output = run(
-                ["git", "commit", "-m", msg],
-                capture_output=True,
-                cwd=self.repo_path
-            )
+            output = self._run(["git", "commit", "-m", msg])
 
-        return self._check_output(output)
+        stdout = self._check_output(output, ok_codes=(0, 1))
+        if output.returncode == 1 and "nothing" not in stdout:  # "nothing to commit" is fine
+            raise GitError(output.args, output.returncode, output.stderr)
+        return stdout
 
     def merge(self, branch: str) -> bool:
-        output = run(
-            ["git", "merge", branch],
-            capture_output=True,
-            cwd=self.repo_path
-        )
-        return "CONFLICT" in self._check_output(output)
+        output = self._run(["git", "merge", branch])
+        conflict = "CONFLICT" in self._check_output(output, ok_codes=(0, 1))
+        if output.returncode == 1 and not conflict:
+            raise GitError(output.args, output.returncode, output.stderr)
+        return conflict
+
+    def abort_merge(self) -> bool:
+        """Aborts a merge left in progress; False if there was none."""
+        output = self._run(["git", "merge", "--abort"])
+        return output.returncode == 0
+
+    def reset_worktree(self) -> str:
+        """Discards uncommitted changes of tracked notes."""
+        output = self._run(["git", "reset", "--hard", "-q"])
+        return self._check_output(output)
 
     def delete_branch(self, branch_name: str, force: bool = False) -> str:
         flag = "-D" if force else "-d"
-        output = run(
-            ["git", "branch", flag, branch_name],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        output = self._run(["git", "branch", flag, branch_name])
         return self._check_output(output)
 
     def delete_file(self, note_path: str) -> str:
-        output = run(
-            ["git", "rm", note_path],
-            capture_output=True,
-            cwd=self.repo_path
-        )
+        output = self._run(["git", "rm", note_path])
         return self._check_output(output)
 
     def list_files(self, branch_name: str) -> list:
-        output = run(
-            ["git", "ls-tree", "-r", branch_name, "--name-only"],
-            capture_output=True,
-            cwd=self.repo_path
+        info = get_batch_reader(self.repo_path).resolve(f"{branch_name}^{{tree}}")
+        if info is None:
+            raise LogicalError(f"not a valid tree - {branch_name}")
+
+        cache_key = f"tree:{info[0]}"
+        listing = tree_cache.get(cache_key)
+        if listing is None:
+            output = self._run(["git", "ls-tree", "-r", info[0], "--name-only"])
+            listing = self._check_output(output).encode()
+            tree_cache.set(cache_key, listing)
+        return listing.decode().splitlines()
+
+    def get_tree_id(self, dir_path: str, rev: str) -> str | None:
+        """Object id of a directory at rev (the root for an empty path), None if missing."""
+        rev = f"{rev}:{dir_path}" if dir_path else f"{rev}^{{tree}}"
+        info = get_batch_reader(self.repo_path).resolve(rev)
+        if info is None or info[1] != "tree":
+            return None
+        return info[0]
+
+    def read_tree(self, tree_id: str) -> list[tuple[str, str, str]]:
+        """Entries (name, type, object id) of one tree object, parsed in-process."""
+        raw = get_batch_reader(self.repo_path).read(tree_id)
+        if raw is None:
+            raise LogicalError(f"not a valid tree - {tree_id}")
+
+        oid_size = len(tree_id) // 2
+        entries, pos = [], 0
+        while pos < len(raw):
+            space = raw.index(b" ", pos)
+            nul = raw.index(b"\0", space)
+            mode = raw[pos:space]
+            kind = "tree" if mode == b"40000" else "commit" if mode == b"160000" else "blob"
+            entries.append((raw[space + 1:nul].decode(), kind,
+                            raw[nul + 1:nul + 1 + oid_size].hex()))
+            pos = nul + 1 + oid_size
+        return entries
+
+    def tree_snapshot(self, tree_id: str) -> dict:
+        """Compact listing of one directory with recursive note counts of subdirectories.
+
+        Snapshots are cached by tree id, so subtrees unchanged between
+        commits are read only once.
+
+        Returns:
+            {"count": notes below the directory, "entries": [[name, "tree", id, count] or
+            [name, "blob", id]]}
+        """
+        cache_key = f"snapshot:{tree_id}"
+        cached = tree_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+        entries, count = [], 0
+        for name, kind, oid in self.read_tree(tree_id):
+            if kind == "tree":
+                subtree_count = self.tree_snapshot(oid)["count"]
+                entries.append([name, kind, oid, subtree_count])
+                count += subtree_count
+            elif kind == "blob":
+                entries.append([name, kind, oid])
+                count += 1
+        snapshot = {"count": count, "entries": entries}
+        tree_cache.set(cache_key, json.dumps(snapshot, separators=(",", ":")).encode())
+        return snapshot
+
+    def diff_tree(self, from_: str, to: str, renames: bool = False) -> list[tuple[str, str, str | None]]:
+        """Lists paths changed between two tree-ish objects.
+
+        Returns:
+            (status letter, path, old path for renames and copies) tuples.
+        """
+        args = ["git", "diff-tree", "-r", "-z", "--no-commit-id", "--name-status"]
+        if renames:
+            args.append("-M")
+        output = self._run(args + [from_, to])
+        fields = self._check_output(output).split("\0")
+
+        changes = []
+        index = 0
+        while index < len(fields) - 1:
+            status = fields[index]
+            if status[:1] in ("R", "C"):
+                changes.append((status, fields[index + 2], fields[index + 1]))
+                index += 3
+            else:
+                changes.append((status, fields[index + 1], None))
+                index += 2
+        return changes
+
+    def diff_patches(self, from_: str, to: str, renames: bool = False) -> list[str]:
+        """Unified patches between two tree-ish objects, one per path, in diff_tree order."""
+        args = ["git", "diff-tree", "-r", "-p", "--no-commit-id", "--no-color", "--no-ext-diff"]
+        if renames:
+            args.append("-M")
+        output = self._run(args + [from_, to])
+        if output.returncode != 0:
+            raise GitError(output.args, output.returncode, output.stderr)
+        text = output.stdout.decode(errors="replace")  # notes need not be valid UTF-8
+        # Content lines are prefixed with " ", "+" or "-", so only file headers
+        # start a line with "diff --git ", the first of them the output.
+        return [patch for patch in PATCH_HEADER_RE.split(text) if patch]
+
+    def log_file(self, note_path: str, from_: str, limit: int) -> list[dict]:
+        """Lists up to `limit` commits touching note_path, newest first."""
+        output = self._run(["git", "log", f"-n{limit}", "--format=%H%x1f%an%x1f%ae%x1f%at%x1f%s%x1e",
+             from_, "--", note_path])
+        commits = []
+        for record in self._check_output(output).split("\x1e"):
+            record = record.strip("\n")
+            if not record:
+                continue
+            commit_id, author, email, timestamp, subject = record.split("\x1f")
+            commits.append({
+                "commit_id": commit_id,
+                "author": author,
+                "email": email,
+                "timestamp": int(timestamp),
+                "message": subject,
+            })
+        return commits
+
+    def blame(self, note_path: str, commit_id: str) -> list[dict]:
+        """Line-level blame of note_path at commit_id."""
+        output = self._run(["git", "blame", "--porcelain", commit_id, "--", note_path])
+        commits: dict[str, dict] = {}
+        lines = []
+        current: dict = {}
+        expect_header = True
+        for line in self._check_output(output).split("\n"):
+            if expect_header:
+                if not line:
+                    continue
+                line_commit_id = line.split(" ", 1)[0]
+                current = commits.setdefault(line_commit_id, {"commit_id": line_commit_id})
+                expect_header = False
+            elif line.startswith("\t"):
+                lines.append({**current, "line": line[1:]})
+                expect_header = True
+            else:
+                key, _, value = line.partition(" ")
+                if key == "author":
+                    current["author"] = value
+                elif key == "author-time":
+                    current["timestamp"] = int(value)
+                elif key == "summary":
+                    current["message"] = value
+        return lines
+
+    def commit_graph_stale(self, tip: str, max_age: float | None = None) -> bool:
+        """Whether the commit-graph should be written up to tip.
+
+        COMMIT_GRAPH_STAMP records the commit the graph was last written for.
+        The graph is stale when there is no stamp, or when the stamp names
+        another commit and, if max_age is given, is older than max_age seconds.
+        """
+        try:
+            with open(os.path.join(self.get_git_dir(), COMMIT_GRAPH_STAMP)) as fh:
+                written = fh.read().strip()
+                age = time.time() - os.fstat(fh.fileno()).st_mtime
+        except FileNotFoundError:
+            return True
+        return written != tip and (max_age is None or age >= max_age)
+
+    def ensure_commit_graph(self, tip: str, max_age: float | None = None) -> bool:
+        """Writes an incremental commit-graph with changed-path Bloom filters,
+        if it is stale (see commit_graph_stale). Returns True, if it was written.
+
+        Only one worker writes at a time; the others skip the write.
+        """
+        if not self.commit_graph_stale(tip, max_age):
+            return False
+        stamp = os.path.join(self.get_git_dir(), COMMIT_GRAPH_STAMP)
+        fd = os.open(f"{stamp}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            output = self._run(["git", "commit-graph", "write", "--reachable", "--changed-paths", "--split"])
+            self._check_output(output)
+            with open(f"{stamp}.tmp", "w") as fh:
+                fh.write(f"{tip}\n")
+            os.replace(f"{stamp}.tmp", stamp)
+            return True
+        finally:
+            os.close(fd)
+
+    def get_last_commit(self, note_path: str, rev: str) -> str | None:
+        """Last commit up to rev that changed note_path, None if none did."""
+        output = self._run(["git", "rev-list", "-1", rev, "--", note_path])
+        return self._check_output(output).strip("\n") or None
+
+    def archive(self, commit_id: str, fmt: str = "tar") -> Popen:
+        """Starts `git archive`; the caller streams its stdout."""
+        return executor.popen(
+            ["git", "archive", f"--format={fmt}", commit_id],
+            cwd=self.repo_path,
+            stdout=PIPE,
+            stderr=DEVNULL,
         )
-        return self._check_output(output).splitlines()
 
-    def get_current_branch(self) -> str:
-        output = run(
-            ["git", "branch", "--show-current"],
-            capture_output=True,
-            cwd=self.repo_path
+    def cat_blob(self, blob_id: str) -> Popen:
+        """Starts `git cat-file blob`; the caller streams its stdout."""
+        return executor.popen(
+            ["git", "cat-file", "blob", blob_id],
+            cwd=self.repo_path,
+            stdout=PIPE,
+            stderr=DEVNULL,
+        )
+
+    def hash_object_file(self, path: str) -> str:
+        """Writes the content of a file, as is, into the object store, returns the blob id."""
+        output = self._run(["git", "hash-object", "-w", "--no-filters", "--", path])
+        return self._check_output(output).strip("\n")
+
+    def fast_import(self) -> Popen:
+        """Starts `git fast-import`; the caller writes the import stream to its stdin."""
+        return executor.popen(
+            ["git", "fast-import", "--quiet", "--done"],
+            cwd=self.repo_path,
+            stdin=PIPE,
+            stdout=DEVNULL,
+            stderr=PIPE,
         )
+
+    def get_committer_ident(self) -> str:
+        output = self._run(["git", "var", "GIT_COMMITTER_IDENT"])
+        return self._check_output(output).strip("\n")
+
+    def sync_worktree(self, old_commit: str, new_commit: str) -> str:
+        """Moves index and worktree from old_commit to new_commit after the
+        checked out branch was updated underneath them."""
+        output = self._run(["git", "read-tree", "-m", "-u", old_commit, new_commit])
+        return self._check_output(output)
+
+    def merge_base(self, first: str, second: str) -> str | None:
+        output = self._run(["git", "merge-base", first, second])
+        if output.returncode != 0:
+            return None
+        return output.stdout.decode().strip("\n")
+
+    def is_ancestor(self, ancestor: str, descendant: str) -> bool:
+        output = self._run(["git", "merge-base", "--is-ancestor", ancestor, descendant])
+        return output.returncode == 0
+
+    def get_current_branch(self) -> str:
+        output = self._run(["git", "branch", "--show-current"])
         return self._check_output(output).strip("\n")
 
     def is_conflict_branch(self, branch_name: str) -> bool:
         return branch_name.startswith("conflict")
 
-    def _check_output(self, output: CompletedProcess) -> str:
+    def _run(self, args: list[str], input: bytes | None = None,
+             env: dict[str, str] | None = None) -> CompletedProcess:
+        return executor.run(args, cwd=self.repo_path, input=input, env=env)
+
+    def _check_output(self, output: CompletedProcess, ok_codes: tuple[int, ...] = (0,)) -> str:
         """
-        Checks for errors in the CompletedProcess and returns the stdout as a string.
+        Checks the exit code of the CompletedProcess and returns the stdout as a string.
         """
-        def check_for_error(stream: bytes) -> bool:
-            return b"error" in stream or b"fatal" in stream
-
-        if check_for_error(output.stderr):
-            print("ERR: in _check_output:", output.stderr)
-            raise LogicalError(output.stderr)
+        if output.returncode not in ok_codes:
+            logger.warning("git %s failed with %s: %s", " ".join(output.args[1:3]), output.returncode,
+                         output.stderr.decode(errors="replace").strip())
+            raise GitError(output.args, output.returncode, output.stderr)
         return output.stdout.decode()
 
 
+_graph_writes: set[str] = set()
+_graph_writes_lock = threading.Lock()
+
+
+def refresh_commit_graph(repo_path: str | None, tip: str, max_age: float | None) -> None:
+    """Brings a stale commit-graph up to tip in a background thread.
+
+    History and blame requests do not wait for the write; they only get
+    faster once it is done.
+    """
+    git = GitCommander(repo_path)
+    if not git.commit_graph_stale(tip, max_age):
+        return
+    key = os.path.abspath(repo_path or os.curdir)
+    with _graph_writes_lock:
+        if key in _graph_writes:
+            return
+        _graph_writes.add(key)
+
+    def write():
+        try:
+            git.ensure_commit_graph(tip, max_age)
+        except Exception:
+            logger.exception("writing the commit-graph of %s failed", key)
+        finally:
+            with _graph_writes_lock:
+                _graph_writes.discard(key)
+
+    threading.Thread(target=write, name="commit-graph", daemon=True).start()
@@ -0,0 +1,138 @@
+"""Startup warm-up of configured repositories.
+
+Typical usage example:
+    seconds = warm_up([settings.REPO_PATH])
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from app import metrics
+from app.exceptions import LogicalError
+from app.utils import GitCommander, get_batch_reader
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+ACCESS_LOG_NAME = "wenote-access.json"
+
+
+class AccessLog:
+    """Persisted per-repo note read counters, used to pick notes to prefetch.
+
+    Counts are kept in memory and merged into the file under a lock every
+    `flush_every` reads and at exit, so all workers contribute to one file.
+    """
+
+    def __init__(self, path: str, flush_every: int = 100):
+        self.path = path
+        self.flush_every = flush_every
+        self._pending: dict[str, int] = {}
+        self._pending_total = 0
+        self._lock = threading.Lock()
+
+    def record(self, note_path: str) -> None:
+        with self._lock:
+            self._pending[note_path] = self._pending.get(note_path, 0) + 1
+            self._pending_total += 1
+            if self._pending_total < self.flush_every:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending, self._pending_total = self._pending, {}, 0
+        if not pending:
+            return
+
+        with open(self.path, "a+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            counts = _parse_counts(fh.read())
+            for note_path, count in pending.items():
+                counts[note_path] = counts.get(note_path, 0) + count
+            fh.seek(0)
+            fh.truncate()
+            json.dump(counts, fh)
+
+    def hottest(self, limit: int) -> list[str]:
+        try:
+            with open(self.path) as fh:
+                counts = _parse_counts(fh.read())
+        except FileNotFoundError:
+            return []
+        return sorted(counts, key=counts.get, reverse=True)[:limit]
+
+
+def _parse_counts(raw: str) -> dict[str, int]:
+    try:
+        counts = json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
+    return counts if isinstance(counts, dict) else {}
+
+
+_access_logs: dict[str, AccessLog] = {}
+_access_logs_lock = threading.Lock()
+
+
+def get_access_log(repo_path: str | None) -> AccessLog:
+    git_dir = GitCommander(repo_path).get_git_dir()
+    with _access_logs_lock:
+        access_log = _access_logs.get(git_dir)
+        if access_log is None:
+            access_log = AccessLog(os.path.join(git_dir, ACCESS_LOG_NAME))
+            _access_logs[git_dir] = access_log
+        return access_log
+
+
+@atexit.register
+def _flush_access_logs() -> None:
+    for access_log in list(_access_logs.values()):
+        try:
+            access_log.flush()
+        except OSError:
+            pass
+
+
+def warm_repo(repo_path: str) -> int:
+    """Starts batch readers, loads refs, refreshes the commit-graph and prefetches
+    the hottest notes.
+
+    Returns:
+        number of prefetched notes.
+    """
+    git = GitCommander(repo_path)
+    get_batch_reader(repo_path).start()
+    git.list_refs()
+    git.ensure_commit_graph(git.get_commit_id(settings.MAIN_BRANCH), settings.COMMIT_GRAPH_MAX_AGE)
+
+    prefetched = 0
+    for note_path in get_access_log(repo_path).hottest(settings.WARMUP_HOT_NOTES):
+        try:
+            git.read_blob(note_path, settings.MAIN_BRANCH)
+        except LogicalError:  # deleted or renamed since it was logged
+            continue
+        prefetched += 1
+    return prefetched
+
+
+def warm_up(repo_paths: list[str]) -> float:
+    """Warms all given repositories, returns the elapsed time in seconds."""
+    started = time.perf_counter()
+    for repo_path in repo_paths:
+        try:
+            prefetched = warm_repo(repo_path)
+        except Exception:
+            logger.exception("warm-up failed for %s", repo_path)
+            continue
+        logger.info("warmed %s, prefetched %d notes", repo_path, prefetched)
+
+    elapsed = time.perf_counter() - started
+    metrics.set_gauge("warmup_seconds", elapsed)
+    return elapsed
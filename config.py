@@ -1,17 +1,8 @@
-import logging
+import os
+import tempfile
+from typing import Literal
 
-from pydantic_settings import BaseSettings 
-
-logging.basicConfig(
-    format="%(levelname)s: %(asctime)s: %(message)s",
-    filename="logs/logs.txt",
-    level=logging.INFO,
-)
-
-logging.getLogger("uvicorn.access").disabled = True
-
-logger = logging.getLogger("uvicorn")
-logger.setLevel(logging.getLevelName(logging.DEBUG))
+from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
@@ -19,5 +10,89 @@ class Settings(BaseSettings):
     REPO_PATH: str
     MAIN_BRANCH: str
 
+    LOGS_DIR: str = "logs"
+
+    # structured logging, see app.logs
+    LOG_FILE: str = "wenoteapi.log"  # in LOGS_DIR, stderr when empty
+    LOG_LEVEL: str = "INFO"
+    LOG_QUEUE_SIZE: int = 10000  # records beyond it are dropped
+    LOG_FLUSH_INTERVAL: float = 0.2
+    LOG_SAMPLE_RATE: float = 1.0  # share of requests logged below WARNING
+    LOG_SLOW_GIT_SECONDS: float = 1.0
+
+    # storage of the note services, see app.backends
+    STORAGE_BACKEND: Literal["git", "memory"] = "git"
+
+    # startup warm-up
+    WARMUP_ON_BOOT: bool = False
+    WARMUP_REPOS: list[str] = []
+    WARMUP_HOT_NOTES: int = 50
+
+    # per-process caches
+    BLOB_CACHE_BYTES: int = 32 * 1024 * 1024
+    TREE_CACHE_BYTES: int = 8 * 1024 * 1024
+    HISTORY_CACHE_BYTES: int = 8 * 1024 * 1024
+
+    # node-wide cache shared by all workers, disabled when empty
+    SHARED_CACHE_PATH: str = ""
+    SHARED_CACHE_BYTES: int = 64 * 1024 * 1024
+    SINGLEFLIGHT_LOCK_DIR: str = os.path.join(tempfile.gettempdir(), "wenote-flights")
+
+    # large notes, see app.lfs
+    MAX_NOTE_BYTES: int = 64 * 1024 * 1024
+    LFS_THRESHOLD_BYTES: int = 0  # 0 keeps every note in git
+    LFS_STORE_PATH: str = ""  # defaults to wenote-lfs in the git directory
+    MAX_IMPORT_BYTES: int = 1024 * 1024 * 1024  # whole archive uploads, see app.archives
+
+    # write-ahead journal of note writes, see app.journal
+    JOURNAL_WRITES: bool = False
+    JOURNAL_POLL_INTERVAL: float = 1.0
+    JOURNAL_COMPACT_BYTES: int = 1024 * 1024
+    JOURNAL_REGISTRY_DIR: str = os.path.join(os.path.expanduser("~"), ".wenote-journals")
+
+    # per-user sparse worktrees, users are named by the X-Wenote-User header
+    USER_WORKTREES: bool = False
+
+    # access control, see app.acl
+    ACL_FILE: str = ".wenote-acl.json"
+    ACL_CACHE_SIZE: int = 256
+
+    # full-text search
+    SEARCH_MAX_NOTE_BYTES: int = 1024 * 1024
+
+    # git subprocesses
+    GIT_MAX_PROCS: int = 16
+    GIT_MAX_PROCS_PER_REPO: int = 4
+    GIT_ACQUIRE_TIMEOUT: float = 5.0
+    GIT_LOCK_DIR: str = os.path.join(tempfile.gettempdir(), "wenote-git")  # slots of all workers
+    GIT_TIMEOUT: float = 30.0
+    GIT_SLOW_TIMEOUT: float = 120.0
+
+    # admission control of incoming requests
+    ADMISSION_CONTROL: bool = False
+    ADMISSION_LOCK_DIR: str = os.path.join(tempfile.gettempdir(), "wenote-admission")
+    ADMISSION_MAX_INFLIGHT: int = 32
+    ADMISSION_READ_RESERVED: int = 8
+    ADMISSION_MAX_WRITES_PER_REPO: int = 2
+    ADMISSION_READ_TIMEOUT: float = 2.0
+    ADMISSION_WRITE_TIMEOUT: float = 5.0
+    ADMISSION_RETRY_AFTER: int = 1
+
+    # admin endpoints and profiling, see app.profiling
+    ADMIN_TOKEN: str = ""  # admin endpoints are disabled when empty
+    PROFILE_INTERVAL: float = 0.005
+    PROFILE_MAX_SECONDS: int = 300
+    PROFILE_DIR: str = os.path.join(tempfile.gettempdir(), "wenote-profiles")  # shared by all workers
+
+    # traffic capture for app.replay, disabled when CAPTURE_PATH is empty
+    CAPTURE_PATH: str = ""
+    CAPTURE_SAMPLE_RATE: float = 1.0
+    CAPTURE_MAX_BYTES: int = 1024 * 1024 * 1024
+    CAPTURE_SALT: str = ""  # users are dropped from captures when empty
+
+    # history, blame and diffs
+    COMMIT_GRAPH_MAX_AGE: int = 300
+    DIFF_MAX_PATCH_BYTES: int = 4 * 1024 * 1024  # larger diffs are returned without patches
+
 
 settings = Settings(_env_file=".env")